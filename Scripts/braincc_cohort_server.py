@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Script to run a resident cohort server. Cohorts of connectivity matrices are
+loaded (or memory-mapped with --mmap) on their first query and kept in memory,
+so that repeated calls of braincc_export_values_from_matrix.py,
+braincc_compute_metrics_for_clusters.py and braincc_matrices_math.py with
+--server answer in milliseconds instead of reloading every matrix. Cohorts are
+reloaded if one of their files changes on disk, and the least recently queried
+cohort is released when more than --max_cohorts are held.
+
+The server listens on a local Unix socket (only accessible by the current
+user) and runs until stopped with --stop (or Ctrl-C). Scripts run standalone
+when no server is running.
+
+Ex: braincc_cohort_server.py &
+    braincc_export_values_from_matrix.py --input *.npy --all --server
+    braincc_cohort_server.py --stop
+"""
+
+import argparse
+import logging
+
+from brainccpy.io.server import connect, default_socket, serve
+
+
+def _build_arg_parser():
+    p = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawTextHelpFormatter)
+
+    p.add_argument('--socket', default=default_socket(),
+                   help='Socket filename. [%(default)s]')
+    p.add_argument('--mmap', action='store_true',
+                   help='If set, matrices are memory-mapped instead of loaded.')
+    p.add_argument('--max_cohorts', type=int, default=4,
+                   help='Maximum number of cohorts kept in memory. [%(default)s]')
+    p.add_argument('--stop', action='store_true',
+                   help='Stop the server running on --socket.')
+    p.add_argument('--verbose', action='store_true', required=False,
+                   help='If applied, verbose mode is activated.')
+
+    return p
+
+
+def main():
+    parser = _build_arg_parser()
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.getLogger().setLevel(logging.INFO)
+
+    if args.stop:
+        client = connect(args.socket)
+        if client is None:
+            parser.error(f'No server running on {args.socket}.')
+        with client:
+            client.request('shutdown')
+        return
+
+    if args.max_cohorts < 1:
+        parser.error('--max_cohorts should be at least 1.')
+
+    try:
+        serve(args.socket, mmap=args.mmap, max_cohorts=args.max_cohorts)
+    except RuntimeError as e:
+        parser.error(str(e))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
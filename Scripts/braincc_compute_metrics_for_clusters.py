@@ -3,11 +3,22 @@
 
 
 import argparse
+import contextlib
 import logging
 import os
 
 import json
 import numpy as np
+import pandas as pd
+from brainccpy.io.backend import cluster_means, compute, load_stack, local_cluster
+from brainccpy.io.incremental import (file_signature,
+                                      fingerprint,
+                                      load_state,
+                                      plan_update,
+                                      save_state)
+from brainccpy.io.manifest import select_connectoflow_inputs
+from brainccpy.io.server import connect, default_socket
+from brainccpy.io.utils import clusters_to_indices, load_matrix_stack
 from scilpy.io.utils import (add_overwrite_arg,
                              add_verbose_arg,
                              assert_inputs_exist,
@@ -28,10 +39,40 @@ def _build_arg_parser():
     p.add_argument('--conn_dir', required=True,
                    help='Directory containing the connectoflow output. \n'
                         'Needed to fetch the selected connectivity matrices.')
-    p.add_argument('--metrics', required=True,
+    p.add_argument('--metrics', nargs='+', required=True,
                    help='Metrics to extract from the connectoflow output.')
     p.add_argument('--output', required=True,
                    help='Filename for the outputted excel sheet (.xlsx)')
+    p.add_argument('--manifest',
+                   help='Manifest index of the connectoflow output, used to select \n'
+                        'inputs without checking every file. It is built on first \n'
+                        'use. [conn_dir/.brainccpy_manifest.json]')
+    p.add_argument('--refresh_manifest', action='store_true',
+                   help='If set, the manifest index is refreshed (file sizes and \n'
+                        'mtimes are compared). Use it after modifying matrices.')
+    p.add_argument('--float32', action='store_true',
+                   help='If set, matrices are held as float32 (means are still \n'
+                        'accumulated in float64).')
+
+    p.add_argument('--backend', choices=['numpy', 'dask'], default='numpy',
+                   help='With dask, matrices (.npy only) are read lazily in chunks of \n'
+                        'subjects and cluster means are computed on a local dask \n'
+                        'cluster. Requires dask[distributed]. \n'
+                        '[%(default)s]')
+    p.add_argument('--n_workers', type=int, required=False,
+                   help='Number of dask workers. Defaults to the number of cores.')
+    p.add_argument('--server', nargs='?', const=default_socket(),
+                   help='Query the cohort server (braincc_cohort_server.py) listening \n'
+                        'on this socket, falling back to standalone mode if it is not \n'
+                        'running. [%(const)s]')
+
+    p.add_argument('--incremental', action='store_true',
+                   help='If set, only new or modified subjects are computed and merged \n'
+                        'into an existing output. A state file (output.state.json) \n'
+                        'records the input files and the clusters definition.')
+    p.add_argument('--use_hash', action='store_true',
+                   help='If set with --incremental, compare inputs using their content \n'
+                        'hash instead of their modification time and size.')
 
     add_verbose_arg(p)
     add_overwrite_arg(p)
@@ -39,6 +80,16 @@ def _build_arg_parser():
     return p
 
 
+def _load_matrix(path, dtype=None):
+    # .npy matrices are memory-mapped and copied directly into the requested
+    # dtype, so no float64 copy is made with --float32.
+    if path.endswith('.npy'):
+        return load_matrix_stack([path], dtype=dtype)[0]
+    mat = load_matrix_in_any_format(path)
+
+    return mat if dtype is None else mat.astype(dtype, copy=False)
+
+
 def main():
     parser = _build_arg_parser()
     args = parser.parse_args()
@@ -46,26 +97,78 @@ def main():
     if args.verbose:
         logging.getLogger().setLevel(logging.INFO)
 
-    assert_inputs_exist(parser, args.cluster_json+args.list_id+args.conn_dir+args.metrics)
-    assert_outputs_exist(parser, args, args.output)
+    assert_inputs_exist(parser, [args.cluster_json, args.list_id])
+    if not args.incremental:
+        assert_outputs_exist(parser, args, args.output)
 
     with open(f'{args.cluster_json}', 'r') as f:
         cluster_dict = json.load(f)
 
     subjects = open(args.list_id).read().split()
-
-    for metric in args.metrics:
-
-        for sub in subjects:
-            mat = load_matrix_in_any_format(f'{args.conn_dir}/{sub}/Compute_Connectivity/{metric}.npy')
-            shape = mat.shape
-            for i in cluster_dict.keys():
-                mask = np.empty((shape))
-                edges = cluster_dict[f'{i}']
-                for i in edges:
-                    x, y = i.split('_')
-                    mask[int(x)-1, int(y)-1] = 1
-                # Keep only values over 0
-                non_zero = mask > 0
-                mean = np.mean(mat * mask, where=non_zero)
-
+    paths = select_connectoflow_inputs(parser, args.conn_dir, subjects, args.metrics,
+                                       filename=args.manifest,
+                                       refresh=args.refresh_manifest)
+
+    if args.backend == 'dask':
+        others = [path for sub in subjects for path in paths[sub]
+                  if not path.endswith('.npy')]
+        if others:
+            parser.error(f'--backend dask only reads .npy matrices: {others[:5]}.')
+
+    todo = subjects
+    existing = None
+    if args.incremental:
+        fprint = fingerprint(cluster_dict, args.metrics, args.float32)
+        signatures = [file_signature(paths[sub], use_hash=args.use_hash) for sub in subjects]
+        state = load_state(args.output)
+        try:
+            idx, changed = plan_update(state, subjects, signatures, fprint)
+        except ValueError as e:
+            parser.error(str(e))
+        todo = [subjects[i] for i in idx]
+        if state is not None:
+            existing = pd.read_excel(args.output, index_col=0)
+            existing.index = existing.index.astype(str)
+            existing = existing.drop(index=changed, errors='ignore')
+
+    # Clusters are read through index arrays, no mask is built.
+    indices = clusters_to_indices(cluster_dict)
+
+    client = connect(args.server) if args.server and todo else None
+
+    results = pd.DataFrame(index=todo)
+    with (local_cluster(n_workers=args.n_workers) if args.backend == 'dask' and todo
+          else contextlib.nullcontext()):
+        for m, metric in enumerate(args.metrics):
+            if client is not None:
+                values = client.cluster_means([paths[sub][m] for sub in todo], cluster_dict,
+                                              dtype='float32' if args.float32 else None)
+            elif args.backend == 'dask' and todo:
+                stack = load_stack([paths[sub][m] for sub in todo],
+                                   dtype=np.float32 if args.float32 else None)
+                values = compute(cluster_means(stack, indices))
+            else:
+                values = np.empty((len(todo), len(indices)))
+                for s, sub in enumerate(todo):
+                    mat = _load_matrix(paths[sub][m], np.float32 if args.float32 else None)
+                    for c, (rows, cols) in enumerate(indices.values()):
+                        values[s, c] = mat[rows, cols].mean(dtype=np.float64)
+
+            for c, cluster in enumerate(indices.keys()):
+                results[f'{metric}_{cluster}'] = values[:, c]
+    if client is not None:
+        client.close()
+
+    if existing is not None:
+        results = pd.concat([existing, results])
+
+    results.to_excel(args.output, header=True, index=True, index_label='IDs')
+
+    if args.incremental:
+        previous = state['subjects'] if state is not None else {}
+        previous.update({sub: sig for sub, sig in zip(subjects, signatures)})
+        save_state(args.output, fprint, previous)
+
+
+if __name__ == '__main__':
+    main()
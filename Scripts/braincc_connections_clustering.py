@@ -8,7 +8,9 @@ import logging
 
 import json
 import numpy as np
-from brainccpy.viz.utils import track_clustering
+from brainccpy.io.streamlines import summarize_cluster
+from brainccpy.io.utils import load_binary_mask
+from brainccpy.viz.utils import track_clustering, threshold_clustering
 from scilpy.io.utils import (add_overwrite_arg,
                              add_verbose_arg,
                              assert_inputs_exist,
@@ -22,6 +24,18 @@ def _build_arg_parser():
 
     p.add_argument('--input',
                    help='Input binary matrix containing significant connections to cluster.')
+    p.add_argument('--thresholds', nargs='+', type=float, required=False,
+                   help='If provided, --input is considered as a weighted matrix (p-values, \n'
+                        't-stats, etc.) and clusters are computed for every threshold in a \n'
+                        'single pass. Only the cluster hierarchy is saved \n'
+                        '(output/Clusters_thresholds.json).')
+    p.add_argument('--lower', action='store_true',
+                   help='If set with --thresholds, keep connections with values lower or \n'
+                        'equal to the threshold (ex: p-values). Otherwise, keep connections \n'
+                        'with values greater or equal to the threshold.')
+    p.add_argument('--sparse', action='store_true',
+                   help='If set, the binary matrix is held as a sparse matrix instead \n'
+                        'of a dense array.')
     p.add_argument('--run_decompose', action='store_true', default=True,
                    help="If True, script will run scil_save_connections_from_hdf5.py to \n"
                         "save raw connections.")
@@ -34,8 +48,25 @@ def _build_arg_parser():
     p.add_argument('--output',
                    help='Main output folder. Output structure will be : \n'
                         '                    output/Raw_Connections/ (if --run_decompose)\n'
-                        '                          /Clusters/ \n'
-                        '                          /Clusters.json \n')
+                        '                          /Clusters/ (unless --no_merge)\n'
+                        '                          /Clusters.json \n'
+                        '                          /Summaries/ (if --summary)\n'
+                        '                          /Clusters_summary.json (if --summary)\n')
+
+    summ = p.add_argument_group(title='Summary options',
+                                description='Streamlines of each cluster are read one connection \n'
+                                            'at a time to compute the number of streamlines, a \n'
+                                            'length histogram and a density map (number of \n'
+                                            'streamlines per voxel, Summaries/{cluster}_density.npy).')
+    summ.add_argument('--summary', action='store_true',
+                      help='If set, compute the summary of every cluster.')
+    summ.add_argument('--no_merge', action='store_true',
+                      help='If set, merged clusters (Clusters/{cluster}.trk) are not written.')
+    summ.add_argument('--nb_bins', type=int, default=50,
+                      help='Number of bins of the length histogram. [%(default)s]')
+    summ.add_argument('--max_length', type=float, default=250,
+                      help='Upper edge of the length histogram (mm). Longer streamlines \n'
+                           'are not counted in the histogram. [%(default)s]')
 
     add_verbose_arg(p)
     add_overwrite_arg(p)
@@ -53,8 +84,17 @@ def main():
     assert_inputs_exist(parser, args.input, args.hdf5)
     assert_output_dirs_exist_and_empty(parser, args, args.output)
 
+    # Create nested clusters for every thresholds.
+    if args.thresholds:
+        mat = np.load(args.input)
+        clusters, parents = threshold_clustering(mat, args.thresholds,
+                                                 direction='lower' if args.lower else 'greater')
+        with open(f'{args.output}/Clusters_thresholds.json', 'w') as fp:
+            json.dump({'clusters': clusters, 'parents': parents}, fp)
+        return
+
     # Create clusters.
-    mat = np.load(args.input)
+    mat = load_binary_mask(args.input, as_sparse=args.sparse)
     cluster_dict = track_clustering(mat)
     with open(f'{args.output}/Cluster.json', 'w') as fp:
         json.dump(cluster_dict, fp)
@@ -76,6 +116,26 @@ def main():
     else:
         out_dir_raw = args.in_connections
 
+    # Summarize clusters without building merged files.
+    if args.summary:
+        out_dir_sum = os.path.join(args.output, 'Summaries')
+        os.mkdir(out_dir_sum)
+        bins = np.linspace(0, args.max_length, args.nb_bins + 1)
+
+        summaries = {}
+        for cluster in cluster_dict.keys():
+            files = [f'{out_dir_raw}/{f}.trk' for f in cluster_dict[f'{cluster}']]
+            summaries[cluster], density = summarize_cluster(files, bins)
+            if density is not None:
+                np.save(f'{out_dir_sum}/{cluster}_density.npy', density)
+            logging.info(f'{cluster}: {summaries[cluster]["count"]} streamlines.')
+
+        with open(f'{args.output}/Clusters_summary.json', 'w') as fp:
+            json.dump(summaries, fp)
+
+    if args.no_merge:
+        return
+
     # Merge individuals connections into one cluster files.
     out_dir = os.path.join(args.output, 'Clusters')
     os.mkdir(out_dir)
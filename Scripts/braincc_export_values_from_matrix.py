@@ -11,8 +11,22 @@ or should respect this structure : ${input}/${subject1}.npy
 
 import numpy as np
 import argparse
-import pandas as pd
-from tqdm import tqdm
+import logging
+from brainccpy.io.backend import compute, edge_values, load_stack, local_cluster
+from brainccpy.io.export import (EdgeTableWriter,
+                                  all_edges,
+                                  edges_from_mask,
+                                  export_edges,
+                                  nonzero_edges)
+from brainccpy.io.incremental import (drop_rows_csv,
+                                      file_signature,
+                                      fingerprint,
+                                      load_state,
+                                      plan_update,
+                                      save_state)
+from brainccpy.io.manifest import select_connectoflow_inputs
+from brainccpy.io.server import connect, default_socket
+from brainccpy.io.utils import load_binary_mask
 
 
 def _build_arg_parser():
@@ -25,15 +39,60 @@ def _build_arg_parser():
                         'folder is a connectoflow output structure.')
 
     p.add_argument('--output', required=False, default='./',
-                   help='Output filename (.csv).')
+                   help='Output filename (.csv or .parquet).')
+    p.add_argument('--verbose', action='store_true', required=False,
+                   help='If applied, verbose mode is activated.')
+    p.add_argument('--backend', choices=['numpy', 'dask'], default='numpy',
+                   help='With dask, matrices (.npy only) are read lazily and the \n'
+                        'connections of each chunk of subjects are extracted on a local \n'
+                        'dask cluster. Requires dask[distributed]. [%(default)s]')
+    p.add_argument('--n_workers', type=int, required=False,
+                   help='Number of dask workers. Defaults to the number of cores.')
+    p.add_argument('--server', nargs='?', const=default_socket(),
+                   help='Query the cohort server (braincc_cohort_server.py) listening \n'
+                        'on this socket, falling back to standalone mode if it is not \n'
+                        'running. [%(const)s]')
+
+    out = p.add_argument_group(title='Output options',
+                               description='Subjects are processed and written in chunks, \n'
+                                           'so memory is capped at a single chunk.')
+    out.add_argument('--chunk_size', type=int, default=100,
+                     help='Number of subjects to process at once. [%(default)s]')
+    out.add_argument('--format', choices=['csv', 'parquet'], default='csv',
+                     help='Output format. Parquet requires pyarrow. [%(default)s]')
+    out.add_argument('--float32', action='store_true',
+                     help='If set, values are extracted and written as float32.')
+    out.add_argument('--long', action='store_true',
+                     help='If set, write a long table (IDs, Edge, Value) containing \n'
+                          'only non-zero connections.')
 
     roi = p.add_argument_group(title='Specifying connections to extract.',
                                description='Two options available : all connections or \n'
-                                           'the one specified by a binary mask.')
+                                           'the one specified by a binary mask. Either can be \n'
+                                           'restricted to connections that are non-zero in the \n'
+                                           'cohort with --nonzero.')
     roi.add_argument('--in_mask', required=False,
                      help='Path to the binary matrix (.npy) selecting connections of interest to extract metrics.')
     roi.add_argument('--all', required=False, default=False, action='store_true',
                      help='If true, will extract all measures from all connections.')
+    roi.add_argument('--nonzero', action='store_true',
+                     help='If set, a first pass over the cohort selects connections that \n'
+                          'are non-zero in at least --min_prop of the subjects.')
+    roi.add_argument('--min_prop', type=float, default=0.,
+                     help='Minimal proportion of subjects (0-1) in which a connection must \n'
+                          'be non-zero to be kept with --nonzero. If 0, connections non-zero \n'
+                          'in any subject are kept. [%(default)s]')
+
+    inc = p.add_argument_group(title='Incremental options',
+                               description='Only new or modified subjects are extracted and \n'
+                                           'appended to an existing csv output. A state file \n'
+                                           '(output.state.json) records the input files and \n'
+                                           'the connections definition.')
+    inc.add_argument('--incremental', action='store_true',
+                     help='If set, update an existing output instead of rewriting it.')
+    inc.add_argument('--use_hash', action='store_true',
+                     help='If set, compare inputs using their content hash instead of \n'
+                          'their modification time and size.')
 
     conn = p.add_argument_group(title='Connectoflow options',
                                 description='Options if matrices to extract are inside \n'
@@ -46,6 +105,13 @@ def _build_arg_parser():
                       help='Path of the subject ID list in a .txt file.')
     conn.add_argument('--in_metrics', required=False,
                       help='Abbreviation of the metric to extract (ex : ad, afd, md, etc.).')
+    conn.add_argument('--manifest', required=False,
+                      help='Manifest index of the connectoflow output, used to select \n'
+                           'inputs without checking every file. It is built on first \n'
+                           'use. [connectoflow_folder/.brainccpy_manifest.json]')
+    conn.add_argument('--refresh_manifest', action='store_true',
+                      help='If set, the manifest index is refreshed (file sizes and \n'
+                           'mtimes are compared). Use it after modifying matrices.')
 
     return p
 
@@ -54,65 +120,89 @@ def main():
     parser = _build_arg_parser()
     args = parser.parse_args()
 
-    if args.all:
-        if args.connectoflow:
-            subjects = open(args.in_ID_list).read().split()
-            mat = np.load(f'{args.connectoflow_folder}/{subjects[0]}/Compute_Connectivity/{args.in_metrics}.npy')
-            mask = np.ones([mat.shape[0], mat.shape[1]])
-        else:
-            mat = np.load(f'{args.input[0]}')
-            mask = np.ones([mat.shape[0], mat.shape[1]])
-    else:
-        mask = np.load(args.in_mask)
-
-    labels = pd.DataFrame(mask)
-    labels_col = labels.columns
-    labels_row = labels.index
-    labels_value = labels.values
-    labels_value = np.triu(labels_value)
-
-    columns = []
-    results = []
-
-    for i in range(labels_col.shape[0]):
-        for j in range(labels_row.shape[0]):
-            cond = labels_value[i, j]
-            if cond == 1:
-                columns.append(str(int(labels_col[i] + 1)) + '_' + str(int(labels_row[j] + 1)))
+    if args.verbose:
+        logging.getLogger().setLevel(logging.INFO)
 
     if args.connectoflow:
-        for subject in tqdm(subjects):
-            metrics = np.triu(np.load(f'{args.directory}/{subject}/Compute_Connectivity/{args.in_metrics}.npy'))
-            output = []
-            for i in range(labels_col.shape[0]):
-                for j in range(labels_row.shape[0]):
-                    cond = labels_value[i, j]
-                    if cond == 1:
-                        out = metrics[i, j]
-                        output.append(out)
-            res = [x for x in output]
-            results.append(res)
+        subjects = open(args.in_ID_list).read().split()
+        found = select_connectoflow_inputs(parser, args.connectoflow_folder, subjects,
+                                           [args.in_metrics], filename=args.manifest,
+                                           refresh=args.refresh_manifest)
+        paths = [found[sub][0] for sub in subjects]
     else:
-        for i in tqdm(args.input):
-            metrics = np.triu(np.load(f'{i}'))
-            output = []
-            for i in range(labels_col.shape[0]):
-                for j in range(labels_row.shape[0]):
-                    cond = labels_value[i, j]
-                    if cond == 1:
-                        out = metrics[i, j]
-                        output.append(out)
-            res = [x for x in output]
-            results.append(res)
-
-    final = pd.DataFrame(results, columns=columns)
+        subjects = args.input
+        paths = args.input
 
-    if args.connectoflow:
-        final.index = subjects
-        final.to_csv(f'{args.output}', header=True, index=subjects, index_label='IDs')
+    if args.nonzero and args.incremental:
+        parser.error('--nonzero cannot be used with --incremental, since the selected '
+                     'connections depend on the whole cohort.')
+
+    if args.all:
+        rows, cols, columns = all_edges(np.load(paths[0], mmap_mode='r').shape[0])
+    elif args.in_mask:
+        rows, cols, columns = edges_from_mask(load_binary_mask(args.in_mask, as_sparse=True))
+    else:
+        parser.error('Provide either --all or --in_mask.')
+
+    if args.nonzero:
+        rows, cols, columns = nonzero_edges(paths, rows, cols, min_prop=args.min_prop,
+                                            chunk_size=args.chunk_size)
+
+    todo = list(range(len(subjects)))
+    append = False
+    if args.incremental:
+        if args.format != 'csv':
+            parser.error('--incremental is only available for csv outputs.')
+        fprint = fingerprint(rows, cols, args.in_metrics, args.long, args.float32)
+        signatures = [file_signature(path, use_hash=args.use_hash) for path in paths]
+        state = load_state(args.output)
+        try:
+            todo, _ = plan_update(state, subjects, signatures, fprint)
+        except ValueError as e:
+            parser.error(str(e))
+        if state is not None and todo:
+            # Rows of new subjects can already be in the output if a previous
+            # run was interrupted before saving its state.
+            drop_rows_csv(args.output, [subjects[i] for i in todo])
+        append = state is not None
+
+    client = connect(args.server) if args.server else None
+    if client is not None:
+        # The server reads the connections from the resident cohort.
+        todo_paths = [paths[i] for i in todo]
+        todo_ids = [subjects[i] for i in todo]
+        with client, EdgeTableWriter(args.output, columns, fmt=args.format,
+                                     long=args.long, append=append) as writer:
+            for start in range(0, len(todo), args.chunk_size):
+                values = client.edges(todo_paths, rows, cols,
+                                      dtype='float32' if args.float32 else None,
+                                      start=start, stop=start + args.chunk_size)
+                writer.write(todo_ids[start:start + args.chunk_size], values)
+    elif args.backend == 'dask' and todo:
+        todo_ids = [subjects[i] for i in todo]
+        with local_cluster(n_workers=args.n_workers, joblib=False):
+            try:
+                stack = load_stack([paths[i] for i in todo],
+                                   dtype=np.float32 if args.float32 else None)
+            except ValueError as e:
+                parser.error(str(e))
+            with EdgeTableWriter(args.output, columns, fmt=args.format,
+                                 long=args.long, append=append) as writer:
+                # Each chunk of subjects is read and extracted in parallel.
+                for start in range(0, len(todo), args.chunk_size):
+                    values = compute(edge_values(stack[start:start + args.chunk_size],
+                                                 rows, cols))
+                    writer.write(todo_ids[start:start + args.chunk_size], values)
     else:
-        final.index = args.input
-        final.to_csv(f'{args.output}', header=True, index=args.input, index_label='IDs')
+        export_edges([paths[i] for i in todo], [subjects[i] for i in todo],
+                     rows, cols, columns, args.output,
+                     chunk_size=args.chunk_size, fmt=args.format, long=args.long,
+                     dtype=np.float32 if args.float32 else None, append=append)
+
+    if args.incremental:
+        previous = state['subjects'] if state is not None else {}
+        previous.update({str(sub): sig for sub, sig in zip(subjects, signatures)})
+        save_state(args.output, fprint, previous)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Script to fit a general linear model (group comparison, covariate-adjusted
+regression, etc.) on every connection of a cohort of connectivity matrices.
+All connections are solved at once (in chunks), t and p-values are corrected
+with the Benjamini-Hochberg FDR and the binary matrix of significant
+connections can be used as --input of braincc_connections_clustering.py.
+
+The design file (.csv or .xlsx) contains one row per subject and one column
+per covariate. Categorical columns are dummy coded (first level dropped) and
+an intercept is added. If it contains an 'IDs' column, rows are matched to
+subjects by ID, otherwise they should be in the same order as the matrices.
+
+Output structure will be : output/tstats.npy
+                                 /pvalues.npy
+                                 /qvalues.npy
+                                 /effect.npy
+                                 /mask.npy
+                                 /design.csv
+"""
+
+import argparse
+import logging
+
+import numpy as np
+import pandas as pd
+from brainccpy.io.manifest import select_connectoflow_inputs
+from brainccpy.io.utils import (add_overwrite_arg,
+                                add_verbose_arg,
+                                validate_input,
+                                validate_output_dir)
+from brainccpy.stats.glm import design_matrix, edge_glm, significance_mask
+
+
+def _build_arg_parser():
+    p = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawTextHelpFormatter)
+
+    p.add_argument('--in_matrices', nargs='+',
+                   help='Connectivity matrices (.npy). Filenames (without \n'
+                        'extension) are used as IDs.')
+    p.add_argument('--in_design', required=True,
+                   help='Design file (.csv or .xlsx).')
+    p.add_argument('--contrast', required=True,
+                   help='Name of the design column to test (after dummy coding, \n'
+                        'ex: age or group_patient).')
+    p.add_argument('--output', required=True,
+                   help='Output folder.')
+    p.add_argument('--alpha', type=float, default=0.05,
+                   help='Significance level. [%(default)s]')
+    p.add_argument('--correction', choices=['fdr', 'none'], default='fdr',
+                   help='Multiple comparisons correction. [%(default)s]')
+    p.add_argument('--tail', choices=['greater', 'lower', 'both'], default='both',
+                   help='Direction of the test. [%(default)s]')
+    p.add_argument('--chunk_size', type=int, default=50000,
+                   help='Number of connections solved at once. [%(default)s]')
+
+    conn = p.add_argument_group(title='Connectoflow options',
+                                description='Options if matrices are inside \n'
+                                            'a connectoflow output structure.')
+    conn.add_argument('--connectoflow_folder',
+                      help='Connectoflow output folder.')
+    conn.add_argument('--in_ID_list',
+                      help='Path of the subject ID list in a .txt file.')
+    conn.add_argument('--in_metrics',
+                      help='Abbreviation of the metric to use (ex : sc, afd, etc.).')
+    conn.add_argument('--manifest',
+                      help='Manifest index of the connectoflow output, used to select \n'
+                           'inputs without checking every file. It is built on first \n'
+                           'use. [connectoflow_folder/.brainccpy_manifest.json]')
+    conn.add_argument('--refresh_manifest', action='store_true',
+                      help='If set, the manifest index is refreshed (file sizes and \n'
+                           'mtimes are compared). Use it after modifying matrices.')
+
+    add_verbose_arg(p)
+    add_overwrite_arg(p)
+
+    return p
+
+
+def main():
+    parser = _build_arg_parser()
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.getLogger().setLevel(logging.INFO)
+
+    validate_input(parser, args.in_design)
+    validate_output_dir(parser, args, args.output)
+
+    if args.connectoflow_folder:
+        if not (args.in_ID_list and args.in_metrics):
+            parser.error('--in_ID_list and --in_metrics are required with '
+                         '--connectoflow_folder.')
+        validate_input(parser, args.in_ID_list)
+        ids = open(args.in_ID_list).read().split()
+        found = select_connectoflow_inputs(parser, args.connectoflow_folder, ids,
+                                           [args.in_metrics], filename=args.manifest,
+                                           refresh=args.refresh_manifest)
+        paths = [found[sub][0] for sub in ids]
+    elif args.in_matrices:
+        paths = args.in_matrices
+        ids = [p.split('/')[-1].rsplit('.', 1)[0] for p in paths]
+        validate_input(parser, paths)
+    else:
+        parser.error('Provide either --in_matrices or --connectoflow_folder.')
+
+    if args.in_design.endswith('.csv'):
+        df = pd.read_csv(args.in_design)
+    else:
+        df = pd.read_excel(args.in_design)
+    if 'IDs' in df.columns:
+        df = df.set_index(df['IDs'].astype(str)).drop(columns='IDs')
+        missing = [sub for sub in ids if sub not in df.index]
+        if missing:
+            parser.error(f'Subjects missing from the design: {missing[:10]}.')
+        df = df.loc[ids]
+    elif len(df) != len(paths):
+        parser.error('The design should contain one row per matrix.')
+
+    design = design_matrix(df)
+    if args.contrast not in design.columns:
+        parser.error(f'--contrast should be one of {list(design.columns)}.')
+    contrast = (design.columns == args.contrast).astype(float)
+
+    tmat, pmat, effect, dof = edge_glm(paths, design, contrast, tail=args.tail,
+                                       chunk_size=args.chunk_size)
+    qmat, mask = significance_mask(pmat, alpha=args.alpha, correction=args.correction)
+    logging.info(f'{int(mask.sum())} significant connections ({dof} degrees of freedom).')
+
+    np.save(f'{args.output}/tstats.npy', tmat)
+    np.save(f'{args.output}/pvalues.npy', pmat)
+    np.save(f'{args.output}/qvalues.npy', qmat)
+    np.save(f'{args.output}/effect.npy', effect)
+    np.save(f'{args.output}/mask.npy', mask)
+    design.index = ids
+    design.to_csv(f'{args.output}/design.csv', index_label='IDs')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Script to compute graph-theory metrics (density, degree, strength, weighted
+clustering coefficient, global efficiency and modularity) for a cohort of
+connectivity matrices. Matrices are symmetrized, absolute-valued and
+normalized by their maximal weight before computing the metrics.
+
+Subjects are processed in chunks spread across processes. The output table
+contains one row per subject (first column 'IDs') and can be used directly as
+input of kmeans_clustering.py.
+
+Input should be either a list of matrices (--in_matrices) or a connectoflow
+output (--connectoflow_folder, --in_ID_list and --in_metrics).
+"""
+
+import argparse
+import logging
+
+import numpy as np
+from brainccpy.graph.metrics import cohort_graph_metrics
+from brainccpy.io.manifest import select_connectoflow_inputs
+from brainccpy.io.utils import (add_overwrite_arg,
+                                add_verbose_arg,
+                                validate_input,
+                                validate_output)
+
+
+def _build_arg_parser():
+    p = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawTextHelpFormatter)
+
+    p.add_argument('--in_matrices', nargs='+',
+                   help='Connectivity matrices (.npy). Filenames (without \n'
+                        'extension) are used as IDs.')
+    p.add_argument('--output', required=True,
+                   help='Output filename (.xlsx or .csv).')
+    p.add_argument('--nodal', action='store_true',
+                   help='If set, node-wise degree, strength and clustering \n'
+                        'coefficient are also written.')
+    p.add_argument('--communities',
+                   help='.txt file containing a community label for each node \n'
+                        '(ex: atlas networks). If not provided, communities are \n'
+                        'found for each subject with the leading eigenvector method.')
+    p.add_argument('--chunk_size', type=int, default=32,
+                   help='Number of subjects processed at once. [%(default)s]')
+    p.add_argument('--n_jobs', type=int, default=1,
+                   help='Number of processes. [%(default)s]')
+
+    conn = p.add_argument_group(title='Connectoflow options',
+                                description='Options if matrices are inside \n'
+                                            'a connectoflow output structure.')
+    conn.add_argument('--connectoflow_folder',
+                      help='Connectoflow output folder.')
+    conn.add_argument('--in_ID_list',
+                      help='Path of the subject ID list in a .txt file.')
+    conn.add_argument('--in_metrics',
+                      help='Abbreviation of the metric to use (ex : sc, commit2_weights, etc.).')
+    conn.add_argument('--manifest',
+                      help='Manifest index of the connectoflow output, used to select \n'
+                           'inputs without checking every file. It is built on first \n'
+                           'use. [connectoflow_folder/.brainccpy_manifest.json]')
+    conn.add_argument('--refresh_manifest', action='store_true',
+                      help='If set, the manifest index is refreshed (file sizes and \n'
+                           'mtimes are compared). Use it after modifying matrices.')
+
+    add_verbose_arg(p)
+    add_overwrite_arg(p)
+
+    return p
+
+
+def main():
+    parser = _build_arg_parser()
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.getLogger().setLevel(logging.INFO)
+
+    if args.connectoflow_folder:
+        if not (args.in_ID_list and args.in_metrics):
+            parser.error('--in_ID_list and --in_metrics are required with '
+                         '--connectoflow_folder.')
+        validate_input(parser, args.in_ID_list)
+        ids = open(args.in_ID_list).read().split()
+        found = select_connectoflow_inputs(parser, args.connectoflow_folder, ids,
+                                           [args.in_metrics], filename=args.manifest,
+                                           refresh=args.refresh_manifest)
+        paths = [found[sub][0] for sub in ids]
+    elif args.in_matrices:
+        paths = args.in_matrices
+        ids = [p.split('/')[-1].rsplit('.', 1)[0] for p in paths]
+        validate_input(parser, paths)
+    else:
+        parser.error('Provide either --in_matrices or --connectoflow_folder.')
+
+    if args.communities:
+        validate_input(parser, args.communities)
+    validate_output(parser, args, args.output)
+
+    communities = None
+    if args.communities:
+        communities = np.loadtxt(args.communities, dtype=int)
+        communities = np.unique(communities, return_inverse=True)[1]
+
+    df = cohort_graph_metrics(paths, ids, chunk_size=args.chunk_size,
+                              n_jobs=args.n_jobs, nodal=args.nodal,
+                              communities=communities)
+
+    if args.output.endswith('.csv'):
+        df.to_csv(args.output, index=False)
+    else:
+        df.to_excel(args.output, index=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Script to remove site effects from a cohort of connectivity matrices with
+ComBat harmonization. Location/scale site effects of every connection are
+estimated at once (in chunks of connections, matrices are memory-mapped) and
+shrunk with empirical Bayes. The fitted model is saved so that new subjects
+from the same sites can be harmonized later with --in_model, without refitting.
+Every site needs at least two subjects to fit the model.
+
+The covariates file (.csv or .xlsx) contains an 'IDs' column, a site column
+(--site_column) and, optionally, biological covariates to preserve (ex: age,
+sex). Categorical covariates are dummy coded (first level dropped).
+
+Output structure will be : output/{ID}.npy
+                                 /combat_model.npz
+"""
+
+import argparse
+import logging
+
+import numpy as np
+import pandas as pd
+from brainccpy.io.manifest import select_connectoflow_inputs
+from brainccpy.io.utils import (add_overwrite_arg,
+                                add_verbose_arg,
+                                validate_input,
+                                validate_output_dir)
+from brainccpy.stats.glm import covariate_levels, design_matrix
+from brainccpy.stats.harmonization import (combat_apply,
+                                           combat_fit,
+                                           load_combat,
+                                           save_combat)
+
+
+def _build_arg_parser():
+    p = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawTextHelpFormatter)
+
+    p.add_argument('--in_matrices', nargs='+',
+                   help='Connectivity matrices (.npy). Filenames (without \n'
+                        'extension) are used as IDs.')
+    p.add_argument('--in_covariates', required=True,
+                   help='Covariates file (.csv or .xlsx) with an IDs column.')
+    p.add_argument('--output', required=True,
+                   help='Output folder.')
+    p.add_argument('--site_column', default='site',
+                   help='Name of the site column. [%(default)s]')
+    p.add_argument('--in_model', required=False,
+                   help='ComBat model (.npz) fitted by a previous run. If provided, \n'
+                        'matrices are harmonized without refitting.')
+    p.add_argument('--no_eb', action='store_true',
+                   help='If set, site effects are not shrunk with empirical Bayes.')
+    p.add_argument('--chunk_size', type=int, default=50000,
+                   help='Number of connections estimated at once. [%(default)s]')
+
+    conn = p.add_argument_group(title='Connectoflow options',
+                                description='Options if matrices are inside \n'
+                                            'a connectoflow output structure.')
+    conn.add_argument('--connectoflow_folder',
+                      help='Connectoflow output folder.')
+    conn.add_argument('--in_ID_list',
+                      help='Path of the subject ID list in a .txt file.')
+    conn.add_argument('--in_metrics',
+                      help='Abbreviation of the metric to use (ex : sc, afd, etc.).')
+    conn.add_argument('--manifest',
+                      help='Manifest index of the connectoflow output, used to select \n'
+                           'inputs without checking every file. It is built on first \n'
+                           'use. [connectoflow_folder/.brainccpy_manifest.json]')
+    conn.add_argument('--refresh_manifest', action='store_true',
+                      help='If set, the manifest index is refreshed (file sizes and \n'
+                           'mtimes are compared). Use it after modifying matrices.')
+
+    add_verbose_arg(p)
+    add_overwrite_arg(p)
+
+    return p
+
+
+def main():
+    parser = _build_arg_parser()
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.getLogger().setLevel(logging.INFO)
+
+    validate_input(parser, args.in_covariates)
+    if args.in_model:
+        validate_input(parser, args.in_model)
+    validate_output_dir(parser, args, args.output)
+
+    if args.connectoflow_folder:
+        if not (args.in_ID_list and args.in_metrics):
+            parser.error('--in_ID_list and --in_metrics are required with '
+                         '--connectoflow_folder.')
+        validate_input(parser, args.in_ID_list)
+        ids = open(args.in_ID_list).read().split()
+        found = select_connectoflow_inputs(parser, args.connectoflow_folder, ids,
+                                           [args.in_metrics], filename=args.manifest,
+                                           refresh=args.refresh_manifest)
+        paths = [found[sub][0] for sub in ids]
+    elif args.in_matrices:
+        paths = args.in_matrices
+        ids = [p.split('/')[-1].rsplit('.', 1)[0] for p in paths]
+        validate_input(parser, paths)
+    else:
+        parser.error('Provide either --in_matrices or --connectoflow_folder.')
+
+    if args.in_covariates.endswith('.csv'):
+        df = pd.read_csv(args.in_covariates)
+    else:
+        df = pd.read_excel(args.in_covariates)
+    for col in ['IDs', args.site_column]:
+        if col not in df.columns:
+            parser.error(f'--in_covariates should contain a {col} column.')
+    df = df.set_index(df['IDs'].astype(str)).drop(columns='IDs')
+    missing = [sub for sub in ids if sub not in df.index]
+    if missing:
+        parser.error(f'Subjects missing from the covariates: {missing[:10]}.')
+    df = df.loc[ids]
+    sites = df.pop(args.site_column).astype(str).to_numpy()
+
+    if args.in_model:
+        params = load_combat(args.in_model)
+        unknown = sorted(set(sites) - set(params['sites']))
+        if unknown:
+            parser.error(f'Sites {unknown} were not seen when fitting the model.')
+        levels = params['levels']
+        if levels is None:
+            if covariate_levels(df):
+                parser.error('The model was saved without the levels of its categorical '
+                             'covariates, fit it again to harmonize new subjects.')
+            levels = {}
+        # Categorical covariates are coded with the levels seen at fit time,
+        # a subset of subjects can miss some of them.
+        try:
+            covariates = design_matrix(df, intercept=False, levels=levels)
+        except ValueError as e:
+            parser.error(str(e))
+        missing = [col for col in params['covariates'] if col not in covariates.columns]
+        if missing:
+            parser.error(f'Covariates {missing} of the model are missing.')
+        covariates = covariates[params['covariates']]
+    else:
+        levels = covariate_levels(df)
+        covariates = design_matrix(df, intercept=False, levels=levels)
+        names, counts = np.unique(sites, return_counts=True)
+        if np.any(counts < 2):
+            parser.error(f'Sites {names[counts < 2].tolist()} have a single subject, at '
+                         f'least two subjects per site are needed to fit ComBat.')
+        params = combat_fit(paths, sites,
+                            covariates.to_numpy() if covariates.shape[1] else None,
+                            covariate_names=covariates.columns, eb=not args.no_eb,
+                            chunk_size=args.chunk_size, covariate_levels=levels)
+        save_combat(params, f'{args.output}/combat_model.npz')
+
+    for sub, path, site, cov in zip(ids, paths, sites, covariates.to_numpy()):
+        mat = combat_apply(np.load(path), site, params, cov)
+        np.save(f'{args.output}/{sub}.npy', mat)
+        logging.info(f'Harmonized {sub} ({site}).')
+
+
+if __name__ == '__main__':
+    main()
@@ -13,6 +13,7 @@ from brainccpy.io.utils import (validate_input,
                                 validate_output_dir,
                                 add_verbose_arg,
                                 add_overwrite_arg)
+from brainccpy.io.server import connect, default_socket
 
 
 def _build_arg_parser():
@@ -21,6 +22,11 @@ def _build_arg_parser():
     p.add_argument('--input',
                    help='Path to the output folder.')
 
+    p.add_argument('--server', nargs='?', const=default_socket(),
+                   help='Query the cohort server (braincc_cohort_server.py) listening \n'
+                        'on this socket, falling back to standalone mode if it is not \n'
+                        'running. [%(const)s]')
+
     add_verbose_arg(p)
     add_overwrite_arg(p)
 
@@ -34,7 +40,12 @@ def main():
     if args.verbose:
         logging.basicConfig(level=logging.DEBUG)
 
-    density = compute_matrices_density(args.input)
+    client = connect(args.server) if args.server else None
+    if client is not None:
+        with client:
+            density = client.density([args.input])[0]
+    else:
+        density = compute_matrices_density(args.input)
     print(density)
 
 
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Script to perform network-based statistic (NBS) inference between two groups
+of connectivity matrices. Components of suprathreshold connections are
+extracted and family-wise error corrected p-values are computed by permuting
+group labels.
+
+Output structure will be : output/tstats.npy
+                                 /Cluster.json
+                                 /pvalues.json
+                                 /null_distribution.npy
+"""
+
+import argparse
+import json
+import logging
+
+import numpy as np
+from brainccpy.io.utils import (add_overwrite_arg,
+                                add_verbose_arg,
+                                load_matrix_stack,
+                                validate_input,
+                                validate_output_dir)
+from brainccpy.stats.nbs import group_labels, nbs
+
+
+def _build_arg_parser():
+    p = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawTextHelpFormatter)
+
+    p.add_argument('--in_matrices', nargs='+', required=True,
+                   help='Connectivity matrices (.npy) of all subjects.')
+    p.add_argument('--in_groups', required=True,
+                   help='.txt file containing the group of each subject (two \n'
+                        'distinct values, ex: 0/1 or 1/2), in the same order as \n'
+                        '--in_matrices. T-statistics are positive when the group \n'
+                        'with the highest label has higher connectivity.')
+    p.add_argument('--threshold', type=float, required=True,
+                   help='Threshold applied on the t-statistics.')
+    p.add_argument('--output', required=True,
+                   help='Output folder.')
+    p.add_argument('--n_perm', type=int, default=5000,
+                   help='Number of permutations. [%(default)s]')
+    p.add_argument('--tail', choices=['greater', 'lower', 'both'], default='both',
+                   help='Direction of the test. [%(default)s]')
+    p.add_argument('--n_jobs', type=int, default=1,
+                   help='Number of processes used to run permutations. [%(default)s]')
+    p.add_argument('--random_seed', type=int, default=1234,
+                   help='Random seed. [%(default)s]')
+
+    add_verbose_arg(p)
+    add_overwrite_arg(p)
+
+    return p
+
+
+def main():
+    parser = _build_arg_parser()
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.getLogger().setLevel(logging.INFO)
+
+    validate_input(parser, args.in_matrices + [args.in_groups])
+    validate_output_dir(parser, args, args.output)
+
+    groups = np.loadtxt(args.in_groups, ndmin=1)
+    if len(groups) != len(args.in_matrices):
+        parser.error('--in_groups should contain one value per matrix.')
+    try:
+        groups = group_labels(groups)
+    except ValueError as e:
+        parser.error(f'--in_groups: {e}')
+
+    stack = load_matrix_stack(args.in_matrices)
+    tmat, cluster_dict, pvalues, null = nbs(stack, groups, args.threshold,
+                                            n_perm=args.n_perm,
+                                            tail=args.tail,
+                                            n_jobs=args.n_jobs,
+                                            random_state=args.random_seed)
+
+    np.save(f'{args.output}/tstats.npy', tmat)
+    np.save(f'{args.output}/null_distribution.npy', null)
+    with open(f'{args.output}/Cluster.json', 'w') as fp:
+        json.dump(cluster_dict, fp)
+    with open(f'{args.output}/pvalues.json', 'w') as fp:
+        json.dump(pvalues, fp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Script to relate connectivity to behaviour with a PLS correlation or a
+regularized canonical correlation analysis (CCA). Latent variables are tested
+with permutations and the reliability of brain saliences is assessed with
+bootstrap ratios, both computed in parallel.
+
+The brain table is the output of braincc_export_values_from_matrix.py (.csv
+or .parquet, wide format). The behaviour table (.csv or .xlsx) contains an
+'IDs' column followed by the behavioural measures. Only subjects present in
+both tables are used.
+
+Output structure will be : output/summary.csv
+                                 /behaviour_saliences.csv
+                                 /scores.csv
+                                 /brain_saliences_{lv}.npy
+                                 /bootstrap_ratios_{lv}.npy
+"""
+
+import argparse
+import logging
+
+import numpy as np
+import pandas as pd
+from brainccpy.io.export import matrix_from_edges
+from brainccpy.io.utils import (add_overwrite_arg,
+                                add_verbose_arg,
+                                validate_input,
+                                validate_output_dir)
+from brainccpy.stats.pls import pls_correlation
+
+
+def _build_arg_parser():
+    p = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawTextHelpFormatter)
+
+    p.add_argument('--in_edges', required=True,
+                   help='Brain table (.csv or .parquet) with an IDs column and one \n'
+                        'column per connection (X_Y).')
+    p.add_argument('--in_behaviour', required=True,
+                   help='Behaviour table (.csv or .xlsx) with an IDs column.')
+    p.add_argument('--output', required=True,
+                   help='Output folder.')
+    p.add_argument('--method', choices=['pls', 'cca'], default='pls',
+                   help='Method to use. [%(default)s]')
+    p.add_argument('--reg', type=float, default=0.1,
+                   help='Ridge regularization of the brain covariance (relative to \n'
+                        'its mean eigenvalue) if --method cca. [%(default)s]')
+    p.add_argument('--n_components', type=int, required=False,
+                   help='Number of latent variables. Defaults to the number of \n'
+                        'behavioural measures.')
+    p.add_argument('--n_nodes', type=int, required=False,
+                   help='Size of the outputted matrices. Defaults to the highest \n'
+                        'node index in the connection names.')
+    p.add_argument('--n_perm', type=int, default=1000,
+                   help='Number of permutations. [%(default)s]')
+    p.add_argument('--n_boot', type=int, default=1000,
+                   help='Number of bootstrap resamples. [%(default)s]')
+    p.add_argument('--n_jobs', type=int, default=1,
+                   help='Number of processes. [%(default)s]')
+    p.add_argument('--random_seed', type=int, default=1234,
+                   help='Random seed. [%(default)s]')
+
+    add_verbose_arg(p)
+    add_overwrite_arg(p)
+
+    return p
+
+
+def _read_table(filename):
+    if filename.endswith('.parquet'):
+        return pd.read_parquet(filename)
+    if filename.endswith('.csv'):
+        return pd.read_csv(filename)
+    return pd.read_excel(filename)
+
+
+def main():
+    parser = _build_arg_parser()
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.getLogger().setLevel(logging.INFO)
+
+    validate_input(parser, [args.in_edges, args.in_behaviour])
+    validate_output_dir(parser, args, args.output)
+
+    edges = _read_table(args.in_edges)
+    behaviour = _read_table(args.in_behaviour)
+    for df, name in [(edges, '--in_edges'), (behaviour, '--in_behaviour')]:
+        if 'IDs' not in df.columns:
+            parser.error(f'{name} should contain an IDs column.')
+        df['IDs'] = df['IDs'].astype(str)
+
+    ids = [sub for sub in edges['IDs'] if sub in set(behaviour['IDs'])]
+    if len(ids) < 3:
+        parser.error('Not enough subjects in common between the two tables.')
+    logging.info(f'{len(ids)} subjects in common.')
+
+    edges = edges.set_index('IDs').loc[ids]
+    behaviour = behaviour.set_index('IDs').loc[ids]
+
+    res = pls_correlation(edges.to_numpy(dtype=np.float32), behaviour.to_numpy(dtype=float),
+                          n_components=args.n_components, method=args.method,
+                          reg=args.reg, n_perm=args.n_perm, n_boot=args.n_boot,
+                          n_jobs=args.n_jobs, random_state=args.random_seed)
+
+    lvs = [f'LV{i + 1}' for i in range(len(res['singular_values']))]
+    pd.DataFrame({'singular_value': res['singular_values'],
+                  'explained': res['explained'],
+                  'pvalue': res['pvalues']},
+                 index=lvs).to_csv(f'{args.output}/summary.csv', index_label='LV')
+    pd.DataFrame(res['behaviour_saliences'], index=behaviour.columns,
+                 columns=lvs).to_csv(f'{args.output}/behaviour_saliences.csv',
+                                     index_label='Measure')
+
+    scores = pd.concat([pd.DataFrame(res['brain_scores'], index=ids,
+                                     columns=[f'brain_{lv}' for lv in lvs]),
+                        pd.DataFrame(res['behaviour_scores'], index=ids,
+                                     columns=[f'behaviour_{lv}' for lv in lvs])], axis=1)
+    scores.to_csv(f'{args.output}/scores.csv', index_label='IDs')
+
+    for i, lv in enumerate(lvs):
+        np.save(f'{args.output}/brain_saliences_{lv}.npy',
+                matrix_from_edges(res['brain_saliences'][:, i], edges.columns, args.n_nodes))
+        np.save(f'{args.output}/bootstrap_ratios_{lv}.npy',
+                matrix_from_edges(res['bootstrap_ratios'][:, i], edges.columns, args.n_nodes))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Script to predict behavioural scores from connectivity with cross-validated
+ridge regression. Since there are far fewer subjects than connections, ridge
+is solved from the subjects kernel: connections are read once (in chunks,
+matrices are memory-mapped) and every penalty of --alphas and every
+behavioural measure are solved at once from one eigendecomposition per fold.
+
+With --cv loo, leave-one-out predictions are obtained in closed form and the
+penalty minimizing the leave-one-out error is reported (optimistic). With
+--cv k, the penalty is selected in each fold by leave-one-out on the training
+subjects (nested). Cross-validated correlations are tested with permutations
+of the behavioural scores, computed in parallel.
+
+Brain data is either the output of braincc_export_values_from_matrix.py
+(--in_edges, .csv or .parquet, wide format) or connectivity matrices
+(--in_matrices or connectoflow options, upper triangle connections). The
+behaviour table (.csv or .xlsx) contains an 'IDs' column followed by the
+behavioural measures. Only subjects present in both and without missing
+behavioural values are used.
+
+Output structure will be : output/summary.csv
+                                 /predictions.csv
+                                 /alphas.csv
+                                 /weights_{measure}.npy (with --weights)
+"""
+
+import argparse
+import logging
+
+import numpy as np
+import pandas as pd
+from brainccpy.io.export import matrix_from_edges
+from brainccpy.io.manifest import select_connectoflow_inputs
+from brainccpy.io.utils import (add_overwrite_arg,
+                                add_verbose_arg,
+                                validate_input,
+                                validate_output_dir)
+from brainccpy.stats.prediction import ridge_cv
+
+
+def _build_arg_parser():
+    p = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawTextHelpFormatter)
+
+    p.add_argument('--in_edges',
+                   help='Brain table (.csv or .parquet) with an IDs column and one \n'
+                        'column per connection (X_Y).')
+    p.add_argument('--in_matrices', nargs='+',
+                   help='Connectivity matrices (.npy). Filenames (without \n'
+                        'extension) are used as IDs.')
+    p.add_argument('--in_behaviour', required=True,
+                   help='Behaviour table (.csv or .xlsx) with an IDs column.')
+    p.add_argument('--output', required=True,
+                   help='Output folder.')
+    p.add_argument('--alphas', nargs='+', type=float,
+                   default=list(np.logspace(-3, 3, 13)),
+                   help='Ridge penalties, relative to the mean eigenvalue of the \n'
+                        'training kernel. [1e-3 to 1e3, 13 values]')
+    p.add_argument('--cv', default='10',
+                   help="Number of folds, or 'loo' for leave-one-out. [%(default)s]")
+    p.add_argument('--no_standardize', action='store_true',
+                   help='If set, connections are not z-scored across subjects.')
+    p.add_argument('--weights', action='store_true',
+                   help='If set, connection weights of the model fitted on all \n'
+                        'subjects are saved as matrices.')
+    p.add_argument('--n_nodes', type=int, required=False,
+                   help='Size of the outputted matrices with --in_edges. Defaults \n'
+                        'to the highest node index in the connection names.')
+    p.add_argument('--n_perm', type=int, default=1000,
+                   help='Number of permutations. [%(default)s]')
+    p.add_argument('--chunk_size', type=int, default=10000,
+                   help='Number of connections read at once. [%(default)s]')
+    p.add_argument('--n_jobs', type=int, default=1,
+                   help='Number of processes. [%(default)s]')
+    p.add_argument('--random_seed', type=int, default=1234,
+                   help='Random seed. [%(default)s]')
+
+    conn = p.add_argument_group(title='Connectoflow options',
+                                description='Options if matrices are inside \n'
+                                            'a connectoflow output structure.')
+    conn.add_argument('--connectoflow_folder',
+                      help='Connectoflow output folder.')
+    conn.add_argument('--in_ID_list',
+                      help='Path of the subject ID list in a .txt file.')
+    conn.add_argument('--in_metrics',
+                      help='Abbreviation of the metric to use (ex : sc, afd, etc.).')
+    conn.add_argument('--manifest',
+                      help='Manifest index of the connectoflow output, used to select \n'
+                           'inputs without checking every file. It is built on first \n'
+                           'use. [connectoflow_folder/.brainccpy_manifest.json]')
+    conn.add_argument('--refresh_manifest', action='store_true',
+                      help='If set, the manifest index is refreshed (file sizes and \n'
+                           'mtimes are compared). Use it after modifying matrices.')
+
+    add_verbose_arg(p)
+    add_overwrite_arg(p)
+
+    return p
+
+
+def _read_table(filename):
+    if filename.endswith('.parquet'):
+        return pd.read_parquet(filename)
+    if filename.endswith('.csv'):
+        return pd.read_csv(filename)
+    return pd.read_excel(filename)
+
+
+def main():
+    parser = _build_arg_parser()
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.getLogger().setLevel(logging.INFO)
+
+    if args.cv != 'loo' and not (args.cv.isdigit() and int(args.cv) >= 2):
+        parser.error("--cv should be 'loo' or a number of folds >= 2.")
+    validate_input(parser, args.in_behaviour)
+    validate_output_dir(parser, args, args.output)
+
+    edges = None
+    if args.in_edges:
+        validate_input(parser, args.in_edges)
+        edges = _read_table(args.in_edges)
+        if 'IDs' not in edges.columns:
+            parser.error('--in_edges should contain an IDs column.')
+        edges = edges.set_index(edges['IDs'].astype(str)).drop(columns='IDs')
+        # Subjects with missing edges are dropped, as for the behaviour.
+        finite = np.isfinite(edges.to_numpy(dtype=np.float32)).all(axis=1)
+        if not finite.all():
+            logging.warning(f'{np.sum(~finite)} subjects with missing or infinite '
+                            f'edges are dropped.')
+            edges = edges[finite]
+        ids = list(edges.index)
+    elif args.connectoflow_folder:
+        if not (args.in_ID_list and args.in_metrics):
+            parser.error('--in_ID_list and --in_metrics are required with '
+                         '--connectoflow_folder.')
+        validate_input(parser, args.in_ID_list)
+        ids = open(args.in_ID_list).read().split()
+        found = select_connectoflow_inputs(parser, args.connectoflow_folder, ids,
+                                           [args.in_metrics], filename=args.manifest,
+                                           refresh=args.refresh_manifest)
+        paths = dict((sub, found[sub][0]) for sub in ids)
+    elif args.in_matrices:
+        validate_input(parser, args.in_matrices)
+        ids = [p.split('/')[-1].rsplit('.', 1)[0] for p in args.in_matrices]
+        paths = dict(zip(ids, args.in_matrices))
+    else:
+        parser.error('Provide either --in_edges, --in_matrices or --connectoflow_folder.')
+
+    behaviour = _read_table(args.in_behaviour)
+    if 'IDs' not in behaviour.columns:
+        parser.error('--in_behaviour should contain an IDs column.')
+    behaviour = behaviour.set_index(behaviour['IDs'].astype(str)).drop(columns='IDs')
+    behaviour = behaviour.dropna()
+
+    ids = [sub for sub in ids if sub in set(behaviour.index)]
+    n_folds = len(ids) if args.cv == 'loo' else int(args.cv)
+    if len(ids) < max(3, n_folds):
+        parser.error('Not enough subjects in common between brain data and behaviour.')
+    logging.info(f'{len(ids)} subjects in common.')
+    behaviour = behaviour.loc[ids]
+
+    if edges is not None:
+        x = edges.loc[ids].to_numpy(dtype=np.float32)
+    else:
+        x = [paths[sub] for sub in ids]
+
+    try:
+        res = ridge_cv(x, behaviour.to_numpy(dtype=float), alphas=args.alphas,
+                       cv='loo' if args.cv == 'loo' else int(args.cv), n_perm=args.n_perm,
+                       standardize=not args.no_standardize, weights=args.weights,
+                       n_jobs=args.n_jobs, random_state=args.random_seed,
+                       chunk_size=args.chunk_size)
+    except ValueError as e:
+        # Matrices are only read in ridge_cv, missing values are found there.
+        parser.error(str(e))
+
+    summary = pd.DataFrame({'r': res['r'], 'r2': res['r2'], 'mae': res['mae']},
+                           index=behaviour.columns)
+    if args.n_perm:
+        summary['pvalue'] = res['pvalues']
+    summary.to_csv(f'{args.output}/summary.csv', index_label='Measure')
+    pd.DataFrame(res['predictions'], index=ids,
+                 columns=behaviour.columns).to_csv(f'{args.output}/predictions.csv',
+                                                   index_label='IDs')
+    folds = ['all'] if args.cv == 'loo' else [f'fold_{i + 1}' for i in range(n_folds)]
+    pd.DataFrame(res['alphas'], index=folds,
+                 columns=behaviour.columns).to_csv(f'{args.output}/alphas.csv',
+                                                   index_label='Fold')
+
+    if args.weights:
+        if edges is None:
+            n_nodes = np.load(x[0], mmap_mode='r').shape[0]
+            rows, cols = np.triu_indices(n_nodes, k=1)
+        for i, measure in enumerate(behaviour.columns):
+            if edges is not None:
+                mat = matrix_from_edges(res['weights'][:, i], edges.columns, args.n_nodes)
+            else:
+                mat = np.zeros((n_nodes, n_nodes))
+                mat[rows, cols] = res['weights'][:, i]
+            np.save(f'{args.output}/weights_{measure}.npy', mat)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,7 +2,9 @@
 # -*- coding: utf-8 -*-
 
 """
-Script to compute K-Means clustering on a datasets.
+Script to compute K-Means clustering on a datasets. Ward agglomerative
+clustering (on a k-nearest neighbors graph), Gaussian mixtures and HDBSCAN
+can be used instead with --method.
 """
 
 
@@ -10,7 +12,17 @@ import argparse
 import pandas as pd
 from brainccpy.Clustering.utils import remove_nans, visualize_clustering
 from brainccpy.Clustering.kmeans import (elbow_method,
-                                         cluster_pipeline)
+                                         adaptive_elbow_method,
+                                         bootstrap_stability)
+from brainccpy.Clustering.kselection import (k_selection_scores,
+                                             gap_statistic)
+from brainccpy.Clustering.consensus import (consensus_clustering,
+                                            consensus_pipeline)
+from brainccpy.Clustering.engines import (ward_sweep,
+                                          gmm_sweep,
+                                          hdbscan_clustering)
+from brainccpy.Clustering.persistence import save_pipeline
+from brainccpy.Clustering.reduction import centroids_in_feature_space
 import matplotlib.pyplot as plt
 
 
@@ -29,11 +41,52 @@ def _build_arg_parser():
                    help='Maximum iterations.')
     p.add_argument('--output_dir',
                    help='Output folder.')
-    p.add_argument('--random_seed', required=False, default=1234,
+    p.add_argument('--random_seed', type=int, required=False, default=1234,
                    help='Random initialization seed.')
+    p.add_argument('--save_model', action='store_true',
+                   help='If set, save the fitted transformation and centroids in \n'
+                        'output_dir/model.npz (see kmeans_predict.py). With \n'
+                        '--consensus, centroids are the means of the consensus \n'
+                        'clusters.')
+    p.add_argument('--n_jobs', type=int, default=1,
+                   help='Number of processes used for parallel steps. [%(default)s]')
     p.add_argument('--verbose', action='store_true', required=False,
                    help='If applied, verbose mode is activated.')
 
+    meth = p.add_argument_group(title='Clustering method')
+    meth.add_argument('--method', default='kmeans',
+                      choices=['kmeans', 'ward', 'gmm', 'hdbscan'],
+                      help='Clustering method. Ward builds a single tree cut for every k, \n'
+                           'gmm selects the number of components with the BIC (used as \n'
+                           'the elbow) and hdbscan finds the number of clusters itself \n'
+                           '(noise subjects are labelled -1, requires the hdbscan \n'
+                           'package with the pinned scikit-learn). [%(default)s]')
+    meth.add_argument('--n_neighbors', type=int, default=10,
+                      help='Number of neighbors of the Ward connectivity graph. [%(default)s]')
+    meth.add_argument('--covariance_type', default='diag',
+                      choices=['full', 'tied', 'diag', 'spherical'],
+                      help='Covariance type of the Gaussian mixtures. [%(default)s]')
+    meth.add_argument('--min_cluster_size', type=int, default=5,
+                      help='Minimal number of subjects in a HDBSCAN cluster. [%(default)s]')
+    meth.add_argument('--min_samples', type=int, required=False,
+                      help='Number of neighbors defining HDBSCAN core points. \n'
+                           'Defaults to --min_cluster_size.')
+
+    ksel = p.add_argument_group(title='Number of clusters selection')
+    ksel.add_argument('--cluster_limit', type=int, default=50,
+                      help='Highest number of clusters evaluated (exclusive). [%(default)s]')
+    ksel.add_argument('--adaptive', action='store_true',
+                      help='If set, fit a coarse grid of k then refine around the knee \n'
+                           'instead of fitting every k.')
+    ksel.add_argument('--coarse_step', type=int, default=5,
+                      help='Step of the coarse k grid if --adaptive is set. [%(default)s]')
+    ksel.add_argument('--k_criterion', default='elbow',
+                      choices=['elbow', 'calinski_harabasz', 'davies_bouldin', 'gap'],
+                      help='Criterion used to select the number of clusters. All \n'
+                           'scores are saved in k_selection.csv. [%(default)s]')
+    ksel.add_argument('--n_refs', type=int, default=10,
+                      help='Number of reference datasets for the gap statistic. [%(default)s]')
+
     tsfm = p.add_mutually_exclusive_group()
     tsfm.add_argument('--quantile', action='store_true',
                       help='Apply quantile transformation to data before clustering.')
@@ -46,6 +99,11 @@ def _build_arg_parser():
     p.add_argument('--nb_quant', type=int, default=100,
                    help='Number of quantile to fit the data into (If quantile'
                         'transformation is selected.)')
+    p.add_argument('--reduce_variance', type=float, required=False,
+                   help='If provided, transformed data is cast to float32 and reduced \n'
+                        'with randomized PCA to this proportion of explained variance \n'
+                        '(ex: 0.9) before clustering. Centroids are mapped back to the \n'
+                        'features space in centroids.csv.')
 
     viz = p.add_mutually_exclusive_group()
     viz.add_argument('--pca', action='store_true',
@@ -55,6 +113,30 @@ def _build_arg_parser():
 
     p.add_argument('--perplexity', required=False, default=30,
                    help='Perplexity value to use in TSNE algorithm (if selected).')
+    p.add_argument('--render', default='auto',
+                   choices=['auto', 'scatter', 'raster', 'density'],
+                   help='Rendering of the 1D and 2D figures: one vector marker per \n'
+                        'subject (scatter), markers embedded as an image (raster) or \n'
+                        'subjects aggregated in bins coloured by cluster (density). \n'
+                        'auto uses scatter up to 10000 subjects, raster above. \n'
+                        '[%(default)s]')
+    p.add_argument('--plot_format', default='pdf', choices=['pdf', 'png', 'svg'],
+                   help='Format of the figures. [%(default)s]')
+
+    boot = p.add_argument_group(title='Stability options')
+    boot.add_argument('--bootstrap', type=int, required=False,
+                      help='If provided, the final KMeans solution is refitted on this \n'
+                           'number of bootstrap resamples (in parallel with --n_jobs) and \n'
+                           'the adjusted Rand index and per-cluster Jaccard index are \n'
+                           'summarized in stability.csv.')
+
+    cons = p.add_argument_group(title='Consensus clustering options')
+    cons.add_argument('--consensus', type=int, required=False,
+                      help='If provided, final labels are obtained by consensus of this \n'
+                           'number of KMeans fits on subsamples of the data. A stability \n'
+                           'score is added for each subject.')
+    cons.add_argument('--subsample', type=float, default=0.8,
+                      help='Proportion of subjects used in each consensus fit. [%(default)s]')
 
     return p
 
@@ -75,58 +157,112 @@ def main():
     clust = df.iloc[:, 1:len(df.columns)]
     length = len(clust.columns)
 
-    if args.quantile:
-        sse, elbow_plot, elbow = elbow_method(df=clust,
-                                              cluster_limit=50,
-                                              init=f'{args.init_method}',
-                                              n_init=args.n_init,
-                                              max_iter=args.max_iter,
-                                              t_method='quant',
-                                              nb_qt=args.nb_quant,
-                                              output_dist=f'{args.out_dist}',
-                                              random_state=random_seed,
-                                              verbose=verbose)
+    if args.method != 'kmeans' and (args.adaptive or args.consensus or args.bootstrap):
+        parser.error('--adaptive, --consensus and --bootstrap are only available with '
+                     '--method kmeans.')
+
+    t_method = 'quant' if args.quantile else 'scaled'
+
+    front_kwargs = {
+        't_method': t_method,
+        'nb_qt': args.nb_quant,
+        'output_dist': f'{args.out_dist}',
+        'random_state': random_seed,
+        'reduce_variance': args.reduce_variance,
+    }
+    sweep_kwargs = dict(front_kwargs, cluster_limit=args.cluster_limit, return_pipes=True)
+    kmeans_kwargs = {
+        'init': f'{args.init_method}',
+        'n_init': args.n_init,
+        'max_iter': args.max_iter,
+        'verbose': verbose,
+    }
+
+    if args.method == 'hdbscan':
+        # The number of clusters is found by HDBSCAN, no sweep is needed.
+        pipe_final = hdbscan_clustering(clust, min_cluster_size=args.min_cluster_size,
+                                        min_samples=args.min_samples, **front_kwargs)
     else:
-        sse, elbow_plot, elbow = elbow_method(df=clust,
-                                              cluster_limit=50,
-                                              init=f'{args.init_method}',
-                                              n_init=args.n_init,
-                                              max_iter=args.max_iter,
-                                              t_method='scaled',
-                                              random_state=random_seed,
-                                              verbose=verbose)
-
-    plt.text(x=len(sse)/2, y=max(sse)/2, s=f'Optimal number \n of clusters : {elbow}')
-    plt.savefig(f'{args.output_dir}/elbow_graph.png')
-    plt.cla()
-    plt.clf()
-
-    if args.quantile:
-        pipe_final = cluster_pipeline(df=clust,
-                                      output_dist=f'{args.out_dist}',
-                                      n_clusters=elbow,
+        if args.method == 'ward':
+            sse, elbow_plot, elbow, pipes = ward_sweep(df=clust, n_neighbors=args.n_neighbors,
+                                                       **sweep_kwargs)
+        elif args.method == 'gmm':
+            sse, elbow_plot, elbow, pipes = gmm_sweep(df=clust,
+                                                      covariance_type=args.covariance_type,
+                                                      **sweep_kwargs)
+        elif args.adaptive:
+            sse, ks, elbow_plot, elbow, pipes = adaptive_elbow_method(df=clust,
+                                                                      coarse_step=args.coarse_step,
+                                                                      **sweep_kwargs,
+                                                                      **kmeans_kwargs)
+        else:
+            sse, elbow_plot, elbow, pipes = elbow_method(df=clust, **sweep_kwargs,
+                                                         **kmeans_kwargs)
+
+        plt.text(x=len(sse)/2, y=max(sse)/2, s=f'Optimal number \n of clusters : {elbow}')
+        plt.savefig(f'{args.output_dir}/elbow_graph.png')
+        plt.cla()
+        plt.clf()
+
+        # Other k-selection criteria are computed from the sweep's fits.
+        scores = k_selection_scores(clust, pipes)
+        if args.method == 'gmm':
+            scores.insert(len(scores.columns), 'bic', sse)
+        if args.k_criterion == 'gap':
+            gaps, best_gap = gap_statistic(clust, pipes, n_refs=args.n_refs,
+                                           random_state=random_seed,
+                                           n_jobs=args.n_jobs)
+            scores = scores.merge(gaps, on='k')
+
+        n_clusters = elbow
+        if args.k_criterion == 'calinski_harabasz':
+            n_clusters = int(scores.loc[scores['calinski_harabasz'].idxmax(), 'k'])
+        elif args.k_criterion == 'davies_bouldin':
+            n_clusters = int(scores.loc[scores['davies_bouldin'].idxmin(), 'k'])
+        elif args.k_criterion == 'gap':
+            n_clusters = best_gap
+        scores.to_csv(f'{args.output_dir}/k_selection.csv', index=False)
+
+        # The sweep already fitted the final model.
+        pipe_final = {p[-1].n_clusters: p for p in pipes}[n_clusters]
+
+    n_clusters = pipe_final[-1].n_clusters
+    data_final = pipe_final[0].transform(clust)
+
+    labels_final = pipe_final[-1].labels_
+
+    if args.bootstrap:
+        summary = bootstrap_stability(clust, pipe_final, n_boot=args.bootstrap,
                                       init_method=f'{args.init_method}',
                                       nb_init=args.n_init,
                                       max_iter=args.max_iter,
-                                      t_method='quant',
-                                      nb_qt=args.nb_quant,
                                       random_state=random_seed,
-                                      verbose=verbose)
-        data_final = pipe_final['Transform'].transform(clust)
+                                      n_jobs=args.n_jobs)
+        summary.to_csv(f'{args.output_dir}/stability.csv', index_label='Score')
+
+    if args.consensus:
+        labels_final, stability, _ = consensus_clustering(clust, n_clusters,
+                                                          n_resamples=args.consensus,
+                                                          subsample=args.subsample,
+                                                          init_method=f'{args.init_method}',
+                                                          max_iter=args.max_iter,
+                                                          t_method=t_method,
+                                                          nb_qt=args.nb_quant,
+                                                          output_dist=f'{args.out_dist}',
+                                                          random_state=random_seed,
+                                                          n_jobs=args.n_jobs,
+                                                          reduce_variance=args.reduce_variance)
+        # Saved centroids and model follow the consensus partition.
+        model, _ = consensus_pipeline(pipe_final, clust, labels_final)
     else:
-        pipe_final = cluster_pipeline(df=clust,
-                                      output_dist=f'{args.out_dist}',
-                                      n_clusters=elbow,
-                                      init_method=f'{args.init_method}',
-                                      nb_init=args.n_init,
-                                      max_iter=args.max_iter,
-                                      t_method='scaled',
-                                      nb_qt=args.nb_quant,
-                                      random_state=random_seed,
-                                      verbose=verbose)
-        data_final = pipe_final['Scaling'].transform(clust)
+        model = pipe_final
 
-    labels_final = pipe_final['kmeans'].labels_
+    if args.reduce_variance is not None:
+        centroids = pd.DataFrame(centroids_in_feature_space(model), columns=clust.columns)
+        centroids.to_csv(f'{args.output_dir}/centroids.csv', index_label='Cluster')
+
+    if args.save_model:
+        save_pipeline(model, f'{args.output_dir}/model.npz', columns=clust.columns)
 
     data_final = pd.DataFrame(data_final, columns=clust.columns)
 
@@ -135,11 +271,15 @@ def main():
     # Visualizing clustering results.
     if args.pca:
         visualize_clustering(data_final, f'{args.output_dir}/',
-                             method='PCA')
+                             method='PCA', render=args.render, fmt=args.plot_format)
     else:
         visualize_clustering(data_final, f'{args.output_dir}/',
                              method='TSNE',
-                             perplexity=args.perplexity)
+                             perplexity=args.perplexity,
+                             render=args.render, fmt=args.plot_format)
+
+    if args.consensus:
+        data_final.insert(len(data_final.columns), 'Stability', stability)
 
     data_final.to_excel(f'{args.output_dir}/clustering_data.xlsx', header=True, index=False)
 
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Script to assign new subjects to the clusters of a model saved by
+kmeans_clustering.py (--save_model), without reclustering.
+"""
+
+
+import argparse
+import logging
+
+import pandas as pd
+from brainccpy.Clustering.persistence import load_pipeline
+from brainccpy.io.utils import (add_overwrite_arg,
+                                add_verbose_arg,
+                                validate_input,
+                                validate_output)
+
+
+def _build_arg_parser():
+    p = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawTextHelpFormatter)
+
+    p.add_argument('in_model',
+                   help='Model saved by kmeans_clustering.py (.npz).')
+    p.add_argument('in_df',
+                   help='Input dataframe of new subjects (.xlsx or .csv). First column \n'
+                        'should contain subjects IDs.')
+    p.add_argument('out_df',
+                   help='Output filename (.xlsx or .csv).')
+    p.add_argument('--chunk_size', type=int, default=10000,
+                   help='Number of subjects assigned at once. [%(default)s]')
+
+    add_verbose_arg(p)
+    add_overwrite_arg(p)
+
+    return p
+
+
+def main():
+    parser = _build_arg_parser()
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.getLogger().setLevel(logging.INFO)
+
+    validate_input(parser, [args.in_model, args.in_df])
+    validate_output(parser, args, args.out_df)
+
+    model = load_pipeline(args.in_model)
+
+    if args.in_df.endswith('.csv'):
+        df = pd.read_csv(args.in_df)
+    else:
+        df = pd.read_excel(args.in_df)
+
+    out = df.iloc[:, [0]].copy()
+    out['Cluster'] = model.predict(df.iloc[:, 1:], chunk_size=args.chunk_size)
+
+    if args.out_df.endswith('.csv'):
+        out.to_csv(args.out_df, header=True, index=False)
+    else:
+        out.to_excel(args.out_df, header=True, index=False)
+
+
+if __name__ == '__main__':
+    main()
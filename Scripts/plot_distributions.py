@@ -4,15 +4,33 @@
 
 """
 Script to visualize variable's distributions.
+
+By default, the variables selected with --intervals are plotted together
+(distributions and pairwise correlations). With --overview, the histogram,
+quantiles and number of NaNs of every variable are computed in one pass over
+the table (by chunks of rows for .csv and .parquet files) and cached in a
+small .npz file. Every variable is then plotted on pages of ridge plots or
+small multiples, and re-running with a different style only reads the cache.
+
+Output structure with --overview : output/distributions.npz
+                                         /distributions_summary.csv
+                                         /distributions_{page}.{format}
 """
 
 
 import argparse
+import logging
+import os
 
 import matplotlib.pyplot as plt
 import pandas as pd
-from brainccpy.Clustering.utils import (plot_dist,
-                                        remove_nans)
+from brainccpy.Clustering.utils import (distribution_summary,
+                                        load_distribution_cache,
+                                        plot_dist,
+                                        plot_distribution_pages,
+                                        remove_nans,
+                                        save_distribution_cache)
+from brainccpy.io.export import iter_table_chunks
 
 
 def _build_arg_parser():
@@ -20,12 +38,35 @@ def _build_arg_parser():
         description=__doc__,
         formatter_class=argparse.RawTextHelpFormatter)
     p.add_argument('in_df',
-                   help='Input dataframe (.xlsx)')
+                   help='Input dataframe (.xlsx, or .csv/.parquet with --overview)')
     p.add_argument('--intervals', nargs='+', type=int,
                    help='Intervals of variables to plot together.'
                         'Ex: --intervals 1 4 will plot variables 1-4.')
     p.add_argument('--output', required=False,
-                   help='Output directory and filename.')
+                   help='Output directory and filename (output folder with \n'
+                        '--overview).')
+
+    ov = p.add_argument_group(title='Overview options')
+    ov.add_argument('--overview', action='store_true',
+                    help='Plot the distribution of every variable from a cached \n'
+                         'summary instead of --intervals.')
+    ov.add_argument('--cache', required=False,
+                    help='Summary cache (.npz). It is computed if it does not exist, \n'
+                         'otherwise the table is not read. [output/distributions.npz]')
+    ov.add_argument('--refresh', action='store_true',
+                    help='If set, the cache is recomputed from the table.')
+    ov.add_argument('--bins', type=int, default=50,
+                    help='Number of histogram bins per variable. [%(default)s]')
+    ov.add_argument('--chunk_size', type=int, default=10000,
+                    help='Number of rows read at once. [%(default)s]')
+    ov.add_argument('--style', choices=['ridge', 'grid'], default='ridge',
+                    help='Ridge plots or small multiples. [%(default)s]')
+    ov.add_argument('--per_page', type=int, default=30,
+                    help='Number of variables per page. [%(default)s]')
+    ov.add_argument('--format', choices=['png', 'pdf', 'svg'], default='png',
+                    help='Format of the pages. [%(default)s]')
+    p.add_argument('--verbose', action='store_true', required=False,
+                   help='If applied, verbose mode is activated.')
 
     return p
 
@@ -34,12 +75,46 @@ def main():
     parser = _build_arg_parser()
     args = parser.parse_args()
 
-    df = pd.read_excel(args.in_df)
-    df = remove_nans(df)
+    if args.verbose:
+        logging.getLogger().setLevel(logging.INFO)
+
+    if not args.overview:
+        if not args.intervals or len(args.intervals) < 2:
+            parser.error('--intervals requires two indices (or use --overview).')
+
+        df = pd.read_excel(args.in_df)
+        df = remove_nans(df)
+
+        # Plot distribution for all intervals.
+        g = plot_dist(df, args.intervals[0], args.intervals[1])
+        plt.savefig(f'{args.output}', format='png')
+        return
+
+    if not args.output:
+        parser.error('--output is required with --overview.')
+    os.makedirs(args.output, exist_ok=True)
+    cache = args.cache or f'{args.output}/distributions.npz'
+
+    if os.path.isfile(cache) and not args.refresh:
+        logging.info(f'Loading cached summary {cache}.')
+        summary = load_distribution_cache(cache)
+    else:
+        summary = distribution_summary(iter_table_chunks(args.in_df, args.chunk_size),
+                                       bins=args.bins)
+        save_distribution_cache(summary, cache)
+        table = pd.DataFrame({'n': summary['n'], 'n_nan': summary['n_nan'],
+                              'mean': summary['mean'], 'std': summary['std']},
+                             index=summary['columns'])
+        for prob, values in zip(summary['probs'], summary['quantiles']):
+            table[f'q{prob:g}'] = values
+        table.to_csv(f'{args.output}/distributions_summary.csv', index_label='Variable')
+        logging.info(f'Summarized {len(summary["columns"])} variables.')
 
-    # Plot distribution for all intervals.
-    g = plot_dist(df, args.intervals[0], args.intervals[1])
-    plt.savefig(f'{args.output}', format='png')
+    for page, fig in enumerate(plot_distribution_pages(summary, per_page=args.per_page,
+                                                       style=args.style)):
+        fig.savefig(f'{args.output}/distributions_{page + 1:03d}.{args.format}',
+                    format=args.format)
+        plt.close(fig)
 
 
 if __name__ == '__main__':
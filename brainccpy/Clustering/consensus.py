@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+import copy
+import logging
+
+import numpy as np
+from joblib import Parallel, delayed
+from sklearn.cluster import KMeans
+from brainccpy.Clustering.kmeans import build_front_end
+
+
+def _fit_resample(data, n_clusters, subsample, init_method, nb_init, max_iter, seed):
+    rng = np.random.default_rng(seed)
+    n = data.shape[0]
+    idx = np.sort(rng.choice(n, size=max(n_clusters, int(round(subsample * n))),
+                             replace=False))
+    km = KMeans(n_clusters=n_clusters, init=init_method, n_init=nb_init,
+                max_iter=max_iter, random_state=int(rng.integers(2 ** 31 - 1)))
+    km.fit(data[idx])
+
+    labels = np.full(n, -1, dtype=np.int32)
+    labels[idx] = km.labels_
+
+    return labels
+
+
+def coassociation_embedding(labels, n_clusters):
+    """
+    Function to encode resampled labels as one-hot indicators. The product of
+    this embedding with its transpose counts how many times two subjects were
+    clustered together, which avoids materialising the co-association matrix.
+    :param labels:      Labels of shape (n_resamples, n_subjects), -1 for
+                        subjects absent from a resample.
+    :param n_clusters:  Number of clusters.
+    :return:            Indicators of co-clustering (n_subjects,
+                        n_resamples * n_clusters) and of sampling
+                        (n_subjects, n_resamples), as float32.
+    """
+    n_resamples, n = labels.shape
+    sampled = (labels >= 0).T.astype(np.float32)
+    onehot = np.zeros((n, n_resamples * n_clusters), dtype=np.float32)
+    r, i = np.nonzero(labels >= 0)
+    onehot[i, r * n_clusters + labels[r, i]] = 1
+
+    return onehot, sampled
+
+
+def iter_coassociation_blocks(onehot, sampled, block_size=2048):
+    """
+    Generator computing the co-association matrix one block of rows at a time
+    (float32). Entries are the proportion of resamples in which two subjects
+    were clustered together among the resamples containing both.
+    :param onehot:      Co-clustering indicators (coassociation_embedding).
+    :param sampled:     Sampling indicators (coassociation_embedding).
+    :param block_size:  Number of rows per block.
+    :return:            Yields (start, block) with block of shape
+                        (block_size, n_subjects).
+    """
+    n = onehot.shape[0]
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        together = onehot[start:stop] @ onehot.T
+        both = sampled[start:stop] @ sampled.T
+        with np.errstate(divide='ignore', invalid='ignore'):
+            block = np.where(both > 0, together / both, 0).astype(np.float32)
+        yield start, block
+
+
+def consensus_clustering(df, n_clusters, n_resamples=100, subsample=0.8,
+                         init_method='k-means++', nb_init=1, max_iter=300,
+                         t_method='quant', nb_qt=100, output_dist='normal',
+                         random_state=1234, n_jobs=1, block_size=2048,
+                         return_matrix=False, reduce_variance=None):
+    """
+    Function to perform consensus (ensemble) k-means clustering. KMeans is fitted
+    on many subsamples of the transformed data with different seeds, the
+    co-association matrix is accumulated in blocks and final labels are
+    obtained by clustering the co-association embedding (equivalent to kernel
+    k-means on the co-association matrix).
+    :param df:                  Pandas dataframe.
+    :param n_clusters:          Number of clusters.
+    :param n_resamples:         Number of KMeans fits.
+    :param subsample:           Proportion of subjects drawn (without replacement)
+                                for each fit.
+    :param init_method:         Initiation state. ['random' or 'k-means++']
+    :param nb_init:             Number of initializations for each fit.
+    :param max_iter:            Number of max iterations to perform.
+    :param t_method:            Method for transforming data ('quant' or 'scaled')
+    :param nb_qt:               Number of quantile to use if 'quant' is selected.
+    :param output_dist:         Outputted distribution following 'quant' transform.
+    :param random_state:        Seed from which the seed of every fit is spawned.
+    :param n_jobs:              Number of processes used to run the fits.
+    :param block_size:          Number of rows of the co-association matrix
+                                computed at once.
+    :param return_matrix:       If True, also returns the full co-association
+                                matrix (float32, n_subjects x n_subjects).
+    :param reduce_variance:     If provided, data is reduced to this proportion
+                                of explained variance before clustering.
+    :return:                    Consensus labels, per-subject stability scores
+                                (mean co-association with the other members of
+                                its cluster) and the co-association matrix
+                                (None if return_matrix is False).
+    """
+
+    # Data is transformed once and shared by all fits.
+    front = build_front_end(t_method, nb_qt, output_dist, reduce_variance,
+                            random_state=random_state)
+    data = np.ascontiguousarray(front.fit_transform(df), dtype=np.float32)
+
+    seeds = np.random.SeedSequence(random_state).spawn(n_resamples)
+    labels = Parallel(n_jobs=n_jobs)(
+        delayed(_fit_resample)(data, n_clusters, subsample, init_method,
+                               nb_init, max_iter, seed)
+        for seed in seeds)
+    labels = np.array(labels)
+    logging.info(f'{n_resamples} KMeans fits completed. Computing consensus ...')
+
+    onehot, sampled = coassociation_embedding(labels, n_clusters)
+
+    # Rows are scaled so that the linear kernel approximates co-association.
+    weights = 1 / np.sqrt(np.maximum(sampled.sum(axis=1, keepdims=True), 1))
+    final = KMeans(n_clusters=n_clusters, n_init=10,
+                   random_state=random_state).fit(onehot * weights).labels_
+
+    n = data.shape[0]
+    sizes = np.bincount(final, minlength=n_clusters)
+    members = np.eye(n_clusters, dtype=np.float32)[final]
+    stability = np.zeros(n, dtype=np.float32)
+    matrix = np.empty((n, n), dtype=np.float32) if return_matrix else None
+    for start, block in iter_coassociation_blocks(onehot, sampled, block_size):
+        stop = start + block.shape[0]
+        # Sum of co-association with own cluster, excluding the diagonal.
+        sums = block @ members
+        own = sums[np.arange(block.shape[0]), final[start:stop]]
+        own -= block[np.arange(block.shape[0]), np.arange(start, stop)]
+        denom = np.maximum(sizes[final[start:stop]] - 1, 1)
+        stability[start:stop] = own / denom
+        if return_matrix:
+            matrix[start:stop] = block
+
+    return final, stability, matrix
+
+
+def consensus_pipeline(pipe, df, labels):
+    """
+    Function to build a copy of a fitted KMeans pipeline whose centroids are
+    the means of the consensus clusters in the transformed space, so that
+    saved models (save_pipeline) assign new subjects to the consensus
+    partition (nearest consensus centroid) with the same cluster IDs.
+    :param pipe:    Fitted Pipeline (cluster_pipeline output).
+    :param df:      Pandas dataframe used for clustering.
+    :param labels:  Consensus labels (consensus_clustering output).
+    :return:        Pipeline copy and proportion of subjects whose nearest
+                    consensus centroid is their own consensus cluster.
+    """
+    pipe = copy.deepcopy(pipe)
+    km = pipe.steps[-1][1]
+    data = np.asarray(pipe[:-1].transform(df))
+    labels = np.asarray(labels)
+
+    centers = km.cluster_centers_.copy()
+    for k in range(km.n_clusters):
+        if np.any(labels == k):
+            centers[k] = data[labels == k].mean(axis=0)
+    km.cluster_centers_ = centers
+    km.labels_ = labels
+
+    dist = (centers ** 2).sum(axis=1) - 2 * data @ centers.T
+    agreement = float(np.mean(np.argmin(dist, axis=1) == labels))
+    logging.info(f'{agreement * 100:.1f}% of subjects are nearest to their consensus '
+                 f'centroid.')
+
+    return pipe, agreement
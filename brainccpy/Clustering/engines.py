@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+
+import logging
+
+import matplotlib.pyplot as plt
+import numpy as np
+from kneed import KneeLocator
+from scipy import sparse
+from sklearn.base import BaseEstimator, ClusterMixin
+from sklearn.cluster import ward_tree
+from sklearn.mixture import GaussianMixture
+from sklearn.neighbors import kneighbors_graph
+from sklearn.pipeline import Pipeline
+from brainccpy.Clustering.kmeans import build_front_end
+
+
+class Partition(ClusterMixin, BaseEstimator):
+    """
+    Partition obtained by a clustering engine other than KMeans, exposing the
+    same fitted attributes as KMeans (labels_, cluster_centers_, inertia_,
+    n_clusters) so it can be used with the k-selection, persistence and
+    prediction functions. Subjects labelled -1 (noise) are ignored when
+    computing centroids and inertia.
+    :param labels:      Cluster label of each subject.
+    :param centers:     Optional centroids (k x p). If None, centroids are the
+                        mean of each cluster.
+    :param n_clusters:  Number of clusters (can be higher than max(labels) + 1
+                        when some clusters are empty).
+    """
+
+    def __init__(self, labels=None, centers=None, n_clusters=None):
+        self.labels = labels
+        self.centers = centers
+        self.n_clusters = n_clusters
+
+    def fit(self, X, y=None):
+        X = np.asarray(X, dtype=float)
+        labels = np.asarray(self.labels, dtype=int)
+        k = self.n_clusters if self.n_clusters is not None else labels.max() + 1
+        valid = labels >= 0
+
+        if self.centers is None:
+            onehot = sparse.csr_matrix((np.ones(valid.sum()),
+                                        (labels[valid], np.flatnonzero(valid))),
+                                       shape=(k, len(labels)))
+            counts = np.asarray(onehot.sum(axis=1)).ravel()
+            centers = (onehot @ X) / np.maximum(counts, 1)[:, None]
+        else:
+            centers = np.asarray(self.centers, dtype=float)
+
+        self.labels_ = labels
+        self.cluster_centers_ = centers
+        self.inertia_ = float(((X[valid] - centers[labels[valid]]) ** 2).sum())
+
+        return self
+
+    def predict(self, X):
+        X = np.asarray(X, dtype=float)
+        sq = (self.cluster_centers_ ** 2).sum(axis=1)
+        return np.argmin(sq - 2 * X @ self.cluster_centers_.T, axis=1)
+
+
+def cut_tree(children, n_samples, n_clusters):
+    """
+    Function to cut a hierarchical tree at several numbers of clusters. Labels
+    for each cut are obtained by pointer jumping over the merges, so each cut
+    costs O(n log n) instead of a new fit.
+    :param children:    Merges of the tree (n_samples - 1 x 2), as returned by
+                        sklearn's ward_tree (node n_samples + i is created by
+                        merge i).
+    :param n_samples:   Number of leaves.
+    :param n_clusters:  Iterable of numbers of clusters.
+    :return:            Dictionary {k: labels}.
+    """
+    n_nodes = 2 * n_samples - 1
+    nodes = np.arange(n_nodes)
+    parent = nodes.copy()
+    created = n_samples + np.arange(len(children))
+    parent[children[:, 0]] = created
+    parent[children[:, 1]] = created
+
+    cuts = {}
+    for k in n_clusters:
+        # Merges done when k clusters are left.
+        done = n_samples - k
+        par = np.where(parent < n_samples + done, parent, nodes)
+        while True:
+            nxt = par[par]
+            if np.array_equal(nxt, par):
+                break
+            par = nxt
+        cuts[k] = np.unique(par[:n_samples], return_inverse=True)[1]
+
+    return cuts
+
+
+def ward_sweep(df, cluster_limit, n_neighbors=10, t_method='quant', nb_qt=100,
+               output_dist='normal', random_state=1234, return_pipes=False,
+               reduce_variance=None):
+    """
+    Function to perform the elbow method with Ward agglomerative clustering
+    constrained by a k-nearest neighbors graph. A single tree is built and cut
+    for every k.
+    :param df:                  Pandas dataframe.
+    :param cluster_limit:       Higher number of cluster to evaluate (exclusive).
+    :param n_neighbors:         Number of neighbors of the connectivity graph.
+    :param t_method:            Method for transforming data ('quant' or 'scaled')
+    :param nb_qt:               Number of quantile to use if 'quant' is selected.
+    :param output_dist:         Outputted distribution following 'quant' transform.
+    :param random_state:
+    :param return_pipes:        If True, also returns the pipelines (one per k).
+    :param reduce_variance:     If provided, data is reduced to this proportion
+                                of explained variance (see build_front_end).
+    :return:                    SSE, plot, elbow[, pipes].
+    """
+
+    front = build_front_end(t_method, nb_qt, output_dist, reduce_variance,
+                            random_state=random_state)
+    data = front.fit_transform(df)
+
+    connectivity = kneighbors_graph(data, n_neighbors=min(n_neighbors, len(data) - 1),
+                                    include_self=False)
+    children = ward_tree(data, connectivity=connectivity)[0]
+    ks = list(range(1, cluster_limit))
+    cuts = cut_tree(children, len(data), ks)
+
+    fitted = [Partition(cuts[k], n_clusters=k).fit(data) for k in ks]
+    sse = [p.inertia_ for p in fitted]
+    logging.info(f'Ward tree cut for k = 1 to {cluster_limit - 1}.')
+
+    # Plotting the results.
+    plot = plt.plot(ks, sse)
+    plt.xticks(ks)
+    plt.xlabel('Number of clusters')
+    plt.ylabel('SSE')
+
+    elbow = KneeLocator(ks, sse, curve='convex', direction='decreasing').elbow
+
+    if return_pipes:
+        pipes = [Pipeline(front.steps + [('ward', p)]) for p in fitted]
+        return sse, plot, elbow, pipes
+
+    return sse, plot, elbow
+
+
+def gmm_sweep(df, cluster_limit, covariance_type='diag', n_init=1, max_iter=100,
+              t_method='quant', nb_qt=100, output_dist='normal', random_state=1234,
+              return_pipes=False, reduce_variance=None):
+    """
+    Function to fit Gaussian mixtures for every k and select the number of
+    components with the Bayesian information criterion (BIC).
+    :param df:                  Pandas dataframe.
+    :param cluster_limit:       Higher number of components to evaluate (exclusive).
+    :param covariance_type:     'full', 'tied', 'diag' or 'spherical'.
+    :param n_init:              Number of initializations per k.
+    :param max_iter:            Number of max EM iterations.
+    :param t_method:            Method for transforming data ('quant' or 'scaled')
+    :param nb_qt:               Number of quantile to use if 'quant' is selected.
+    :param output_dist:         Outputted distribution following 'quant' transform.
+    :param random_state:
+    :param return_pipes:        If True, also returns the pipelines (one per k).
+                                Their last step is a Partition whose centroids
+                                are the components' means.
+    :param reduce_variance:     If provided, data is reduced to this proportion
+                                of explained variance (see build_front_end).
+    :return:                    BIC, plot, k with the lowest BIC[, pipes].
+    """
+
+    front = build_front_end(t_method, nb_qt, output_dist, reduce_variance,
+                            random_state=random_state)
+    data = front.fit_transform(df)
+
+    ks = list(range(1, cluster_limit))
+    bic = []
+    pipes = []
+    for k in ks:
+        gmm = GaussianMixture(n_components=k, covariance_type=covariance_type,
+                              n_init=n_init, max_iter=max_iter,
+                              random_state=random_state).fit(data)
+        bic.append(gmm.bic(data))
+        if return_pipes:
+            part = Partition(gmm.predict(data), centers=gmm.means_, n_clusters=k).fit(data)
+            pipes.append(Pipeline(front.steps + [('gmm', part)]))
+
+    best = ks[int(np.argmin(bic))]
+
+    # Plotting the results.
+    plot = plt.plot(ks, bic)
+    plt.xticks(ks)
+    plt.xlabel('Number of clusters')
+    plt.ylabel('BIC')
+
+    if return_pipes:
+        return bic, plot, best, pipes
+
+    return bic, plot, best
+
+
+def _hdbscan(**kwargs):
+    try:
+        from sklearn.cluster import HDBSCAN
+    except ImportError:
+        try:
+            from hdbscan import HDBSCAN
+        except ImportError:
+            raise ImportError('HDBSCAN requires scikit-learn >= 1.3 or the hdbscan package '
+                              '(pip install hdbscan).')
+    return HDBSCAN(**kwargs)
+
+
+def hdbscan_clustering(df, min_cluster_size=5, min_samples=None, t_method='quant',
+                       nb_qt=100, output_dist='normal', random_state=1234,
+                       reduce_variance=None):
+    """
+    Function to perform density-based clustering with HDBSCAN. The number of
+    clusters is found by the algorithm and subjects not belonging to any
+    cluster are labelled -1.
+    :param df:                  Pandas dataframe.
+    :param min_cluster_size:    Minimal number of subjects in a cluster.
+    :param min_samples:         Number of neighbors defining core points. If
+                                None, min_cluster_size is used.
+    :param t_method:            Method for transforming data ('quant' or 'scaled')
+    :param nb_qt:               Number of quantile to use if 'quant' is selected.
+    :param output_dist:         Outputted distribution following 'quant' transform.
+    :param random_state:        Seed of the dimensionality reduction.
+    :param reduce_variance:     If provided, data is reduced to this proportion
+                                of explained variance (see build_front_end).
+    :return:                    Fitted Pipeline (last step is a Partition).
+    """
+
+    front = build_front_end(t_method, nb_qt, output_dist, reduce_variance,
+                            random_state=random_state)
+    data = front.fit_transform(df)
+
+    labels = _hdbscan(min_cluster_size=min_cluster_size,
+                      min_samples=min_samples).fit_predict(data)
+    part = Partition(labels, n_clusters=max(labels.max() + 1, 1)).fit(data)
+    logging.info(f'HDBSCAN found {part.n_clusters} clusters '
+                 f'({np.sum(labels < 0)} noise subjects).')
+
+    return Pipeline(front.steps + [('hdbscan', part)])
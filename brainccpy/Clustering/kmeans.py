@@ -1,16 +1,23 @@
 # -*- coding: utf-8 -*-
 
+import logging
+
 import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
 from kneed import KneeLocator
 from sklearn.cluster import KMeans
-from sklearn.metrics import silhouette_score
+from sklearn.metrics import adjusted_rand_score, silhouette_score
 from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import StandardScaler
 from brainccpy.Clustering.utils import QuantileTransformer
+from brainccpy.Clustering.reduction import DimensionReduction
 
 
 def elbow_method(df, cluster_limit, init='k-means++', n_init=20, max_iter=1000, t_method='quant',
-                 nb_qt=100, output_dist='normal', random_state=1234, verbose=0):
+                 nb_qt=100, output_dist='normal', random_state=1234, verbose=0,
+                 return_pipes=False, reduce_variance=None):
     """
     Function perform the elbow method for the optimal number of cluster to use.
     :param df:                  Pandas dataframe.
@@ -25,24 +32,35 @@ def elbow_method(df, cluster_limit, init='k-means++', n_init=20, max_iter=1000,
     :param output_dist:         Outputted distribution following 'quant' transform.
     :param random_state:
     :param verbose:
+    :param return_pipes:        If True, also returns the fitted pipelines so that
+                                other k-selection criteria can be computed from
+                                the sweep (see brainccpy.Clustering.kselection).
+    :param reduce_variance:     If provided, data is cast to float32 and reduced to
+                                this proportion of explained variance before
+                                clustering (see build_front_end).
     :return:
     """
 
     kmeans_kwargs = {
-        'init_method': f'{init}',
-        'nb_init': n_init,
+        'init': f'{init}',
+        'n_init': n_init,
         'max_iter': max_iter,
-        't_method': f'{t_method}',
-        'nb_qt': nb_qt,
-        'output_dist': f'{output_dist}',
         'random_state': random_state,
         'verbose': verbose,
     }
 
+    # Transformation (and reduction) is fitted once for the whole sweep.
+    front = build_front_end(t_method, nb_qt, output_dist, reduce_variance,
+                            random_state=random_state)
+    data = front.fit_transform(df)
+
     sse = []
+    pipes = []
     for k in range(1, cluster_limit):
-        pipe = cluster_pipeline(df, k, **kmeans_kwargs)
-        sse.append(pipe['kmeans'].inertia_)
+        km = KMeans(n_clusters=k, **kmeans_kwargs).fit(data)
+        sse.append(km.inertia_)
+        if return_pipes:
+            pipes.append(Pipeline(front.steps + [('kmeans', km)]))
 
     # Plotting the results.
     plot = plt.plot(list(range(1, cluster_limit)), sse)
@@ -56,9 +74,116 @@ def elbow_method(df, cluster_limit, init='k-means++', n_init=20, max_iter=1000,
     )
     elbow = kl.elbow
 
+    if return_pipes:
+        return sse, plot, elbow, pipes
+
     return sse, plot, elbow
 
 
+def _split_init(data, km):
+    """
+    Initial centroids for k+1 clusters: centroids of a fitted k model plus the
+    point farthest from its centroid in the cluster with the highest SSE.
+    """
+    dist = ((data - km.cluster_centers_[km.labels_]) ** 2).sum(axis=1)
+    worst = np.argmax(np.bincount(km.labels_, weights=dist,
+                                  minlength=km.n_clusters))
+    members = np.flatnonzero(km.labels_ == worst)
+    far = members[np.argmax(dist[members])]
+
+    return np.vstack([km.cluster_centers_, data[far]])
+
+
+def adaptive_elbow_method(df, cluster_limit, coarse_step=5, window=3, init='k-means++',
+                          n_init=20, max_iter=1000, t_method='quant', nb_qt=100,
+                          output_dist='normal', random_state=1234, verbose=0,
+                          return_pipes=False, reduce_variance=None):
+    """
+    Function to perform an adaptive elbow method. A coarse grid of k is fitted
+    first, then k values around the detected knee are fitted until the knee
+    is stable over a window of fits. Refined fits are warm started from the
+    k-1 centroids plus one split, and the transformation is fitted only once.
+    :param df:                  Pandas dataframe.
+    :param cluster_limit:       Higher number of cluster to evaluate (exclusive).
+    :param coarse_step:         Step of the coarse k grid. Refinement covers
+                                knee +/- (coarse_step - 1).
+    :param window:              Number of consecutive refined fits with the same
+                                knee needed to stop.
+    :param init:                Initiation state for cold fits. ['random' or 'k-means++']
+    :param n_init:              Number of initializations for cold fits.
+    :param max_iter:            Number of max iterations to perform.
+    :param t_method:            Method for transforming data ('quant' or 'scaled')
+    :param nb_qt:               Number of quantile to use if 'quant' is selected.
+    :param output_dist:         Outputted distribution following 'quant' transform.
+    :param random_state:
+    :param verbose:
+    :param return_pipes:        If True, also returns the fitted pipelines.
+    :param reduce_variance:     If provided, data is cast to float32 and reduced to
+                                this proportion of explained variance before
+                                clustering (see build_front_end).
+    :return:                    SSE and fitted k values (ascending), plot, elbow.
+    """
+
+    front = build_front_end(t_method, nb_qt, output_dist, reduce_variance,
+                            random_state=random_state)
+    data = front.fit_transform(df)
+
+    fitted = {}
+
+    def fit(k):
+        if k - 1 in fitted:
+            km = KMeans(n_clusters=k, init=_split_init(data, fitted[k - 1]), n_init=1,
+                        max_iter=max_iter, random_state=random_state, verbose=verbose)
+        else:
+            km = KMeans(n_clusters=k, init=f'{init}', n_init=n_init, max_iter=max_iter,
+                        random_state=random_state, verbose=verbose)
+        fitted[k] = km.fit(data)
+
+    def knee():
+        ks = sorted(fitted)
+        e = KneeLocator(ks, [fitted[k].inertia_ for k in ks],
+                        curve='convex', direction='decreasing').elbow
+        return None if e is None else int(e)
+
+    for k in sorted(set(range(1, cluster_limit, coarse_step)) | {2, cluster_limit - 1}):
+        if 1 <= k < cluster_limit:
+            fit(k)
+
+    elbow = knee()
+    stable = 0
+    k = 1 if elbow is None else max(1, elbow - coarse_step + 1)
+    while k < cluster_limit and (elbow is None or k <= elbow + coarse_step - 1):
+        if k not in fitted:
+            fit(k)
+            new = knee()
+            if new == elbow:
+                stable += 1
+                if stable >= window:
+                    break
+            elif new is not None:
+                stable = 0
+                elbow = new
+                k = max(1, new - coarse_step + 1)
+                continue
+        k += 1
+
+    ks = sorted(fitted)
+    sse = [fitted[k].inertia_ for k in ks]
+    logging.info(f'Adaptive sweep fitted {len(ks)} models: k = {ks}.')
+
+    # Plotting the results.
+    plot = plt.plot(ks, sse, marker='o')
+    plt.xticks(ks)
+    plt.xlabel('Number of clusters')
+    plt.ylabel('SSE')
+
+    if return_pipes:
+        pipes = [Pipeline(front.steps + [('kmeans', fitted[k])]) for k in ks]
+        return sse, ks, plot, elbow, pipes
+
+    return sse, ks, plot, elbow
+
+
 def silhouette_coef(df, cluster_limit, init='k-means++', n_init=20, max_iter=1000, t_method='quant',
                  nb_qt=100, output_dist='normal', random_state=1234):
     """
@@ -100,9 +225,51 @@ def silhouette_coef(df, cluster_limit, init='k-means++', n_init=20, max_iter=100
     return silhouette_plot, silhouette_coefficients
 
 
+def build_transformer(t_method='quant', nb_qt=100, output_dist='normal'):
+    """
+    Function to build the transformation step applied before clustering.
+    :param t_method:            Method for transforming data ('quant' or 'scaled')
+    :param nb_qt:               Number of quantile to use if 'quant' is selected.
+    :param output_dist:         Outputted distribution following 'quant' transform.
+    :return:                    Tuple (step name, transformer) to use in a Pipeline.
+    """
+
+    if t_method == 'quant':
+        return ('Transform', QuantileTransformer(n_quantiles=nb_qt,
+                                                 output_distribution=f'{output_dist}'))
+
+    return ('Scaling', StandardScaler())
+
+
+def build_front_end(t_method='quant', nb_qt=100, output_dist='normal', reduce_variance=None,
+                    max_components=256, reduce_method='pca', random_state=1234):
+    """
+    Function to build the steps applied before clustering: transformation and,
+    optionally, float32 cast and dimensionality reduction.
+    :param t_method:            Method for transforming data ('quant' or 'scaled')
+    :param nb_qt:               Number of quantile to use if 'quant' is selected.
+    :param output_dist:         Outputted distribution following 'quant' transform.
+    :param reduce_variance:     Proportion of explained variance to keep. If None,
+                                no reduction is applied.
+    :param max_components:      Maximum number of components of the reduction.
+    :param reduce_method:       'pca' or 'svd' (see DimensionReduction).
+    :param random_state:
+    :return:                    Unfitted Pipeline.
+    """
+
+    steps = [build_transformer(t_method, nb_qt, output_dist)]
+    if reduce_variance is not None:
+        steps.append(('Reduction', DimensionReduction(variance=reduce_variance,
+                                                      max_components=max_components,
+                                                      method=reduce_method,
+                                                      random_state=random_state)))
+
+    return Pipeline(steps)
+
+
 def cluster_pipeline(df, n_clusters, init_method='k-means++', nb_init=10, max_iter=1000,
                      t_method='quant', nb_qt=100, output_dist='normal', random_state=1234,
-                     verbose=0):
+                     verbose=0, reduce_variance=None):
     """
 
     :param df:
@@ -115,14 +282,12 @@ def cluster_pipeline(df, n_clusters, init_method='k-means++', nb_init=10, max_it
     :param output_dist:
     :param random_state:
     :param verbose:
+    :param reduce_variance:     If provided, data is cast to float32 and reduced to
+                                this proportion of explained variance before
+                                clustering (see build_front_end).
     :return:
     """
 
-    transf_kwargs = {
-        'n_quantiles': nb_qt,
-        'output_distribution': f'{output_dist}'
-    }
-
     kmeans_kwargs = {
         'n_clusters': n_clusters,
         'init': f'{init_method}',
@@ -132,30 +297,104 @@ def cluster_pipeline(df, n_clusters, init_method='k-means++', nb_init=10, max_it
         'verbose': verbose,
     }
 
-    if t_method == 'quant':
-        pipe = Pipeline(
-            [
-                ('Transform', QuantileTransformer(
-                    **transf_kwargs,
-                )),
-                ('kmeans', KMeans(
-                    **kmeans_kwargs,
-                ),),
-            ],
-            verbose=True
-        )
-
-    else:
-        pipe = Pipeline(
-            [
-                ('Scaling', StandardScaler()),
-                ('kmeans', KMeans(
-                    **kmeans_kwargs,
-                ),),
-            ],
-            verbose=True
-        )
+    front = build_front_end(t_method, nb_qt, output_dist, reduce_variance,
+                            random_state=random_state)
+    pipe = Pipeline(
+        front.steps + [
+            ('kmeans', KMeans(
+                **kmeans_kwargs,
+            ),),
+        ],
+        verbose=True
+    )
 
     pipe.fit(df)
 
     return pipe
+
+
+def _bootstrap_replicate(data, reference, n_clusters, init_method, nb_init, max_iter,
+                         seed):
+    """
+    Refit KMeans on a bootstrap resample of the data and compare it with the
+    reference labels on the subjects drawn. Only scores are returned.
+    """
+    rng = np.random.default_rng(seed)
+    n = data.shape[0]
+    idx = rng.integers(n, size=n)
+    km = KMeans(n_clusters=n_clusters, init=init_method, n_init=nb_init,
+                max_iter=max_iter, random_state=int(rng.integers(2 ** 31 - 1)))
+    km.fit(data[idx])
+
+    drawn = np.unique(idx)
+    ref = reference[drawn]
+    boot = km.predict(data[drawn])
+
+    # Jaccard of each reference cluster with its most similar bootstrap cluster.
+    table = np.bincount(ref * n_clusters + boot,
+                        minlength=n_clusters ** 2).reshape(n_clusters, n_clusters)
+    union = table.sum(axis=1)[:, None] + table.sum(axis=0)[None, :] - table
+    with np.errstate(divide='ignore', invalid='ignore'):
+        jaccard = np.where(union > 0, table / union, 0).max(axis=1)
+
+    return adjusted_rand_score(ref, boot), jaccard
+
+
+def bootstrap_stability(df, pipe, n_boot=100, init_method='k-means++', nb_init=10,
+                        max_iter=1000, random_state=1234, n_jobs=1):
+    """
+    Function to assess the stability of a clustering solution by refitting
+    KMeans on bootstrap resamples. The data is transformed once and shared by
+    all replicates (memory-mapped by joblib in the worker processes); each
+    replicate uses its own seed spawned from random_state, so results do not
+    depend on n_jobs. Only scores are returned by the replicates, no labels
+    are kept.
+    :param df:              Pandas dataframe used to fit pipe.
+    :param pipe:            Fitted Pipeline (ex: cluster_pipeline output) giving
+                            the transformation and the reference labels.
+    :param n_boot:          Number of bootstrap replicates.
+    :param init_method:     Initiation state. ['random' or 'k-means++']
+    :param nb_init:         Number of initializations for each refit.
+    :param max_iter:        Number of max iterations to perform.
+    :param random_state:    Seed from which the seed of every replicate is spawned.
+    :param n_jobs:          Number of processes.
+    :return:                Pandas dataframe with the mean, standard deviation,
+                            minimum and maximum of the adjusted Rand index and of
+                            the Jaccard index of each cluster, and the proportion
+                            of replicates in which each cluster dissolved
+                            (Jaccard < 0.5).
+    """
+
+    n_clusters = pipe[-1].n_clusters
+    reference = np.asarray(pipe[-1].labels_)
+    data = np.ascontiguousarray(pipe[:-1].transform(df), dtype=np.float32)
+
+    seeds = np.random.SeedSequence(random_state).spawn(n_boot)
+    results = Parallel(n_jobs=n_jobs)(
+        delayed(_bootstrap_replicate)(data, reference, n_clusters, init_method,
+                                      nb_init, max_iter, seed)
+        for seed in seeds)
+
+    total = np.zeros(n_clusters + 1)
+    total_sq = np.zeros(n_clusters + 1)
+    low = np.full(n_clusters + 1, np.inf)
+    high = np.full(n_clusters + 1, -np.inf)
+    dissolved = np.zeros(n_clusters + 1)
+
+    for i, (ari, jaccard) in enumerate(results):
+        scores = np.append(ari, jaccard)
+        total += scores
+        total_sq += scores ** 2
+        low = np.minimum(low, scores)
+        high = np.maximum(high, scores)
+        dissolved[1:] += jaccard < 0.5
+        logging.info(f'Bootstrap {i + 1}/{n_boot}: ARI = {ari:.3f}')
+
+    mean = total / n_boot
+    std = np.sqrt(np.maximum(total_sq / n_boot - mean ** 2, 0))
+    summary = pd.DataFrame({'mean': mean, 'std': std, 'min': low, 'max': high,
+                            'dissolved': dissolved / n_boot},
+                           index=['ARI'] + [f'Jaccard_{c}' for c in range(n_clusters)])
+    summary.loc['ARI', 'dissolved'] = np.nan
+
+    return summary
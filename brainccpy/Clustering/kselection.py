@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from sklearn.cluster import KMeans
+
+
+def _within_dispersion(data, labels, centers):
+    return ((data - centers[labels]) ** 2).sum()
+
+
+def calinski_harabasz(data, labels, centers):
+    """
+    Function to compute the Calinski-Harabasz score from already fitted
+    labels and centroids in O(n * k).
+    :param data:        Transformed data used for clustering (n x p).
+    :param labels:      Cluster labels.
+    :param centers:     Cluster centroids (k x p).
+    :return:            Calinski-Harabasz score (higher is better). NaN if k < 2.
+    """
+    n, k = data.shape[0], centers.shape[0]
+    if k < 2:
+        return np.nan
+
+    counts = np.bincount(labels, minlength=k)
+    mean = data.mean(axis=0)
+    between = (counts * ((centers - mean) ** 2).sum(axis=1)).sum()
+    within = _within_dispersion(data, labels, centers)
+
+    return float(between * (n - k) / (within * (k - 1))) if within > 0 else 1.0
+
+
+def davies_bouldin(data, labels, centers):
+    """
+    Function to compute the Davies-Bouldin score from already fitted
+    labels and centroids in O(n * k).
+    :param data:        Transformed data used for clustering (n x p).
+    :param labels:      Cluster labels.
+    :param centers:     Cluster centroids (k x p).
+    :return:            Davies-Bouldin score (lower is better). NaN if k < 2.
+    """
+    k = centers.shape[0]
+    if k < 2:
+        return np.nan
+
+    dist = np.sqrt(((data - centers[labels]) ** 2).sum(axis=1))
+    counts = np.bincount(labels, minlength=k)
+    scatter = np.bincount(labels, weights=dist, minlength=k) / np.maximum(counts, 1)
+
+    sq = (centers ** 2).sum(axis=1)
+    separation = np.sqrt(np.maximum(sq[:, None] + sq[None, :] - 2 * centers @ centers.T, 0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = (scatter[:, None] + scatter[None, :]) / separation
+    ratio[np.diag_indices(k)] = 0
+    ratio[~np.isfinite(ratio)] = 0
+
+    return float(ratio.max(axis=1).mean())
+
+
+def k_selection_scores(df, pipes):
+    """
+    Function to compute the k-selection criteria from the pipelines fitted
+    during the elbow sweep (elbow_method with return_pipes=True), without
+    refitting any model.
+    :param df:          Pandas dataframe used in the sweep.
+    :param pipes:       List of fitted pipelines (one per k).
+    :return:            Pandas dataframe with the SSE, Calinski-Harabasz and
+                        Davies-Bouldin scores for each k.
+    """
+    data = pipes[0][:-1].transform(df)
+
+    scores = []
+    for pipe in pipes:
+        km = pipe[-1]
+        scores.append({
+            'k': km.n_clusters,
+            'sse': km.inertia_,
+            'calinski_harabasz': calinski_harabasz(data, km.labels_, km.cluster_centers_),
+            'davies_bouldin': davies_bouldin(data, km.labels_, km.cluster_centers_),
+        })
+
+    return pd.DataFrame(scores)
+
+
+def _reference_dispersions(low, high, n, ks, kmeans_kwargs, seed):
+    rng = np.random.default_rng(seed)
+    ref = rng.uniform(low, high, size=(n, len(low)))
+    return [np.log(KMeans(n_clusters=k, **kmeans_kwargs).fit(ref).inertia_)
+            for k in ks]
+
+
+def gap_statistic(df, pipes, n_refs=10, nb_init=3, max_iter=300,
+                  random_state=1234, n_jobs=1):
+    """
+    Function to compute the gap statistic (Tibshirani et al., 2001) for every
+    k of the elbow sweep. Reference datasets are drawn uniformly over the
+    range of the transformed data and are clustered in parallel.
+    :param df:              Pandas dataframe used in the sweep.
+    :param pipes:           List of fitted pipelines (one per k).
+    :param n_refs:          Number of reference datasets.
+    :param nb_init:         Number of initializations for reference fits.
+    :param max_iter:        Number of max iterations for reference fits.
+    :param random_state:    Seed from which every reference seed is spawned.
+    :param n_jobs:          Number of processes used to cluster references.
+    :return:                Pandas dataframe with the gap and its standard error
+                            for each k, and the optimal k (smallest k such as
+                            gap(k) >= gap(k+1) - s(k+1)).
+    """
+    data = pipes[0][:-1].transform(df)
+    ks = [pipe[-1].n_clusters for pipe in pipes]
+    log_w = np.log([pipe[-1].inertia_ for pipe in pipes])
+
+    kmeans_kwargs = {
+        'n_init': nb_init,
+        'max_iter': max_iter,
+        'random_state': random_state,
+    }
+    seeds = np.random.SeedSequence(random_state).spawn(n_refs)
+    ref_log_w = np.array(Parallel(n_jobs=n_jobs)(
+        delayed(_reference_dispersions)(data.min(axis=0), data.max(axis=0),
+                                        data.shape[0], ks, kmeans_kwargs, seed)
+        for seed in seeds))
+
+    gap = ref_log_w.mean(axis=0) - log_w
+    sk = ref_log_w.std(axis=0) * np.sqrt(1 + 1 / n_refs)
+
+    best = ks[-1]
+    for i in range(len(ks) - 1):
+        if gap[i] >= gap[i + 1] - sk[i + 1]:
+            best = ks[i]
+            break
+
+    return pd.DataFrame({'k': ks, 'gap': gap, 'gap_sk': sk}), best
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+import numpy as np
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler
+from brainccpy.Clustering.reduction import DimensionReduction
+from brainccpy.Clustering.utils import (QuantileTransformer,
+                                        StreamingQuantileTransformer)
+from brainccpy.version import __version__
+
+FORMAT_VERSION = 1
+
+# Transformers that can be saved before the clustering step.
+TRANSFORMERS = {
+    'QuantileTransformer': QuantileTransformer,
+    'StreamingQuantileTransformer': StreamingQuantileTransformer,
+    'StandardScaler': StandardScaler,
+    'DimensionReduction': DimensionReduction,
+}
+
+
+def _to_json(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return {'__array__': value.tolist()}
+    return value
+
+
+def _from_json(value):
+    if isinstance(value, dict) and '__array__' in value:
+        return np.array(value['__array__'], dtype=object)
+    return value
+
+
+def save_pipeline(pipe, filename, columns=None):
+    """
+    Function to save a fitted clustering pipeline (cluster_pipeline output) in
+    a compact and versioned .npz file. Only the parameters and fitted arrays
+    of each step are saved (no pickle), so the file can be loaded safely.
+    :param pipe:        Fitted Pipeline. Last step must expose cluster_centers_.
+    :param filename:    Output filename (.npz).
+    :param columns:     Names of the features used for fitting, in order.
+    """
+    arrays = {}
+    steps = []
+    for i, (name, est) in enumerate(pipe.steps[:-1]):
+        cls = type(est).__name__
+        if cls not in TRANSFORMERS:
+            raise ValueError(f'Transformer {cls} cannot be saved.')
+        attrs = {}
+        for attr, value in vars(est).items():
+            if not attr.endswith('_') or attr.startswith('_'):
+                continue
+            if isinstance(value, np.ndarray) and value.dtype != object:
+                arrays[f'{i}/{attr}'] = value
+            else:
+                attrs[attr] = _to_json(value)
+        steps.append({'name': name,
+                      'class': cls,
+                      'params': {k: _to_json(v) for k, v in est.get_params().items()},
+                      'attrs': attrs})
+
+    name, clusterer = pipe.steps[-1]
+    arrays['centers'] = clusterer.cluster_centers_
+    meta = {
+        'format_version': FORMAT_VERSION,
+        'brainccpy_version': __version__,
+        'steps': steps,
+        'clusterer': name,
+        'columns': None if columns is None else [str(c) for c in columns],
+    }
+
+    np.savez_compressed(filename, meta=np.array(json.dumps(meta)), **arrays)
+
+
+class ClusterModel(object):
+    """
+    Clustering model loaded with load_pipeline. Subjects are transformed with
+    the saved transformation steps and assigned to the nearest centroid.
+    :param transform:   Pipeline of fitted transformers.
+    :param centers:     Cluster centroids (k x p).
+    :param columns:     Names of the features, in order (or None).
+    """
+
+    def __init__(self, transform, centers, columns=None):
+        self.transform_ = transform
+        self.centers = centers
+        self.columns = columns
+        self._centers_sq = (centers ** 2).sum(axis=1)
+
+    def transform(self, df):
+        if self.columns is not None and hasattr(df, 'columns'):
+            df = df[self.columns]
+        if self.transform_ is None:
+            return np.asarray(df, dtype=float)
+        return self.transform_.transform(df)
+
+    def predict(self, df, chunk_size=10000):
+        """
+        Assign subjects to the nearest centroid, processing them in chunks.
+        :param df:          Pandas dataframe or array of subjects.
+        :param chunk_size:  Number of subjects processed at once.
+        :return:            Cluster labels.
+        """
+        data = self.transform(df)
+        labels = np.empty(data.shape[0], dtype=int)
+        for start in range(0, data.shape[0], chunk_size):
+            chunk = data[start:start + chunk_size]
+            # ||x||^2 is constant for each subject and can be omitted.
+            dist = self._centers_sq - 2 * chunk @ self.centers.T
+            labels[start:start + chunk_size] = np.argmin(dist, axis=1)
+
+        return labels
+
+
+def load_pipeline(filename):
+    """
+    Function to load a clustering pipeline saved with save_pipeline.
+    :param filename:    Model filename (.npz).
+    :return:            ClusterModel.
+    """
+    with np.load(filename, allow_pickle=False) as f:
+        meta = json.loads(str(f['meta']))
+        if meta['format_version'] > FORMAT_VERSION:
+            raise ValueError(f'Model format version {meta["format_version"]} is not '
+                             f'supported by this version of brainccpy '
+                             f'(<= {FORMAT_VERSION}).')
+
+        steps = []
+        for i, step in enumerate(meta['steps']):
+            est = TRANSFORMERS[step['class']](**{k: _from_json(v) for k, v
+                                                 in step['params'].items()})
+            for attr, value in step['attrs'].items():
+                setattr(est, attr, _from_json(value))
+            prefix = f'{i}/'
+            for key in f.files:
+                if key.startswith(prefix):
+                    setattr(est, key[len(prefix):], f[key])
+            steps.append((step['name'], est))
+        centers = f['centers']
+
+    transform = Pipeline(steps) if steps else None
+
+    return ClusterModel(transform, centers, meta['columns'])
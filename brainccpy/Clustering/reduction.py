@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+import logging
+
+import numpy as np
+from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.decomposition import PCA, TruncatedSVD
+
+
+class DimensionReduction(TransformerMixin, BaseEstimator):
+    """
+    Transformer casting data to float32 and reducing its dimensionality with
+    randomized PCA or TruncatedSVD, keeping the smallest number of components
+    reaching the requested explained variance.
+    :param variance:        Proportion of explained variance to keep (0-1).
+    :param max_components:  Maximum number of components computed by the
+                            randomized decomposition.
+    :param method:          'pca' (centered) or 'svd' (TruncatedSVD, not centered).
+    :param random_state:    Seed of the randomized decomposition.
+    """
+
+    def __init__(self, variance=0.9, max_components=256, method='pca', random_state=1234):
+        self.variance = variance
+        self.max_components = max_components
+        self.method = method
+        self.random_state = random_state
+
+    def fit(self, X, y=None):
+        X = np.asarray(X, dtype=np.float32)
+        n_max = min(self.max_components, *X.shape)
+
+        if self.method == 'pca':
+            dec = PCA(n_components=n_max, svd_solver='randomized',
+                      random_state=self.random_state).fit(X)
+            mean = dec.mean_
+        elif self.method == 'svd':
+            dec = TruncatedSVD(n_components=min(n_max, X.shape[1] - 1),
+                               algorithm='randomized',
+                               random_state=self.random_state).fit(X)
+            mean = np.zeros(X.shape[1], dtype=np.float32)
+        else:
+            raise ValueError("method should be either 'pca' or 'svd'.")
+
+        ratio = dec.explained_variance_ratio_
+        total = np.cumsum(ratio)
+        n = min(int(np.searchsorted(total, self.variance)) + 1, len(ratio))
+        # Tolerance for the rounding of the ratios when every component is kept.
+        if total[-1] < self.variance - 1e-6:
+            logging.warning(f'The {len(ratio)} computed components explain '
+                            f'{total[-1] * 100:.1f}% of variance, less than the requested '
+                            f'{self.variance * 100:.1f}% (max_components='
+                            f'{self.max_components}). All of them are kept.')
+        logging.info(f'{n} components kept ({np.sum(ratio[:n]) * 100:.1f}% of variance).')
+
+        self.components_ = dec.components_[:n].astype(np.float32)
+        self.mean_ = mean.astype(np.float32)
+        self.explained_variance_ratio_ = ratio[:n]
+        self.n_components_ = n
+        self.n_features_in_ = X.shape[1]
+
+        return self
+
+    def transform(self, X):
+        X = np.asarray(X, dtype=np.float32)
+        return (X - self.mean_) @ self.components_.T
+
+    def inverse_transform(self, X):
+        X = np.asarray(X, dtype=np.float32)
+        return X @ self.components_ + self.mean_
+
+
+def centroids_in_feature_space(pipe):
+    """
+    Function to map the centroids of a fitted clustering pipeline back to the
+    space of the transformed features (before dimensionality reduction).
+    :param pipe:    Fitted Pipeline (cluster_pipeline output).
+    :return:        Centroids (k x n_features).
+    """
+    centers = pipe.steps[-1][1].cluster_centers_
+    for _, step in reversed(pipe.steps[1:-1]):
+        centers = step.inverse_transform(centers)
+
+    return centers
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+import matplotlib
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.preprocessing import QuantileTransformer
+
+from brainccpy.Clustering.utils import (StreamingQuantileTransformer,
+                                        distribution_summary,
+                                        plot_distribution_pages)
+
+matplotlib.use('Agg')
+
+N_SAMPLES = 2000
+SKETCH_SIZE = 1000
+
+
+def _bound(n_chunks):
+    # Documented bound of StreamingQuantileTransformer (rank error).
+    return n_chunks / N_SAMPLES + (1 + np.ceil(np.log2(n_chunks))) / SKETCH_SIZE
+
+
+def _data(kind):
+    rng = np.random.default_rng(0)
+    if kind == 'normal':
+        return rng.normal(size=(N_SAMPLES, 2))
+    return rng.integers(0, 7, size=(N_SAMPLES, 2)).astype(float)
+
+
+def _reference(data):
+    return QuantileTransformer(n_quantiles=1000, subsample=10 ** 9).fit(data).transform(data)
+
+
+@pytest.mark.parametrize('kind', ['normal', 'tied'])
+@pytest.mark.parametrize('chunk_size', [5, 100, 1000])
+def test_fit_error_bound(kind, chunk_size):
+    data = _data(kind)
+    qt = StreamingQuantileTransformer(sketch_size=SKETCH_SIZE, chunk_size=chunk_size)
+    out = qt.fit(data).transform(data)
+
+    assert np.abs(out - _reference(data)).max() <= _bound(-(-N_SAMPLES // chunk_size))
+
+
+@pytest.mark.parametrize('kind', ['normal', 'tied'])
+@pytest.mark.parametrize('batch_size', [30, 250])
+def test_partial_fit_buffers_small_batches(kind, batch_size):
+    data = _data(kind)
+    qt = StreamingQuantileTransformer(sketch_size=SKETCH_SIZE, chunk_size=100)
+    for start in range(0, N_SAMPLES, batch_size):
+        qt.partial_fit(data[start:start + batch_size])
+    out = qt.transform(data)
+
+    assert np.abs(out - _reference(data)).max() <= _bound(N_SAMPLES // 100)
+    # Batches are regrouped into the same chunks as fit.
+    fitted = StreamingQuantileTransformer(sketch_size=SKETCH_SIZE, chunk_size=100).fit(data)
+    np.testing.assert_allclose(out, fitted.transform(data), atol=1e-12)
+
+
+def test_partial_fit_incomplete_chunk():
+    data = _data('normal')[:150]
+    qt = StreamingQuantileTransformer(chunk_size=100).partial_fit(data)
+
+    # The 50 buffered rows are part of the fitted quantiles.
+    assert qt._n_samples == 150
+    assert len(qt._buffer) == 50
+    assert qt.quantiles_[-1, 0] == data[:, 0].max()
+
+
+@pytest.mark.parametrize('style', ['ridge', 'grid'])
+def test_plot_distribution_pages_empty_column(style):
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({'values': rng.normal(size=100), 'empty': np.nan})
+    summary = distribution_summary([df.iloc[:50], df.iloc[50:]], bins=10)
+    assert summary['n'][1] == 0
+
+    figures = list(plot_distribution_pages(summary, style=style))
+    texts = [t.get_text() for ax in figures[0].axes for t in ax.texts]
+    assert any('NaN: 100' in t for t in texts)
+    plt.close('all')
@@ -1,7 +1,12 @@
 # -*- coding: utf-8 -*-
 
+import json
+
 import seaborn as sns
 import numpy as np
+from joblib import Parallel, delayed, effective_n_jobs
+from scipy import stats
+from sklearn.base import BaseEstimator, TransformerMixin
 from sklearn.preprocessing import (QuantileTransformer,
                                    PowerTransformer,
                                    StandardScaler)
@@ -13,6 +18,7 @@ from mpl_toolkits.mplot3d import Axes3D
 from matplotlib.lines import Line2D
 from matplotlib.colors import ListedColormap
 import matplotlib.animation as animation
+from brainccpy.version import __version__
 
 
 def plot_dist(df, ind1, ind2):
@@ -45,20 +51,476 @@ def remove_nans(df):
     return df
 
 
-def quantile_transform(df, nb_qt, output_dist):
+def quantile_transform(df, nb_qt, output_dist, chunk_size=None, n_jobs=1):
     """
-
-    :param df:
-    :param nb_qt:
-    :return:
+    Function to apply a quantile transformation to each column.
+    :param df:          Pandas dataframe or array (can be memory-mapped).
+    :param nb_qt:       Number of quantiles.
+    :param output_dist: Outputted distribution ('uniform' or 'normal').
+    :param chunk_size:  If provided, quantiles are estimated with streaming
+                        sketches over chunks of this many rows
+                        (see StreamingQuantileTransformer) instead of
+                        loading whole columns.
+    :param n_jobs:      Number of processes used to build the sketches.
+    :return:            Transformed array.
     """
-    qt = QuantileTransformer(n_quantiles=nb_qt, random_state=0,
-                             output_distribution=f'{output_dist}')
+    if chunk_size is not None:
+        qt = StreamingQuantileTransformer(n_quantiles=nb_qt,
+                                          output_distribution=f'{output_dist}',
+                                          chunk_size=chunk_size, n_jobs=n_jobs)
+    else:
+        qt = QuantileTransformer(n_quantiles=nb_qt, random_state=0,
+                                 output_distribution=f'{output_dist}')
     out = qt.fit_transform(df)
 
     return out
 
 
+# Same clipping of the normal output as sklearn's QuantileTransformer.
+BOUNDS_THRESHOLD = 1e-7
+
+
+def _rows(data, start, stop):
+    chunk = data.iloc[start:stop] if hasattr(data, 'iloc') else data[start:stop]
+    return np.asarray(chunk, dtype=float).reshape(stop - start, -1)
+
+
+def _searchsorted_columns(xp, x, side='left'):
+    """
+    np.searchsorted applied independently to every column (binary search on
+    all columns at once). xp is (K x p) and sorted along axis 0, x is (m x p).
+    """
+    lo = np.zeros(x.shape, dtype=np.intp)
+    hi = np.full(x.shape, xp.shape[0], dtype=np.intp)
+    for _ in range(int(np.ceil(np.log2(xp.shape[0] + 1))) + 1):
+        mid = (lo + hi) // 2
+        v = np.take_along_axis(xp, np.minimum(mid, xp.shape[0] - 1), axis=0)
+        right = (v <= x) if side == 'right' else (v < x)
+        active = lo < hi
+        lo = np.where(active & right, mid + 1, lo)
+        hi = np.where(active & ~right, mid, hi)
+
+    return lo
+
+
+def _interp_columns(x, xp, fp, side='both'):
+    """
+    Column-wise linear interpolation (xp is K x p, fp is K or K x p). With
+    side='both', as in sklearn, the interpolations from the left and from the
+    right are averaged so that repeated values of xp are mapped to the middle
+    of their range. 'left' and 'right' map them to their first and last
+    value (left and right limits of a step).
+    """
+    k = xp.shape[0]
+    fp = np.broadcast_to(fp.reshape(k, -1), (k, xp.shape[1]))
+
+    def gather(a, idx):
+        return np.take_along_axis(a, idx, axis=0)
+
+    sides = ['right', 'left'] if side == 'both' else [side]
+    out = np.zeros(x.shape)
+    for s in sides:
+        i = np.clip(_searchsorted_columns(xp, x, s) - 1, 0, k - 2)
+        x0, x1 = gather(xp, i), gather(xp, i + 1)
+        # Empty intervals only remain at the ends (values out of range).
+        tied = (x >= x1) if s == 'right' else (x > x0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = np.where(x1 > x0, (x - x0) / (x1 - x0), tied)
+        t = np.clip(t, 0, 1)
+        f0 = gather(fp, i)
+        out += (f0 + t * (gather(fp, i + 1) - f0)) / len(sides)
+
+    return out
+
+
+def _chunk_sketch(chunk, probs):
+    # Linear quantiles (as np.nanquantile) of all columns from a single sort,
+    # NaNs are sorted last.
+    counts = (~np.isnan(chunk)).sum(axis=0)
+    ordered = np.sort(chunk, axis=0)
+    last = np.maximum(counts - 1, 0)
+    pos = probs[:, None] * last
+    lo = np.floor(pos).astype(np.intp)
+    low = np.take_along_axis(ordered, lo, axis=0)
+    high = np.take_along_axis(ordered, np.minimum(lo + 1, last), axis=0)
+    q = low + (pos - lo) * (high - low)
+    q[:, counts == 0] = np.nan
+
+    return q, counts.astype(float)
+
+
+def _merge_sketches(a, b, probs):
+    """
+    Merge two quantile sketches (values at probs, count of each column): the
+    CDF of the union is the count-weighted mixture of both CDFs, evaluated at
+    every knot and inverted back on the probs grid. Left and right limits are
+    both kept so that tied values (discrete data) stay steps of the CDF.
+    """
+    (qa, na), (qb, nb) = a, b
+    # Columns without values in one of the sketches take the other one.
+    qa, qb = np.where(na > 0, qa, qb), np.where(nb > 0, qb, qa)
+    cand = np.sort(np.concatenate([qa, qb]), axis=0)
+    cdf = np.empty((2 * len(cand),) + cand.shape[1:])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for offset, side in enumerate(['left', 'right']):
+            cdf[offset::2] = (na * _interp_columns(cand, qa, probs, side) +
+                              nb * _interp_columns(cand, qb, probs, side)) / (na + nb)
+    grid = np.broadcast_to(probs[:, None], qa.shape)
+    q = _interp_columns(grid, np.maximum.accumulate(cdf, axis=0),
+                        np.repeat(cand, 2, axis=0))
+    q[0], q[-1] = np.minimum(qa[0], qb[0]), np.maximum(qa[-1], qb[-1])
+
+    return q, na + nb
+
+
+def _push_sketch(levels, sketch, probs):
+    # Binary counter: sketches are only merged with sketches summarizing the
+    # same number of chunks, so each value goes through log2(n_chunks) merges.
+    for i in range(len(levels) + 1):
+        if i == len(levels):
+            levels.append(None)
+        if levels[i] is None:
+            levels[i] = sketch
+            return
+        sketch = _merge_sketches(levels[i], sketch, probs)
+        levels[i] = None
+
+
+def _reduce_sketches(sketches, probs):
+    sketches = [s for s in sketches if s is not None]
+    while len(sketches) > 1:
+        sketches = [_merge_sketches(sketches[i], sketches[i + 1], probs)
+                    if i + 1 < len(sketches) else sketches[i]
+                    for i in range(0, len(sketches), 2)]
+
+    return sketches[0]
+
+
+def _sketch_rows(data, start, stop, chunk_size, probs):
+    levels = []
+    for i in range(start, stop, chunk_size):
+        _push_sketch(levels, _chunk_sketch(_rows(data, i, min(i + chunk_size, stop)),
+                                           probs), probs)
+
+    return _reduce_sketches(levels[::-1], probs)
+
+
+class StreamingQuantileTransformer(TransformerMixin, BaseEstimator):
+    """
+    Quantile transformer for data larger than memory, with the n_quantiles and
+    output_distribution semantics of sklearn's QuantileTransformer. Quantiles
+    are estimated in one pass over chunks of rows: each chunk is summarized by
+    a mergeable sketch per column (values at sketch_size + 1 equally spaced
+    probabilities and the count of non-NaN values), sketches of the chunks
+    are merged pairwise, and workers sketch separate blocks of rows in
+    parallel before their sketches are merged. Transform is applied chunk by
+    chunk with a linear interpolation vectorized over columns.
+
+    Error bounds: a chunk of m rows is summarized by its linearly
+    interpolated order statistics, which deviate from its empirical CDF by at
+    most 1 / m in rank, i.e. n_chunks / n_samples once weighted over chunks
+    of similar sizes. The sketch of a chunk deviates from this by at most
+    1 / sketch_size between knots, each merge adds at most another
+    1 / sketch_size, and a value goes through at most ceil(log2(n_chunks))
+    merges. Fitted quantiles are therefore within
+    n_chunks / n_samples + (1 + ceil(log2(n_chunks))) / sketch_size in rank
+    of those of QuantileTransformer fitted on the full data without
+    subsampling, and the 'uniform' outputs differ by at most the same amount
+    (about 1 / chunk_size + (1 + log2(n_chunks)) / sketch_size; smooth
+    distributions are closer). partial_fit buffers rows until chunk_size is
+    reached, so the bound does not depend on the size of its batches.
+    Memory is (sketch_size + 1) x n_features floats per sketch level, plus
+    at most chunk_size buffered rows with partial_fit.
+    :param n_quantiles:         Number of quantiles (capped to the number of
+                                samples).
+    :param output_distribution: 'uniform' or 'normal'.
+    :param sketch_size:         Resolution of the per-column sketches.
+    :param chunk_size:          Number of rows loaded at once.
+    :param n_jobs:              Number of processes used to build the sketches.
+    """
+
+    def __init__(self, n_quantiles=1000, output_distribution='uniform',
+                 sketch_size=1000, chunk_size=10000, n_jobs=1):
+        self.n_quantiles = n_quantiles
+        self.output_distribution = output_distribution
+        self.sketch_size = sketch_size
+        self.chunk_size = chunk_size
+        self.n_jobs = n_jobs
+
+    def _probs(self):
+        return np.linspace(0, 1, self.sketch_size + 1)
+
+    def _finalize(self):
+        sketches = self._levels[::-1]
+        if getattr(self, '_buffer', None) is not None:
+            # Rows of an incomplete chunk are sketched without being consumed.
+            sketches = sketches + [_chunk_sketch(self._buffer, self._probs())]
+        q, counts = _reduce_sketches(sketches, self._probs())
+        self.n_features_in_ = q.shape[1]
+        self.n_quantiles_ = max(1, min(self.n_quantiles, self._n_samples))
+        self.references_ = np.linspace(0, 1, self.n_quantiles_)
+        # Sketch values on its regular grid, read at the references.
+        pos = self.references_ * self.sketch_size
+        i = np.minimum(pos.astype(int), self.sketch_size - 1)
+        t = (pos - i)[:, None]
+        self.quantiles_ = np.maximum.accumulate(q[i] + t * (q[i + 1] - q[i]), axis=0)
+
+        return self
+
+    def fit(self, X, y=None):
+        """
+        Estimate the quantiles of every column in one pass over chunks of rows.
+        :param X:   Pandas dataframe or array (n_samples x n_features), can be
+                    memory-mapped.
+        :return:    self.
+        """
+        if self.output_distribution not in ['uniform', 'normal']:
+            raise ValueError("output_distribution should be either 'uniform' or 'normal'.")
+        n = X.shape[0]
+        probs = self._probs()
+        n_chunks = min(max(1, effective_n_jobs(self.n_jobs)),
+                       -(-n // self.chunk_size))
+        bounds = np.linspace(0, n, n_chunks + 1).astype(int)
+        sketches = Parallel(n_jobs=self.n_jobs)(
+            delayed(_sketch_rows)(X, bounds[i], bounds[i + 1], self.chunk_size, probs)
+            for i in range(n_chunks))
+        self._levels = [_reduce_sketches(sketches, probs)]
+        self._buffer = None
+        self._n_samples = n
+
+        return self._finalize()
+
+    def partial_fit(self, X, y=None):
+        """
+        Update the sketches with new rows (ex: subjects added to a cohort or
+        chunks read from disk). Rows are sketched by chunks of chunk_size,
+        the rows of an incomplete chunk are buffered until the next call.
+        :param X:   Rows (n_rows x n_features), any number.
+        :return:    self.
+        """
+        if not hasattr(self, '_levels'):
+            self._levels, self._buffer, self._n_samples = [], None, 0
+        probs = self._probs()
+        n = X.shape[0]
+        start = 0
+        if getattr(self, '_buffer', None) is not None:
+            start = min(self.chunk_size - len(self._buffer), n)
+            self._buffer = np.concatenate([self._buffer, _rows(X, 0, start)])
+            if len(self._buffer) == self.chunk_size:
+                _push_sketch(self._levels, _chunk_sketch(self._buffer, probs), probs)
+                self._buffer = None
+        for start in range(start, n, self.chunk_size):
+            stop = min(start + self.chunk_size, n)
+            if stop - start < self.chunk_size:
+                self._buffer = _rows(X, start, stop)
+                break
+            _push_sketch(self._levels, _chunk_sketch(_rows(X, start, stop), probs), probs)
+        self._n_samples += n
+
+        return self._finalize()
+
+    def transform(self, X):
+        """
+        Transform the data chunk by chunk.
+        :param X:   Pandas dataframe or array, can be memory-mapped.
+        :return:    Transformed array (float64).
+        """
+        lower, upper = self.quantiles_[0], self.quantiles_[-1]
+        out = np.empty((X.shape[0], self.n_features_in_))
+        for start in range(0, X.shape[0], self.chunk_size):
+            stop = min(start + self.chunk_size, X.shape[0])
+            x = _rows(X, start, stop)
+            if self.output_distribution == 'normal':
+                lower_idx = x - BOUNDS_THRESHOLD < lower
+                upper_idx = x + BOUNDS_THRESHOLD > upper
+            else:
+                lower_idx = x == lower
+                upper_idx = x == upper
+            res = _interp_columns(x, self.quantiles_, self.references_)
+            res[upper_idx] = 1
+            res[lower_idx] = 0
+            if self.output_distribution == 'normal':
+                res = np.clip(stats.norm.ppf(res),
+                              stats.norm.ppf(BOUNDS_THRESHOLD - np.spacing(1)),
+                              stats.norm.ppf(1 - (BOUNDS_THRESHOLD - np.spacing(1))))
+            res[np.isnan(x)] = np.nan
+            out[start:stop] = res
+
+        return out
+
+
+DISTRIBUTIONS_VERSION = 1
+
+
+def distribution_summary(chunks, bins=50, probs=(0, 0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99, 1),
+                         sketch_size=1000):
+    """
+    Function to summarize the distribution of every numerical column of a
+    table in one pass over chunks of rows. Each chunk updates the quantile
+    sketches of StreamingQuantileTransformer and the moments of every
+    column, histograms are then derived from the merged sketches (rank error
+    of the sketch, see StreamingQuantileTransformer) so that bin edges do
+    not need to be known before reading the data.
+    :param chunks:      Iterable of pandas dataframes (ex: iter_table_chunks).
+                        Numerical columns of the first chunk are used.
+    :param bins:        Number of histogram bins per column.
+    :param probs:       Probabilities of the quantiles to report.
+    :param sketch_size: Resolution of the quantile sketches.
+    :return:            Dictionary with columns, n (non-NaN values), n_nan,
+                        mean, std, probs, quantiles (len(probs) x p), edges
+                        (bins + 1 x p) and counts (bins x p).
+    """
+    grid = np.linspace(0, 1, sketch_size + 1)
+    levels, columns = [], None
+    for chunk in chunks:
+        if columns is None:
+            columns = list(chunk.select_dtypes('number').columns)
+        values = chunk[columns].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float)
+        if levels:
+            n_nan += np.isnan(values).sum(axis=0)
+            sums += np.nansum(values, axis=0)
+            squares += np.nansum(values ** 2, axis=0)
+        else:
+            n_nan = np.isnan(values).sum(axis=0)
+            sums = np.nansum(values, axis=0)
+            squares = np.nansum(values ** 2, axis=0)
+        _push_sketch(levels, _chunk_sketch(values, grid), grid)
+
+    sketch, n = _reduce_sketches(levels[::-1], grid)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = sums / n
+        std = np.sqrt(np.maximum(squares / n - mean ** 2, 0) * n / (n - 1))
+
+    probs = np.asarray(probs, dtype=float)
+    pos = probs * sketch_size
+    i = np.minimum(pos.astype(int), sketch_size - 1)
+    t = (pos - i)[:, None]
+    quantiles = sketch[i] + t * (sketch[i + 1] - sketch[i])
+
+    # Bins span the range of each column, counts are read on the sketch CDF
+    # (left limits, bins include their lower edge as in np.histogram).
+    steps = np.linspace(0, 1, bins + 1)[:, None]
+    edges = sketch[0] + steps * (sketch[-1] - sketch[0])
+    cdf = _interp_columns(edges, sketch, grid, side='left')
+    cdf[-1] = 1
+    counts = np.diff(cdf, axis=0) * n
+
+    return {'columns': [str(c) for c in columns], 'n': n, 'n_nan': n_nan,
+            'mean': mean, 'std': std, 'probs': probs, 'quantiles': quantiles,
+            'edges': edges, 'counts': counts}
+
+
+def save_distribution_cache(summary, filename):
+    """
+    Function to save a distribution_summary output in a .npz file (no pickle).
+    :param summary:     distribution_summary output.
+    :param filename:    Output filename (.npz).
+    """
+    meta = {'format_version': DISTRIBUTIONS_VERSION,
+            'brainccpy_version': __version__,
+            'columns': summary['columns']}
+    arrays = {k: v for k, v in summary.items() if k != 'columns'}
+    np.savez_compressed(filename, meta=np.array(json.dumps(meta)), **arrays)
+
+
+def load_distribution_cache(filename):
+    """
+    Function to load a distribution summary saved with save_distribution_cache.
+    :param filename:    Cache filename (.npz).
+    :return:            Dictionary (see distribution_summary).
+    """
+    with np.load(filename, allow_pickle=False) as f:
+        meta = json.loads(str(f['meta']))
+        if meta['format_version'] > DISTRIBUTIONS_VERSION:
+            raise ValueError(f'Cache format version {meta["format_version"]} is not '
+                             f'supported by this version of brainccpy '
+                             f'(<= {DISTRIBUTIONS_VERSION}).')
+        summary = {k: f[k] for k in f.files if k != 'meta'}
+    summary['columns'] = meta['columns']
+
+    return summary
+
+
+def plot_distribution_pages(summary, per_page=30, style='ridge', overlap=1.5,
+                            ncols=6, palette='Spectral'):
+    """
+    Generator of figures showing the cached histograms of every column,
+    per_page columns at a time, as ridge plots (stacked and overlapping
+    densities, joyplot-like) or small multiples. Only the summary is used, so
+    figures can be re-styled without reading the data again. Columns without
+    any value (only NaNs) are listed with their NaN count and not drawn.
+    :param summary:     distribution_summary or load_distribution_cache output.
+    :param per_page:    Number of columns per figure.
+    :param style:       'ridge' or 'grid'.
+    :param overlap:     Height of each ridge relative to the spacing (ridge).
+    :param ncols:       Number of columns of subplots (grid).
+    :param palette:     Seaborn palette.
+    :return:            Matplotlib figures.
+    """
+    if style not in ['ridge', 'grid']:
+        raise ValueError("style should be either 'ridge' or 'grid'.")
+
+    columns = summary['columns']
+    for start in range(0, len(columns), per_page):
+        idx = np.arange(start, min(start + per_page, len(columns)))
+        colors = sns.color_palette(palette, len(idx))
+        edges = summary['edges'][:, idx]
+        empty = np.asarray(summary['n'])[idx] == 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            density = np.nan_to_num(summary['counts'][:, idx] / np.diff(edges, axis=0))
+        peak = np.maximum(density.max(axis=0), np.finfo(float).tiny)
+
+        if style == 'ridge':
+            fig, ax = plt.subplots(figsize=(8, 0.35 * len(idx) + 1))
+            # Each ridge is drawn on its own axis span so columns with
+            # different ranges can share the figure.
+            for j in range(len(idx))[::-1]:
+                y = len(idx) - 1 - j
+                if empty[j]:
+                    ax.text(-0.01, y, f'{columns[idx[j]]} [no values, NaN: '
+                                      f'{int(summary["n_nan"][idx[j]])}]',
+                            ha='right', va='bottom', fontsize=6)
+                    continue
+                x = (edges[:, j] - edges[0, j]) / max(edges[-1, j] - edges[0, j],
+                                                     np.finfo(float).eps)
+                h = np.append(density[:, j], 0) / peak[j] * overlap
+                ax.fill_between(x, y, y + h, step='post', color=colors[j],
+                                edgecolor='black', linewidth=0.3)
+                ax.text(-0.01, y, f'{columns[idx[j]]} '
+                                  f'[{edges[0, j]:.3g}, {edges[-1, j]:.3g}]',
+                        ha='right', va='bottom', fontsize=6)
+            ax.set_xlim(0, 1)
+            ax.set_ylim(-0.2, len(idx) - 1 + overlap + 0.2)
+            ax.set_xticks([0, 1], labels=['min', 'max'])
+            ax.set_yticks([])
+            for side in ['left', 'right', 'top']:
+                ax.spines[side].set_visible(False)
+        else:
+            nrows = -(-len(idx) // ncols)
+            fig, axes = plt.subplots(nrows, ncols, figsize=(2.2 * ncols, 1.6 * nrows),
+                                     squeeze=False)
+            for j, ax in enumerate(axes.ravel()):
+                if j >= len(idx):
+                    ax.set_axis_off()
+                    continue
+                if empty[j]:
+                    ax.set_title(str(columns[idx[j]]), fontsize=7)
+                    ax.text(0.5, 0.5, f'NaN: {int(summary["n_nan"][idx[j]])}',
+                            ha='center', va='center', fontsize=7, transform=ax.transAxes)
+                    ax.set_xticks([])
+                    ax.set_yticks([])
+                    continue
+                ax.stairs(summary['counts'][:, idx[j]], edges[:, j], fill=True,
+                          color=colors[j])
+                ax.set_title(f'{columns[idx[j]]} (NaN: {int(summary["n_nan"][idx[j]])})',
+                             fontsize=7)
+                ax.tick_params(labelsize=6)
+        fig.suptitle(f'Variables {idx[0] + 1} to {idx[-1] + 1} of {len(columns)}')
+        fig.tight_layout()
+
+        yield fig
+
+
 def power_transform(df, method):
     """
 
@@ -84,15 +546,90 @@ def standard_scale(df):
     return out
 
 
-def visualize_clustering(df, output, method='PCA', perplexity=30):
+def plot_cluster_counts(labels, output, fmt='pdf'):
     """
-
-    :param df:
-    :param method:
-    :param perplexity:
-    :param output:
-    :return:
+    Function to plot the number of samples per cluster (counted with
+    np.bincount, HDBSCAN noise labelled -1 is shown first).
+    :param labels:  Cluster labels.
+    :param output:  Output folder.
+    :param fmt:     Output format ('pdf', 'png' or 'svg').
+    """
+    labels = np.asarray(labels, dtype=int)
+    offset = -min(labels.min(), 0)
+    counts = np.bincount(labels + offset)
+    present = np.flatnonzero(counts)
+    colors = sns.color_palette('Spectral', len(present))
+
+    fig, ax = plt.subplots()
+    ax.bar(np.arange(len(present)), counts[present], color=colors)
+    ax.set_xticks(np.arange(len(present)), labels=present - offset)
+    ax.set(title='Number of samples per clusters.', xlabel='Clusters',
+           ylabel='Nb of samples')
+    fig.savefig(f'{output}/count_plot.{fmt}', format=fmt)
+    plt.close(fig)
+
+
+def _scatter_clusters(ax, x, y, labels, render='scatter', bins=300):
+    """
+    Draw samples coloured by cluster. 'scatter' draws one vector marker per
+    sample, 'raster' draws the same markers as an embedded image and
+    'density' aggregates samples into 2D bins (1D histograms if y is None)
+    coloured by the mean colour of the clusters in each bin, so the size of
+    the figure does not depend on the number of samples.
+    """
+    clusters, inverse = np.unique(labels, return_inverse=True)
+    colors = np.array(sns.color_palette('Spectral', len(clusters)))
+    handles = [Line2D([], [], marker='.', color=colors[i], markersize=15, linestyle='None')
+               for i in range(len(clusters))]
+
+    if render == 'density' and y is None:
+        edges = np.histogram_bin_edges(x, bins=bins)
+        for i in range(len(clusters)):
+            counts, _ = np.histogram(x[inverse == i], bins=edges)
+            ax.stairs(counts, edges, color=colors[i], fill=True, alpha=0.5)
+    elif render == 'density':
+        xedges = np.histogram_bin_edges(x, bins=bins)
+        yedges = np.histogram_bin_edges(y, bins=bins)
+        counts = np.stack([np.histogram2d(x[inverse == i], y[inverse == i],
+                                          bins=[xedges, yedges])[0]
+                           for i in range(len(clusters))])
+        total = counts.sum(axis=0)
+        image = np.zeros(total.shape + (4,))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            image[..., :3] = np.nan_to_num(np.einsum('kij,kc->ijc', counts, colors) /
+                                           total[..., None])
+        image[..., 3] = np.log1p(total) / np.log1p(total.max())
+        ax.imshow(image.transpose(1, 0, 2), origin='lower', aspect='auto',
+                  interpolation='nearest',
+                  extent=(xedges[0], xedges[-1], yedges[0], yedges[-1]))
+    else:
+        ax.scatter(x, np.zeros_like(x) if y is None else y, c=colors[inverse], s=20,
+                   edgecolors='white', linewidths=0.5, rasterized=render == 'raster')
+
+    ax.legend(handles=handles, labels=[str(c) for c in clusters], title='Cluster',
+              loc='best', prop={'size': 8})
+
+
+def visualize_clustering(df, output, method='PCA', perplexity=30, render='auto',
+                         fmt='pdf', bins=300):
+    """
+    Function to plot the number of samples per cluster and the 1D, 2D and 3D
+    embeddings of the data coloured by cluster.
+    :param df:          Pandas dataframe containing a Cluster column.
+    :param output:      Output folder.
+    :param method:      Embedding method ('PCA' or 'TSNE').
+    :param perplexity:  Perplexity of TSNE.
+    :param render:      'scatter' (one vector marker per sample), 'raster'
+                        (markers embedded as an image), 'density' (samples
+                        aggregated in bins) or 'auto' (scatter up to 10000
+                        samples, raster above). With 'raster' and 'density',
+                        the size of the figures does not depend on the
+                        number of samples.
+    :param fmt:         Output format of the figures ('pdf', 'png' or 'svg').
+    :param bins:        Number of bins per axis if render is 'density'.
     """
+    if render == 'auto':
+        render = 'scatter' if len(df) <= 10000 else 'raster'
 
     if method == 'PCA':
         m_1d = PCA(n_components=1)
@@ -114,39 +651,23 @@ def visualize_clustering(df, output, method='PCA', perplexity=30):
     PCs_3d.columns = ["PC1_3d", "PC2_3d", "PC3_3d"]
 
     PC_df = pd.concat([PCs_1d, PCs_2d, PCs_3d, df['Cluster']], axis=1, join='inner')
-    PC_df['dummy'] = 0
+    labels = PC_df['Cluster'].to_numpy()
 
     # Plotting results.
-    sns.countplot(data=PC_df, x='Cluster', palette='Spectral',
-                  ).set(title='Number of samples per clusters.',
-                        xlabel='Clusters', ylabel='Nb of samples')
-    plt.savefig(f'{output}/count_plot.pdf', type='pdf')
-    plt.cla()
-    plt.clf()
-
-    sns.scatterplot(data=PC_df,
-                    x='PC1_1d',
-                    y='dummy',
-                    hue='Cluster',
-                    legend='full',
-                    palette='Spectral',
-                    ).set(title='1D representation of clustering algorithm.',
-                          xlabel='PC1', ylabel='')
-    plt.savefig(f'{output}/1d_results.pdf', type='pdf')
-    plt.cla()
-    plt.clf()
-
-    sns.scatterplot(data=PC_df,
-                    x='PC1_2d',
-                    y='PC2_2d',
-                    hue='Cluster',
-                    legend='full',
-                    palette='Spectral',
-                    ).set(title='2D representation of clustering algorithm.',
-                          xlabel='PC1', ylabel='PC2')
-    plt.savefig(f'{output}/2d_results.pdf', type='pdf')
-    plt.cla()
-    plt.clf()
+    plot_cluster_counts(labels, output, fmt=fmt)
+
+    fig, ax = plt.subplots()
+    _scatter_clusters(ax, PC_df['PC1_1d'].to_numpy(), None, labels, render, bins)
+    ax.set(title='1D representation of clustering algorithm.', xlabel='PC1', ylabel='')
+    fig.savefig(f'{output}/1d_results.{fmt}', format=fmt)
+    plt.close(fig)
+
+    fig, ax = plt.subplots()
+    _scatter_clusters(ax, PC_df['PC1_2d'].to_numpy(), PC_df['PC2_2d'].to_numpy(),
+                      labels, render, bins)
+    ax.set(title='2D representation of clustering algorithm.', xlabel='PC1', ylabel='PC2')
+    fig.savefig(f'{output}/2d_results.{fmt}', format=fmt)
+    plt.close(fig)
 
     sns.set(style='darkgrid')
     fig = plt.figure()
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+
+import logging
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from scipy.sparse.csgraph import shortest_path
+from brainccpy.io.utils import load_matrix_stack
+
+
+def _prepare(stack):
+    """
+    Symmetric, non-negative, zero-diagonal copy of a stack of matrices,
+    with weights normalized by the maximal weight of each subject.
+    """
+    stack = np.abs(np.asarray(stack, dtype=np.float64))
+    if stack.ndim == 2:
+        stack = stack[None]
+    stack = np.maximum(stack, np.swapaxes(stack, 1, 2))
+    idx = np.arange(stack.shape[1])
+    stack[:, idx, idx] = 0
+    vmax = stack.max(axis=(1, 2), keepdims=True)
+    stack /= np.where(vmax > 0, vmax, 1)
+
+    return stack
+
+
+def node_degree(stack):
+    """
+    Function to compute the degree of every node.
+    :param stack:   Connectivity matrices (n_subjects, N, N).
+    :return:        Degrees (n_subjects, N).
+    """
+    return (_prepare(stack) > 0).sum(axis=2)
+
+
+def node_strength(stack):
+    """
+    Function to compute the strength (sum of normalized weights) of every node.
+    :param stack:   Connectivity matrices (n_subjects, N, N).
+    :return:        Strengths (n_subjects, N).
+    """
+    return _prepare(stack).sum(axis=2)
+
+
+def clustering_coefficient(stack):
+    """
+    Function to compute the weighted clustering coefficient (Onnela et al.,
+    2005) of every node, as in bctpy's clustering_coef_wu. Triangles are
+    counted for all subjects at once with batched matrix products.
+    :param stack:   Connectivity matrices (n_subjects, N, N).
+    :return:        Clustering coefficients (n_subjects, N).
+    """
+    return _clustering_coefficient(_prepare(stack))
+
+
+def _clustering_coefficient(w):
+    k = (w > 0).sum(axis=2).astype(float)
+    cube = np.cbrt(w)
+    cyc3 = np.einsum('sij,sij->si', cube @ cube, cube)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cc = np.where(k > 1, cyc3 / (k * (k - 1)), 0)
+
+    return cc
+
+
+def global_efficiency(stack):
+    """
+    Function to compute the weighted global efficiency of every subject, using
+    the inverse of normalized weights as lengths.
+    :param stack:   Connectivity matrices (n_subjects, N, N).
+    :return:        Global efficiencies (n_subjects,).
+    """
+    return _global_efficiency(_prepare(stack))
+
+
+def _global_efficiency(w):
+    n = w.shape[1]
+    eff = np.empty(w.shape[0])
+    for s in range(w.shape[0]):
+        with np.errstate(divide='ignore'):
+            lengths = np.where(w[s] > 0, 1 / w[s], 0)
+        dist = shortest_path(lengths, method='auto', directed=False)
+        with np.errstate(divide='ignore'):
+            inv = 1 / dist
+        inv[~np.isfinite(inv)] = 0
+        eff[s] = inv.sum() / (n * (n - 1))
+
+    return eff
+
+
+def _modularity_matrix(w):
+    k = w.sum(axis=1)
+    two_m = k.sum()
+    return w - np.outer(k, k) / two_m, two_m
+
+
+def _leading_eigenvector(w):
+    """
+    Newman (2006) spectral modularity maximization by repeated bisection with
+    the leading eigenvector of the generalized modularity matrix.
+    """
+    n = w.shape[0]
+    if w.sum() == 0:
+        return np.zeros(n, dtype=int)
+
+    b, _ = _modularity_matrix(w)
+    labels = np.zeros(n, dtype=int)
+    pending = [np.arange(n)]
+    n_comm = 1
+    while pending:
+        g = pending.pop()
+        if len(g) < 2:
+            continue
+        bg = b[np.ix_(g, g)]
+        bg = bg - np.diag(bg.sum(axis=1))
+        vals, vecs = np.linalg.eigh(bg)
+        if vals[-1] <= 1e-10:
+            continue
+        s = np.where(vecs[:, -1] >= 0, 1, -1)
+        if np.all(s == s[0]) or s @ bg @ s <= 1e-10:
+            continue
+        labels[g[s < 0]] = n_comm
+        n_comm += 1
+        pending.extend([g[s > 0], g[s < 0]])
+
+    return labels
+
+
+def modularity(stack, communities=None):
+    """
+    Function to compute the modularity of every subject. If no partition is
+    provided, communities are found per subject with Newman's leading
+    eigenvector method.
+    :param stack:           Connectivity matrices (n_subjects, N, N).
+    :param communities:     Optional node labels (N,) shared by all subjects
+                            (ex: atlas networks).
+    :return:                Modularity (n_subjects,) and community labels
+                            (n_subjects, N).
+    """
+    return _modularity(_prepare(stack), communities)
+
+
+def _modularity(w, communities=None):
+    n_sub, n = w.shape[:2]
+
+    if communities is None:
+        labels = np.array([_leading_eigenvector(w[s]) for s in range(n_sub)])
+    else:
+        labels = np.tile(np.asarray(communities), (n_sub, 1))
+
+    q = np.zeros(n_sub)
+    k = w.sum(axis=2)
+    two_m = k.sum(axis=1)
+    for s in range(n_sub):
+        if two_m[s] == 0:
+            continue
+        onehot = np.eye(labels[s].max() + 1)[labels[s]]
+        within = np.trace(onehot.T @ w[s] @ onehot)
+        expected = ((onehot.T @ k[s]) ** 2).sum() / two_m[s]
+        q[s] = (within - expected) / two_m[s]
+
+    return q, labels
+
+
+def graph_metrics(stack, nodal=False, communities=None):
+    """
+    Function to compute graph-theory metrics for a stack of matrices. The
+    stack is prepared (symmetrized and normalized) once for all metrics.
+    :param stack:           Connectivity matrices (n_subjects, N, N).
+    :param nodal:           If True, node-wise degree, strength and clustering
+                            coefficient are also returned.
+    :param communities:     Optional node labels used for the modularity.
+    :return:                Pandas dataframe (one row per subject).
+    """
+    w = _prepare(stack)
+    n = w.shape[1]
+
+    degree = (w > 0).sum(axis=2)
+    strength = w.sum(axis=2)
+    cc = _clustering_coefficient(w)
+    q, _ = _modularity(w, communities)
+
+    out = {
+        'density': degree.sum(axis=1) / (n * (n - 1)),
+        'mean_degree': degree.mean(axis=1),
+        'mean_strength': strength.mean(axis=1),
+        'mean_clustering': cc.mean(axis=1),
+        'global_efficiency': _global_efficiency(w),
+        'modularity': q,
+    }
+    if nodal:
+        for name, values in [('degree', degree), ('strength', strength),
+                             ('clustering', cc)]:
+            for i in range(n):
+                out[f'{name}_{i + 1}'] = values[:, i]
+
+    return pd.DataFrame(out)
+
+
+def _chunk_graph_metrics(paths, nodal, communities):
+    # Each worker reads its own chunk of matrices.
+    return graph_metrics(load_matrix_stack(paths), nodal, communities)
+
+
+def cohort_graph_metrics(paths, ids, chunk_size=32, n_jobs=1, nodal=False,
+                         communities=None):
+    """
+    Function to compute graph-theory metrics for a cohort. Subjects are
+    processed by chunks, which are spread across processes. Each process
+    loads its own chunk, so reading is parallel and only paths are sent to
+    the workers.
+    :param paths:           List of matrices filenames (.npy).
+    :param ids:             Subjects IDs (same order as paths).
+    :param chunk_size:      Number of subjects per chunk.
+    :param n_jobs:          Number of processes.
+    :param nodal:           If True, node-wise metrics are also computed.
+    :param communities:     Optional node labels used for the modularity.
+    :return:                Pandas dataframe with an 'IDs' column followed by
+                            the metrics (usable as kmeans_clustering.py input).
+    """
+    chunks = [paths[i:i + chunk_size] for i in range(0, len(paths), chunk_size)]
+    logging.info(f'Computing graph metrics for {len(paths)} subjects '
+                 f'in {len(chunks)} chunks.')
+    tables = Parallel(n_jobs=n_jobs)(
+        delayed(_chunk_graph_metrics)(chunk, nodal, communities)
+        for chunk in chunks)
+
+    df = pd.concat(tables, ignore_index=True)
+    df.insert(0, 'IDs', list(ids))
+
+    return df
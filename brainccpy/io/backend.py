@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+import contextlib
+import logging
+import os
+
+import numpy as np
+from brainccpy.io.manifest import npy_header
+from brainccpy.io.utils import load_matrix_stack
+
+BACKENDS = ['numpy', 'dask']
+
+# Default backend, can be set with the BRAINCCPY_BACKEND environment variable.
+_BACKEND = os.environ.get('BRAINCCPY_BACKEND', 'numpy')
+
+
+def _import_dask():
+    try:
+        import dask
+        import dask.array
+    except ImportError:
+        raise ImportError('dask is required for the dask backend '
+                          '(pip install "dask[distributed]").')
+    return dask
+
+
+def set_backend(name):
+    """
+    Function to select the backend used to hold cohort stacks.
+    :param name:    'numpy' (stacks loaded in memory) or 'dask' (chunked
+                    arrays read lazily from the per-subject files).
+    """
+    global _BACKEND
+    if name not in BACKENDS:
+        raise ValueError(f'backend should be one of {BACKENDS}.')
+    if name == 'dask':
+        _import_dask()
+    _BACKEND = name
+
+
+def get_backend():
+    """
+    Function to get the current backend name.
+    :return:    'numpy' or 'dask'.
+    """
+    return _BACKEND
+
+
+def is_lazy(array):
+    """
+    Function to check if an array is a dask array (results need compute()).
+    """
+    return type(array).__module__.startswith('dask')
+
+
+def compute(*arrays):
+    """
+    Function to evaluate arrays produced by either backend.
+    :param arrays:  Numpy or dask arrays.
+    :return:        Numpy array (tuple if several arrays are given).
+    """
+    if any(is_lazy(a) for a in arrays):
+        dask = _import_dask()
+        arrays = dask.compute(*arrays)
+    arrays = tuple(np.asarray(a) for a in arrays)
+
+    return arrays[0] if len(arrays) == 1 else arrays
+
+
+def load_stack(paths, dtype=None, subjects_per_chunk=16, backend=None):
+    """
+    Function to build the stack of a cohort of connectivity matrices.
+    With the dask backend, every subject is a delayed np.load (shape and dtype
+    are read from the .npy headers) and subjects are grouped in chunks, so the
+    cohort is never loaded at once and reductions run as a task graph.
+    :param paths:               List of matrices filenames (.npy only with
+                                the dask backend).
+    :param dtype:               Dtype of the stack. If None, the dtype on
+                                disk is kept.
+    :param subjects_per_chunk:  Number of subjects per dask chunk.
+    :param backend:             'numpy' or 'dask'. If None, get_backend().
+    :return:                    Array of shape (n_subjects, N, N).
+    """
+    backend = backend or get_backend()
+    if backend == 'numpy':
+        return load_matrix_stack(paths, dtype=dtype)
+    if backend != 'dask':
+        raise ValueError(f'backend should be one of {BACKENDS}.')
+
+    dask = _import_dask()
+    others = [path for path in paths if not path.endswith('.npy')]
+    if others:
+        raise ValueError(f'The dask backend only reads .npy matrices: {others[:5]}.')
+    shape, disk_dtype = npy_header(paths[0])
+    dtype = np.dtype(dtype or disk_dtype)
+
+    def load(path):
+        return np.load(path).astype(dtype, copy=False)
+
+    subjects = [dask.array.from_delayed(dask.delayed(load)(path), shape=tuple(shape),
+                                        dtype=dtype)
+                for path in paths]
+    stack = dask.array.stack(subjects)
+
+    return stack.rechunk((subjects_per_chunk,) + tuple(shape))
+
+
+def edge_values(stack, rows, cols):
+    """
+    Function to extract connections from every matrix of a stack.
+    :param stack:   Stack (n_subjects, N, N), numpy or dask.
+    :param rows:    Row indices of the connections.
+    :param cols:    Column indices of the connections.
+    :return:        Array (n_subjects, n_edges), lazy with the dask backend.
+    """
+    n_nodes = stack.shape[-1]
+    # Single-axis indexing of the flattened matrices is supported by dask.
+    flat = stack.reshape(stack.shape[0], n_nodes * n_nodes)
+
+    return flat[:, np.asarray(rows) * n_nodes + np.asarray(cols)]
+
+
+def cluster_means(stack, indices):
+    """
+    Function to compute the mean value of each cluster of connections for
+    every subject (accumulated in float64).
+    :param stack:   Stack (n_subjects, N, N), numpy or dask.
+    :param indices: Dictionary of clusters (clusters_to_indices output).
+    :return:        Array (n_subjects, n_clusters), lazy with the dask backend.
+    """
+    columns = [edge_values(stack, rows, cols).mean(axis=1, dtype=np.float64)
+               for rows, cols in indices.values()]
+    if is_lazy(stack):
+        return _import_dask().array.stack(columns, axis=1)
+
+    return np.stack(columns, axis=1)
+
+
+def matrices_density(stack):
+    """
+    Function to compute the density (percentage of connections equal to 1) of
+    every binary matrix of a stack.
+    :param stack:   Stack (n_subjects, N, N), numpy or dask.
+    :return:        Density values in % (n_subjects,).
+    """
+    return (stack == 1).mean(axis=(1, 2)) * 100
+
+
+def edge_moments(stack):
+    """
+    Function to compute the mean and standard deviation of every connection
+    across subjects.
+    :param stack:   Stack (n_subjects, N, N), numpy or dask.
+    :return:        Mean and standard deviation matrices (N x N).
+    """
+    mean = stack.mean(axis=0, dtype=np.float64)
+    std = stack.std(axis=0, dtype=np.float64)
+
+    return mean, std
+
+
+@contextlib.contextmanager
+def local_cluster(n_workers=None, threads_per_worker=1, processes=False,
+                  memory_limit='auto', joblib=True):
+    """
+    Context manager starting a dask LocalCluster and selecting the dask
+    backend. With processes=False, workers are threads communicating in
+    memory (no network); with processes=True, each worker is a separate
+    process (loopback only). If joblib is True, joblib's Parallel calls
+    (bootstrap, permutations, etc.) are also dispatched on the cluster.
+    :param n_workers:           Number of workers. If None, one per core.
+    :param threads_per_worker:  Number of threads per worker.
+    :param processes:           Use processes instead of threads.
+    :param memory_limit:        Memory limit of each worker.
+    :param joblib:              Dispatch joblib's Parallel on the cluster.
+    :return:                    dask.distributed Client.
+    """
+    _import_dask()
+    try:
+        from dask.distributed import Client, LocalCluster
+    except ImportError:
+        raise ImportError('dask.distributed is required to start a local cluster '
+                          '(pip install "dask[distributed]").')
+
+    previous = get_backend()
+    cluster = LocalCluster(n_workers=n_workers or os.cpu_count(),
+                           threads_per_worker=threads_per_worker, processes=processes,
+                           memory_limit=memory_limit, dashboard_address=None)
+    client = Client(cluster)
+    logging.info(f'Started a dask cluster with {len(cluster.workers)} workers.')
+    set_backend('dask')
+    try:
+        if joblib:
+            from joblib import parallel_backend
+            with parallel_backend('dask'):
+                yield client
+        else:
+            yield client
+    finally:
+        set_backend(previous)
+        client.close()
+        cluster.close()
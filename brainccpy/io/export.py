@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+
+import logging
+
+import numpy as np
+import pandas as pd
+from brainccpy.io.utils import upper_triangle_edges
+
+
+def edge_names(rows, cols):
+    """
+    Function to build the column names (X_Y, 1-based) of connections.
+    :param rows:    Row indices (0-based).
+    :param cols:    Column indices (0-based).
+    :return:        List of names.
+    """
+    return [f'{r + 1}_{c + 1}' for r, c in zip(rows.tolist(), cols.tolist())]
+
+
+def matrix_from_edges(values, names, n_nodes=None):
+    """
+    Function to put values of named connections (X_Y, 1-based) back into a
+    matrix. Values are written in the upper triangle only.
+    :param values:  Values of each connection.
+    :param names:   Connection names (X_Y).
+    :param n_nodes: Size of the matrix. If None, the highest node index.
+    :return:        Matrix (N x N).
+    """
+    pairs = np.array([name.split('_') for name in names], dtype=int) - 1
+    rows, cols = pairs.min(axis=1), pairs.max(axis=1)
+    n_nodes = n_nodes or int(pairs.max()) + 1
+    mat = np.zeros((n_nodes, n_nodes))
+    mat[rows, cols] = values
+
+    return mat
+
+
+def edges_from_mask(mask):
+    """
+    Function to get the upper triangle connections selected by a binary mask.
+    :param mask:    Binary matrix (N x N), dense or scipy.sparse.
+    :return:        Row indices, column indices (0-based, row-major order) and
+                    column names (X_Y, 1-based) of the selected connections.
+    """
+    rows, cols = upper_triangle_edges(mask)
+
+    return rows, cols, edge_names(rows, cols)
+
+
+def all_edges(n_nodes):
+    """
+    Function to get every upper triangle connection (diagonal included)
+    without building a mask.
+    :param n_nodes: Number of nodes (N).
+    :return:        Row indices, column indices (0-based, row-major order) and
+                    column names (X_Y, 1-based).
+    """
+    rows, cols = np.triu_indices(n_nodes)
+
+    return rows, cols, edge_names(rows, cols)
+
+
+def nonzero_edges(paths, rows, cols, min_prop=0., chunk_size=100):
+    """
+    Function to select, in one streaming pass over the cohort, the connections
+    that are non-zero in enough subjects.
+    :param paths:       List of matrices filenames (.npy).
+    :param rows:        Row indices of the candidate connections.
+    :param cols:        Column indices of the candidate connections.
+    :param min_prop:    Minimal proportion of subjects (0-1) in which a
+                        connection must be non-zero. If 0, connections non-zero
+                        in at least one subject are kept.
+    :param chunk_size:  Number of subjects per chunk.
+    :return:            Row indices, column indices and column names of the
+                        kept connections.
+    """
+    counts = np.zeros(len(rows), dtype=np.int64)
+    for _, values in iter_edge_chunks(paths, rows, cols, chunk_size=chunk_size):
+        counts += np.count_nonzero(values, axis=0)
+
+    keep = counts >= max(np.ceil(min_prop * len(paths)), 1)
+    rows, cols = rows[keep], cols[keep]
+    logging.info(f'{len(rows)} connections kept out of {len(keep)}.')
+
+    return rows, cols, edge_names(rows, cols)
+
+
+def iter_edge_chunks(paths, rows, cols, chunk_size=100, dtype=None):
+    """
+    Generator extracting the selected connections of every matrix, one chunk
+    of subjects at a time, so that memory is capped at a single chunk.
+    :param paths:       List of matrices filenames (.npy).
+    :param rows:        Row indices of the connections to extract.
+    :param cols:        Column indices of the connections to extract.
+    :param chunk_size:  Number of subjects per chunk.
+    :param dtype:       Output dtype. If None, the dtype on disk is kept.
+    :return:            Yields (start, values) where values is an array of
+                        shape (n_subjects_in_chunk, n_edges).
+    """
+    for start in range(0, len(paths), chunk_size):
+        chunk = paths[start:start + chunk_size]
+        values = None
+        for i, path in enumerate(chunk):
+            mat = np.load(path, mmap_mode='r')
+            if values is None:
+                values = np.empty((len(chunk), len(rows)), dtype=dtype or mat.dtype)
+            values[i] = mat[rows, cols]
+        logging.info(f'Extracted subjects {start + 1} to {start + len(chunk)}.')
+        yield start, values
+
+
+class EdgeTableWriter(object):
+    """
+    Incremental writer for subjects x connections tables. Chunks are appended
+    to a csv file or written as row groups of a parquet file.
+    :param output:      Output filename (.csv or .parquet).
+    :param columns:     Connection names (X_Y).
+    :param fmt:         'csv' or 'parquet'.
+    :param long:        If True, writes a long (IDs, Edge, Value) table
+                        containing only non-zero connections.
+    :param append:      If True, chunks are appended to an existing csv file.
+    """
+
+    def __init__(self, output, columns, fmt='csv', long=False, append=False):
+        if fmt not in ['csv', 'parquet']:
+            raise ValueError("fmt should be either 'csv' or 'parquet'.")
+        if append and fmt != 'csv':
+            raise ValueError('Only csv tables can be appended to.')
+
+        self.output = output
+        self.columns = np.asarray(columns)
+        self.fmt = fmt
+        self.long = long
+        self._writer = None
+        self._header = not append
+
+        if fmt == 'parquet':
+            try:
+                import pyarrow
+                import pyarrow.parquet
+            except ImportError:
+                raise ImportError('pyarrow is required to write parquet files.')
+            self._pa = pyarrow
+            self._pq = pyarrow.parquet
+
+    def _frame(self, ids, values):
+        if self.long:
+            s, e = np.nonzero(values)
+            return pd.DataFrame({'IDs': np.asarray(ids, dtype=object)[s],
+                                 'Edge': self.columns[e],
+                                 'Value': values[s, e]})
+
+        df = pd.DataFrame(values, columns=self.columns)
+        df.insert(0, 'IDs', ids)
+        return df
+
+    def write(self, ids, values):
+        """
+        Write a chunk of subjects.
+        :param ids:     Subjects IDs of the chunk.
+        :param values:  Array of shape (len(ids), n_edges).
+        """
+        df = self._frame(ids, values)
+
+        if self.fmt == 'csv':
+            df.to_csv(self.output, mode='w' if self._header else 'a',
+                      header=self._header, index=False)
+        else:
+            table = self._pa.Table.from_pandas(df, preserve_index=False)
+            if self._writer is None:
+                self._writer = self._pq.ParquetWriter(self.output, table.schema)
+            self._writer.write_table(table)
+        self._header = False
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def export_edges(paths, ids, rows, cols, columns, output, chunk_size=100,
+                 fmt='csv', long=False, dtype=None, append=False):
+    """
+    Function to export the selected connections of every matrix in a table,
+    processing subjects in fixed-size chunks.
+    :param paths:       List of matrices filenames (.npy).
+    :param ids:         Subjects IDs (same order as paths).
+    :param rows:        Row indices of the connections to extract.
+    :param cols:        Column indices of the connections to extract.
+    :param columns:     Connection names (X_Y).
+    :param output:      Output filename (.csv or .parquet).
+    :param chunk_size:  Number of subjects per chunk.
+    :param fmt:         'csv' or 'parquet'.
+    :param long:        If True, writes a long table with only non-zero values.
+    :param dtype:       Output dtype. If None, the dtype on disk is kept.
+    :param append:      If True, subjects are appended to an existing csv table.
+    """
+    with EdgeTableWriter(output, columns, fmt=fmt, long=long, append=append) as writer:
+        for start, values in iter_edge_chunks(paths, rows, cols,
+                                              chunk_size=chunk_size, dtype=dtype):
+            writer.write(ids[start:start + len(values)], values)
+
+
+def iter_table_chunks(filename, chunk_size=10000):
+    """
+    Generator reading a table by chunks of rows, so tables larger than memory
+    can be processed in one pass. Excel files cannot be read partially and
+    are yielded as a single chunk.
+    :param filename:    Table filename (.csv, .parquet or .xlsx).
+    :param chunk_size:  Number of rows per chunk.
+    :return:            Pandas dataframes.
+    """
+    if filename.endswith('.csv'):
+        yield from pd.read_csv(filename, chunksize=chunk_size)
+    elif filename.endswith('.parquet'):
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError('pyarrow is required to read parquet files.')
+        for batch in pyarrow.parquet.ParquetFile(filename).iter_batches(chunk_size):
+            yield batch.to_pandas()
+    else:
+        yield pd.read_excel(filename)
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+
+def fingerprint(*items):
+    """
+    Function to compute a fingerprint of the definitions used to build an
+    output (masks, clusters, metrics, options). Arrays are hashed with their
+    shape and dtype, other items through their JSON representation.
+    :param items:   Arrays, strings, lists or dictionaries.
+    :return:        Hexadecimal sha256 digest.
+    """
+    h = hashlib.sha256()
+    for item in items:
+        if isinstance(item, np.ndarray):
+            arr = np.ascontiguousarray(item)
+            h.update(f'{arr.shape}{arr.dtype}'.encode())
+            h.update(arr.tobytes())
+        else:
+            h.update(json.dumps(item, sort_keys=True, default=str).encode())
+
+    return h.hexdigest()
+
+
+def file_signature(paths, use_hash=False):
+    """
+    Function to compute the signature of the input files of a subject.
+    :param paths:       Filename or list of filenames.
+    :param use_hash:    If True, the content is hashed (sha1) instead of using
+                        the modification time and size.
+    :return:            List of signatures (one per file).
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+
+    signatures = []
+    for path in paths:
+        if use_hash:
+            h = hashlib.sha1()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    h.update(block)
+            signatures.append(h.hexdigest())
+        else:
+            st = os.stat(path)
+            signatures.append([st.st_mtime_ns, st.st_size])
+
+    return signatures
+
+
+def state_filename(output):
+    return f'{output}.state.json'
+
+
+def load_state(output):
+    """
+    Function to load the incremental state stored next to an output.
+    :param output:  Output filename.
+    :return:        State dictionary or None if the output or its state is missing.
+    """
+    if not (os.path.isfile(output) and os.path.isfile(state_filename(output))):
+        return None
+
+    with open(state_filename(output)) as f:
+        return json.load(f)
+
+
+def save_state(output, fprint, signatures):
+    """
+    Function to save the incremental state of an output.
+    :param output:      Output filename.
+    :param fprint:      Fingerprint of the definitions (see fingerprint).
+    :param signatures:  Dictionary of signatures per subject ID.
+    """
+    # Written to a temporary file then renamed, so an interrupted run never
+    # leaves a truncated state.
+    tmp = f'{state_filename(output)}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'fingerprint': fprint, 'subjects': signatures}, f)
+    os.replace(tmp, state_filename(output))
+
+
+def plan_update(state, ids, signatures, fprint):
+    """
+    Function to find the subjects to (re)compute.
+    :param state:       State of the existing output (load_state) or None.
+    :param ids:         Subjects IDs.
+    :param signatures:  Current signature of each subject (same order as ids).
+    :param fprint:      Fingerprint of the current definitions.
+    :return:            Indices of the subjects to compute and IDs of subjects
+                        already in the output that have changed.
+    """
+    if state is None:
+        return list(range(len(ids))), []
+
+    if state['fingerprint'] != fprint:
+        raise ValueError('Existing output was built with different definitions '
+                         '(mask, clusters, metrics or options). Use a new output '
+                         'or disable the incremental mode.')
+
+    todo, changed = [], []
+    for i, (sub, sig) in enumerate(zip(ids, signatures)):
+        previous = state['subjects'].get(str(sub))
+        if previous is None:
+            todo.append(i)
+        elif previous != sig:
+            todo.append(i)
+            changed.append(str(sub))
+    logging.info(f'{len(todo)} subjects to compute ({len(changed)} changed).')
+
+    return todo, changed
+
+
+def drop_rows_csv(filename, ids, chunk_size=1000):
+    """
+    Function to remove the rows of some subjects from a csv table (first
+    column containing the IDs), reading it by chunks. The table is only
+    rewritten if one of the subjects is present.
+    :param filename:    Csv filename.
+    :param ids:         IDs of the subjects to remove.
+    :param chunk_size:  Number of rows read at once.
+    """
+    ids = set(str(i) for i in ids)
+    id_col = pd.read_csv(filename, nrows=0).columns[0]
+    if not ids.intersection(pd.read_csv(filename, usecols=[id_col],
+                                        dtype={id_col: str})[id_col]):
+        return
+    tmp = f'{filename}.tmp'
+    header = True
+    for chunk in pd.read_csv(filename, chunksize=chunk_size, dtype={id_col: str},
+                             float_precision='round_trip'):
+        chunk = chunk[~chunk[id_col].isin(ids)]
+        chunk.to_csv(tmp, mode='w' if header else 'a', header=header, index=False)
+        header = False
+    os.replace(tmp, filename)
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+MANIFEST_VERSION = 2
+MANIFEST_NAME = '.brainccpy_manifest.json'
+CONNECTIVITY_DIR = 'Compute_Connectivity'
+
+
+def npy_header(path):
+    """
+    Function to read the shape and dtype of a .npy file from its header only.
+    :param path:    Filename (.npy).
+    :return:        Shape (list) and dtype (str).
+    """
+    with open(path, 'rb') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, _, dtype = np.lib.format.read_array_header_2_0(f)
+
+    return list(shape), dtype.str
+
+
+def _scan_subject(root, sub, previous):
+    """
+    Scan the connectivity folder of a subject. Files whose size and mtime are
+    unchanged keep their previous header, others are read again (this also
+    detects files overwritten in place, which do not change the folder mtime).
+    """
+    folder = os.path.join(root, sub, CONNECTIVITY_DIR)
+    old = previous['metrics'] if previous is not None else {}
+    metrics = {}
+    try:
+        with os.scandir(folder) as it:
+            for entry in it:
+                if not (entry.name.endswith('.npy') and entry.is_file()):
+                    continue
+                st = entry.stat()
+                metric = entry.name[:-4]
+                prev = old.get(metric)
+                if prev is not None and prev[0] == st.st_size and prev[1] == st.st_mtime_ns:
+                    metrics[metric] = prev
+                else:
+                    shape, dtype = npy_header(entry.path)
+                    metrics[metric] = [st.st_size, st.st_mtime_ns, shape, dtype]
+    except FileNotFoundError:
+        return sub, None
+
+    return sub, {'metrics': metrics}
+
+
+def manifest_filename(root):
+    return os.path.join(root, MANIFEST_NAME)
+
+
+def load_manifest(filename):
+    """
+    Function to load a manifest index.
+    :param filename:    Manifest filename (.json).
+    :return:            Manifest dictionary or None if missing, unreadable or
+                        outdated (it is then rebuilt).
+    """
+    if not os.path.isfile(filename):
+        return None
+
+    try:
+        with open(filename) as f:
+            manifest = json.load(f)
+    except ValueError:
+        logging.warning(f'Manifest {filename} is corrupted, it will be rebuilt.')
+        return None
+
+    if not isinstance(manifest, dict) or manifest.get('version') != MANIFEST_VERSION:
+        return None
+
+    return manifest
+
+
+def _save_manifest(manifest, filename):
+    # The index is shared by every job reading the connectoflow output: it is
+    # written to a temporary file of the same folder and renamed, so readers
+    # never see a partial file and an interrupted job leaves the old index.
+    # The temporary name is unique across jobs (and hosts).
+    tmp = f'{filename}.{uuid.uuid4().hex}.tmp'
+    try:
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, separators=(',', ':'))
+        os.replace(tmp, filename)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+def build_manifest(root, filename=None, n_jobs=8, subjects=None):
+    """
+    Function to build or refresh the manifest index of a connectoflow output.
+    Subject folders are scanned in parallel and the size and mtime of every
+    file are compared to the previous index: only new or modified files have
+    their header read again. For every subject and metric, the index stores
+    the file size, mtime, shape and dtype.
+    :param root:        Connectoflow output folder.
+    :param filename:    Manifest filename. Defaults to root/.brainccpy_manifest.json.
+    :param n_jobs:      Number of threads used to scan subjects.
+    :param subjects:    If provided, only these subjects are scanned and the
+                        other entries of the previous index are kept.
+    :return:            Manifest dictionary. It is saved to filename when
+                        possible (a read-only folder only logs a warning).
+    """
+    filename = filename or manifest_filename(root)
+    manifest = load_manifest(filename)
+    if manifest is not None and manifest['root'] != os.path.abspath(root):
+        manifest = None
+    previous = manifest['subjects'] if manifest is not None else {}
+
+    if subjects is None:
+        with os.scandir(root) as it:
+            subjects = sorted(e.name for e in it if e.is_dir() and not e.name.startswith('.'))
+        entries = {}
+    else:
+        entries = {sub: entry for sub, entry in previous.items() if sub not in set(subjects)}
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        scanned = pool.map(lambda sub: _scan_subject(root, sub, previous.get(sub)), subjects)
+        entries.update((sub, entry) for sub, entry in scanned if entry is not None)
+    logging.info(f'Manifest: {len(entries)} subjects ({len(subjects)} scanned).')
+
+    manifest = {'version': MANIFEST_VERSION, 'root': os.path.abspath(root),
+                'subjects': entries}
+    if entries != previous:
+        try:
+            _save_manifest(manifest, filename)
+        except OSError as e:
+            logging.warning(f'Manifest could not be saved ({e}).')
+
+    return manifest
+
+
+def manifest_lookup(manifest, subjects, metrics):
+    """
+    Function to select input files from a manifest.
+    :param manifest:    Manifest dictionary (build_manifest).
+    :param subjects:    Subjects IDs.
+    :param metrics:     Metric names (filename without .npy).
+    :return:            Dictionary {subject: [path per metric]}, dictionary
+                        {metric: set of shapes} and list of missing
+                        (subject, metric) pairs.
+    """
+    root = manifest['root']
+    paths, shapes, missing = {}, {m: set() for m in metrics}, []
+    for sub in subjects:
+        found = manifest['subjects'].get(sub, {}).get('metrics', {})
+        paths[sub] = []
+        for metric in metrics:
+            if metric not in found:
+                missing.append((sub, metric))
+                continue
+            shapes[metric].add(tuple(found[metric][2]))
+            paths[sub].append(os.path.join(root, sub, CONNECTIVITY_DIR, f'{metric}.npy'))
+
+    return paths, shapes, missing
+
+
+def select_connectoflow_inputs(parser, root, subjects, metrics, filename=None,
+                               refresh=False, n_jobs=8):
+    """
+    Function to validate and select the matrices of a connectoflow output
+    through its manifest index, instead of checking every file. The cached
+    index is used as is: it is only built if it does not exist, and only the
+    requested subjects missing from it are scanned. Use refresh after
+    modifying existing matrices (ex: re-running connectoflow).
+    :param parser:      argparse.ArgumentParser object.
+    :param root:        Connectoflow output folder.
+    :param subjects:    Subjects IDs.
+    :param metrics:     Metric names (filename without .npy).
+    :param filename:    Manifest filename (see build_manifest).
+    :param refresh:     If True, every subject folder is scanned again and
+                        file sizes and mtimes are compared to the index.
+    :param n_jobs:      Number of threads used to scan subjects.
+    :return:            Dictionary {subject: [path per metric]}.
+    """
+    if not os.path.isdir(root):
+        parser.error(f'Input folder {root} does not exist.')
+
+    manifest = None if refresh else load_manifest(filename or manifest_filename(root))
+    if manifest is None or manifest['root'] != os.path.abspath(root):
+        manifest = build_manifest(root, filename=filename, n_jobs=n_jobs)
+    paths, shapes, missing = manifest_lookup(manifest, subjects, metrics)
+
+    if missing and not refresh:
+        # New subjects or metrics since the index was built.
+        rescan = sorted(set(sub for sub, _ in missing))
+        manifest = build_manifest(root, filename=filename, n_jobs=n_jobs, subjects=rescan)
+        paths, shapes, missing = manifest_lookup(manifest, subjects, metrics)
+
+    if missing:
+        listed = ', '.join(f'{sub}/{metric}' for sub, metric in missing[:10])
+        parser.error(f'{len(missing)} input matrices do not exist ({listed}'
+                     f'{", ..." if len(missing) > 10 else ""}).')
+    for metric, found in shapes.items():
+        if len(found) > 1:
+            hint = '' if refresh else ' If matrices were modified, use --refresh_manifest.'
+            parser.error(f'Matrices of {metric} have different shapes: {sorted(found)}.{hint}')
+
+    return paths
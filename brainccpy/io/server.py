@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+import socket
+import socketserver
+import stat
+import struct
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from brainccpy.io.backend import cluster_means, edge_values, matrices_density
+from brainccpy.io.incremental import file_signature, fingerprint
+from brainccpy.io.utils import clusters_to_indices, load_matrix_stack
+from brainccpy.version import __version__
+
+PROTOCOL_VERSION = 1
+
+# Messages are a JSON header preceded by its length (4 bytes, big-endian),
+# followed by the raw bytes of the arrays described in header['arrays'].
+_LENGTH = struct.Struct('>I')
+
+
+def default_socket():
+    """
+    Function to get the default socket filename of the cohort server.
+    :return:    BRAINCCPY_SOCKET if set, otherwise a per-user file in the
+                temporary directory.
+    """
+    return os.environ.get('BRAINCCPY_SOCKET',
+                          os.path.join(tempfile.gettempdir(),
+                                       f'brainccpy-{os.getuid()}.sock'))
+
+
+def _recv_exact(sock, size):
+    buf = bytearray(size)
+    view = memoryview(buf)
+    while size:
+        n = sock.recv_into(view[-size:], size)
+        if n == 0:
+            raise ConnectionError('Connection closed by peer.')
+        size -= n
+
+    return buf
+
+
+def send_message(sock, header, arrays=()):
+    """
+    Function to send a message (JSON header and numpy arrays) on a socket.
+    :param sock:    Connected socket.
+    :param header:  JSON serializable dictionary.
+    :param arrays:  Sequence of numpy arrays sent as raw bytes.
+    """
+    arrays = [np.ascontiguousarray(a) for a in arrays]
+    header = dict(header, arrays=[{'dtype': a.dtype.str, 'shape': list(a.shape)}
+                                  for a in arrays])
+    payload = json.dumps(header).encode()
+    sock.sendall(_LENGTH.pack(len(payload)) + payload)
+    for a in arrays:
+        sock.sendall(memoryview(a).cast('B'))
+
+
+def recv_message(sock):
+    """
+    Function to receive a message sent with send_message.
+    :param sock:    Connected socket.
+    :return:        Header dictionary and list of numpy arrays.
+    """
+    size, = _LENGTH.unpack(_recv_exact(sock, _LENGTH.size))
+    header = json.loads(bytes(_recv_exact(sock, size)))
+    arrays = []
+    for spec in header.pop('arrays'):
+        dtype = np.dtype(spec['dtype'])
+        n = int(np.prod(spec['shape'])) * dtype.itemsize
+        arrays.append(np.frombuffer(_recv_exact(sock, n), dtype=dtype).reshape(spec['shape']))
+
+    return header, arrays
+
+
+class Cohort(object):
+    """
+    Cohort of connectivity matrices held by the server, either stacked in
+    memory or memory-mapped (one map per subject).
+    :param paths:   List of matrices filenames (.npy).
+    :param dtype:   Dtype of the stack (None keeps the dtype on disk).
+    :param mmap:    If True, matrices are memory-mapped instead of loaded.
+    """
+
+    def __init__(self, paths, dtype=None, mmap=False):
+        self.paths = list(paths)
+        self.dtype = dtype
+        self.mmap = mmap
+        self.signatures = file_signature(self.paths)
+        if mmap:
+            self.data = [np.load(p, mmap_mode='r') for p in self.paths]
+        else:
+            self.data = load_matrix_stack(self.paths, dtype=dtype)
+
+    def is_stale(self):
+        return file_signature(self.paths) != self.signatures
+
+    def block(self, start=0, stop=None):
+        """
+        Stack of the subjects between start and stop.
+        """
+        if self.mmap:
+            return np.stack([np.asarray(m, dtype=self.dtype) for m in self.data[start:stop]])
+        return self.data[start:stop]
+
+
+def _remove_stale_socket(socket_path):
+    """
+    Remove the socket left by a server that did not exit cleanly. Raises a
+    RuntimeError if a server still answers on it, or if the file is not a
+    socket.
+    """
+    if not stat.S_ISSOCK(os.lstat(socket_path).st_mode):
+        raise RuntimeError(f'{socket_path} exists and is not a socket.')
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except ConnectionRefusedError:
+        os.unlink(socket_path)
+        return
+    finally:
+        sock.close()
+    raise RuntimeError(f'A cohort server is already running on {socket_path}.')
+
+
+class CohortServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Server keeping cohorts of connectivity matrices in memory and answering
+    queries (edge extraction, cluster means, density) over a Unix socket.
+    Cohorts are identified by their files and dtype: they are loaded on the
+    first query and reloaded if a file changes on disk. When more than
+    max_cohorts are held, the least recently queried one is released.
+    :param socket_path: Socket filename.
+    :param mmap:        If True, cohorts are memory-mapped instead of loaded.
+    :param max_cohorts: Maximum number of cohorts kept in memory.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, mmap=False, max_cohorts=4):
+        if max_cohorts < 1:
+            raise ValueError('max_cohorts should be at least 1.')
+        if os.path.lexists(socket_path):
+            _remove_stale_socket(socket_path)
+        self.mmap = mmap
+        self.max_cohorts = max_cohorts
+        self.cohorts = OrderedDict()
+        self._lock = threading.Lock()
+        # The socket is created with owner-only permissions, it is never
+        # accessible by other users, even briefly.
+        umask = os.umask(0o177)
+        try:
+            super().__init__(socket_path, _Handler)
+        finally:
+            os.umask(umask)
+
+    def cohort(self, paths, dtype=None):
+        key = fingerprint(list(paths), str(dtype))
+        with self._lock:
+            cohort = self.cohorts.get(key)
+            if cohort is None or cohort.is_stale():
+                # Release the previous version before loading the new one.
+                self.cohorts.pop(key, None)
+                logging.info(f'Loading a cohort of {len(paths)} matrices.')
+                cohort = Cohort(paths, dtype=dtype, mmap=self.mmap)
+                self.cohorts[key] = cohort
+                while len(self.cohorts) > self.max_cohorts:
+                    self.cohorts.popitem(last=False)
+                    logging.info('Released the least recently used cohort.')
+            self.cohorts.move_to_end(key)
+
+        return cohort
+
+    def handle_request_message(self, header):
+        """
+        Answer a query. Returns the response header and arrays.
+        """
+        op = header.get('op')
+        if op == 'ping':
+            return {'version': __version__, 'protocol': PROTOCOL_VERSION,
+                    'cohorts': len(self.cohorts)}, []
+        if op == 'shutdown':
+            threading.Thread(target=self.shutdown).start()
+            return {}, []
+        if op not in ['load', 'edges', 'cluster_means', 'density']:
+            raise ValueError(f'Unknown operation {op}.')
+
+        cohort = self.cohort(header['paths'], header.get('dtype'))
+        if op == 'load':
+            return {'n_subjects': len(cohort.paths),
+                    'shape': list(cohort.data[0].shape)}, []
+        block = cohort.block(header.get('start', 0), header.get('stop'))
+        if op == 'edges':
+            return {}, [np.asarray(edge_values(block, header['rows'], header['cols']))]
+        if op == 'cluster_means':
+            return {}, [cluster_means(block, clusters_to_indices(header['clusters']))]
+
+        return {}, [matrices_density(block)]
+
+
+class _Handler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        while True:
+            try:
+                header, _ = recv_message(self.request)
+            except ConnectionError:
+                return
+            try:
+                response, arrays = self.server.handle_request_message(header)
+                response['status'] = 'ok'
+            except Exception as e:
+                logging.exception(f'Query {header.get("op")} failed.')
+                response, arrays = {'status': 'error', 'message': str(e)}, []
+            send_message(self.request, response, arrays)
+
+
+class CohortClient(object):
+    """
+    Client of the cohort server. Queries return numpy arrays.
+    :param socket_path: Socket filename.
+    """
+
+    def __init__(self, socket_path=None):
+        self.socket_path = socket_path or default_socket()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+    def request(self, op, **params):
+        """
+        Send a query to the server.
+        :param op:      Operation ('ping', 'load', 'edges', 'cluster_means',
+                        'density' or 'shutdown').
+        :param params:  Parameters of the operation.
+        :return:        Response header and list of arrays.
+        """
+        if 'paths' in params:
+            # The server does not share the working directory of the client.
+            params['paths'] = [os.path.abspath(path) for path in params['paths']]
+        send_message(self.sock, dict(params, op=op))
+        header, arrays = recv_message(self.sock)
+        if header.pop('status') != 'ok':
+            raise RuntimeError(f'Cohort server error: {header["message"]}')
+
+        return header, arrays
+
+    def edges(self, paths, rows, cols, dtype=None, start=0, stop=None):
+        """
+        Connections (rows, cols) of the subjects between start and stop.
+        :return:    Array (n_subjects, n_edges).
+        """
+        return self.request('edges', paths=paths, dtype=dtype, start=start, stop=stop,
+                            rows=np.asarray(rows).tolist(),
+                            cols=np.asarray(cols).tolist())[1][0]
+
+    def cluster_means(self, paths, clusters, dtype=None):
+        """
+        Mean value of each cluster (track_clustering output) for every subject.
+        :return:    Array (n_subjects, n_clusters).
+        """
+        return self.request('cluster_means', paths=paths, dtype=dtype,
+                            clusters=clusters)[1][0]
+
+    def density(self, paths):
+        """
+        Density (% of connections equal to 1) of every matrix.
+        :return:    Array (n_subjects,).
+        """
+        return self.request('density', paths=paths)[1][0]
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def connect(socket_path=None):
+    """
+    Function to connect to a running cohort server.
+    :param socket_path: Socket filename. If None, default_socket().
+    :return:            CohortClient, or None if no server is running (scripts
+                        then fall back to standalone mode).
+    """
+    try:
+        return CohortClient(socket_path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        logging.info('No cohort server running, running standalone.')
+        return None
+
+
+def serve(socket_path=None, mmap=False, max_cohorts=4):
+    """
+    Function to run the cohort server until a shutdown query is received.
+    :param socket_path: Socket filename. If None, default_socket().
+    :param mmap:        If True, cohorts are memory-mapped instead of loaded.
+    :param max_cohorts: Maximum number of cohorts kept in memory.
+    """
+    socket_path = socket_path or default_socket()
+    server = CohortServer(socket_path, mmap=mmap, max_cohorts=max_cohorts)
+    logging.info(f'Cohort server listening on {socket_path}.')
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
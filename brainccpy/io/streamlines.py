@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+
+import numpy as np
+
+
+def _load_nibabel():
+    try:
+        import nibabel
+    except ImportError:
+        raise ImportError('nibabel is required to read streamlines.')
+    return nibabel
+
+
+def streamline_lengths(points, lengths):
+    """
+    Function to compute the length of every streamline from the concatenated
+    array of points, without looping over streamlines.
+    :param points:      Concatenated points of all streamlines (n_points x 3).
+    :param lengths:     Number of points of each streamline.
+    :return:            Length of each streamline (same unit as points).
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    if len(lengths) == 0:
+        return np.zeros(0)
+
+    seg = np.sqrt((np.diff(points, axis=0) ** 2).sum(axis=1))
+    ends = np.cumsum(lengths)
+    # Segments joining two consecutive streamlines are not part of any of them.
+    seg[ends[:-1][ends[:-1] > 0] - 1] = 0
+    offsets = np.concatenate([[0], ends[:-1]])
+    out = np.add.reduceat(np.append(seg, 0), np.minimum(offsets, len(seg)))
+    out[lengths < 2] = 0
+
+    return out
+
+
+def streamline_density(points, lengths, vox_to_rasmm, dimensions):
+    """
+    Function to compute a density map (number of streamlines going through
+    each voxel, every streamline being counted once per voxel).
+    :param points:          Concatenated points in RAS+ mm (n_points x 3).
+    :param lengths:         Number of points of each streamline.
+    :param vox_to_rasmm:    Voxel to RAS+ mm affine (4 x 4).
+    :param dimensions:      Dimensions of the reference volume.
+    :return:                Density map (int32).
+    """
+    dimensions = tuple(int(d) for d in dimensions)
+    n_vox = int(np.prod(dimensions))
+    if len(points) == 0:
+        return np.zeros(dimensions, dtype=np.int32)
+
+    inv = np.linalg.inv(vox_to_rasmm)
+    vox = np.floor(points @ inv[:3, :3].T + inv[:3, 3] + 0.5).astype(np.int64)
+    sid = np.repeat(np.arange(len(lengths)), lengths)
+
+    inside = np.all((vox >= 0) & (vox < dimensions), axis=1)
+    lin = np.ravel_multi_index(vox[inside].T, dimensions)
+    pairs = np.unique(sid[inside] * n_vox + lin)
+
+    return np.bincount(pairs % n_vox, minlength=n_vox).reshape(dimensions).astype(np.int32)
+
+
+def summarize_cluster(files, bins):
+    """
+    Function to summarize the streamlines of a cluster while reading its
+    connections one at a time (no merged tractogram is built).
+    :param files:   List of connections filenames (.trk). Missing files
+                    (connections without streamlines) are skipped.
+    :param bins:    Edges of the length histogram (mm).
+    :return:        Dictionary (count, length statistics and histogram) and
+                    density map (None if no connection was found).
+    """
+    nib = _load_nibabel()
+
+    count = 0
+    total = 0.
+    min_len, max_len = np.inf, 0.
+    hist = np.zeros(len(bins) - 1, dtype=np.int64)
+    density = None
+    header = None
+    for filename in files:
+        if not os.path.isfile(filename):
+            logging.warning(f'{filename} does not exist, connection skipped.')
+            continue
+
+        trk = nib.streamlines.load(filename)
+        streamlines = trk.streamlines
+        if len(streamlines) == 0:
+            continue
+        points = streamlines.get_data()
+        lengths = streamlines._lengths
+
+        lens = streamline_lengths(points, lengths)
+        count += len(lens)
+        total += lens.sum()
+        min_len = min(min_len, lens.min())
+        max_len = max(max_len, lens.max())
+        hist += np.histogram(lens, bins=bins)[0]
+
+        affine = trk.header['voxel_to_rasmm']
+        dims = trk.header['dimensions']
+        if density is None:
+            density = np.zeros(tuple(int(d) for d in dims), dtype=np.int32)
+            header = {'voxel_to_rasmm': np.asarray(affine).tolist(),
+                      'dimensions': [int(d) for d in dims]}
+        density += streamline_density(points, lengths, affine, dims)
+
+    summary = {
+        'count': count,
+        'mean_length': total / count if count else 0.,
+        'min_length': float(min_len) if count else 0.,
+        'max_length': float(max_len),
+        'length_bins': np.asarray(bins).tolist(),
+        'length_histogram': hist.tolist(),
+        'reference': header,
+    }
+
+    return summary, density
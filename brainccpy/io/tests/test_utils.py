@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+import logging
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import sparse
+
+from brainccpy.io.export import edges_from_mask, export_edges
+from brainccpy.io.utils import (clusters_to_indices,
+                                load_binary_mask,
+                                load_matrix_stack,
+                                upper_triangle_edges)
+from brainccpy.viz.utils import track_clustering
+
+# float32 keeps 24 bits of mantissa, values are compared to float64 results
+# within a few units of its rounding error.
+RTOL = 1e-6
+N_NODES = 30
+N_SUBJECTS = 12
+
+
+@pytest.fixture
+def cohort(tmp_path):
+    rng = np.random.default_rng(0)
+    paths = []
+    for i in range(N_SUBJECTS):
+        mat = rng.lognormal(mean=2, sigma=1.5, size=(N_NODES, N_NODES))
+        mat = np.triu(mat) + np.triu(mat, 1).T
+        paths.append(str(tmp_path / f'sub{i}.npy'))
+        np.save(paths[-1], mat)
+
+    return paths
+
+
+@pytest.fixture
+def mask():
+    rng = np.random.default_rng(1)
+    mask = np.triu(rng.random((N_NODES, N_NODES)) < 0.1, 1).astype(float)
+
+    return mask + mask.T
+
+
+def test_load_matrix_stack_float32(cohort):
+    stack64 = load_matrix_stack(cohort)
+    stack32 = load_matrix_stack(cohort, dtype=np.float32)
+
+    assert stack64.dtype == np.float64
+    assert stack32.dtype == np.float32
+    np.testing.assert_allclose(stack32, stack64, rtol=RTOL)
+
+
+def test_cluster_means_float32(cohort, mask):
+    clusters = track_clustering(mask)
+    indices = clusters_to_indices(clusters)
+    stack64 = load_matrix_stack(cohort)
+    stack32 = load_matrix_stack(cohort, dtype=np.float32)
+
+    for cluster, (rows, cols) in indices.items():
+        means64 = stack64[:, rows, cols].mean(axis=1)
+        means32 = stack32[:, rows, cols].mean(axis=1, dtype=np.float64)
+        np.testing.assert_allclose(means32, means64, rtol=RTOL)
+
+        # Same values as the former mask-based computation.
+        cluster_mask = np.zeros((N_NODES, N_NODES))
+        cluster_mask[rows, cols] = 1
+        for mat, mean in zip(stack64, means64):
+            expected = np.mean(mat * cluster_mask, where=cluster_mask > 0)
+            np.testing.assert_allclose(mean, expected, rtol=1e-12)
+
+
+def test_export_edges_float32(cohort, mask, tmp_path):
+    rows, cols, columns = edges_from_mask(mask)
+    ids = [f'sub{i}' for i in range(N_SUBJECTS)]
+    export_edges(cohort, ids, rows, cols, columns, str(tmp_path / 'edges64.csv'),
+                 chunk_size=5)
+    export_edges(cohort, ids, rows, cols, columns, str(tmp_path / 'edges32.csv'),
+                 chunk_size=5, dtype=np.float32)
+    edges64 = pd.read_csv(tmp_path / 'edges64.csv')
+    edges32 = pd.read_csv(tmp_path / 'edges32.csv')
+
+    assert list(edges32.columns) == ['IDs'] + columns
+    assert list(edges32['IDs']) == ids
+    np.testing.assert_allclose(edges32[columns].to_numpy(), edges64[columns].to_numpy(),
+                               rtol=RTOL)
+    expected = load_matrix_stack(cohort)[:, rows, cols]
+    np.testing.assert_allclose(edges64[columns].to_numpy(), expected, rtol=1e-12)
+
+
+def test_track_clustering_representations(mask):
+    expected = track_clustering(mask)
+
+    assert len(expected) > 0
+    assert track_clustering(mask.astype(bool)) == expected
+    assert track_clustering(sparse.csr_matrix(mask)) == expected
+    assert track_clustering(sparse.csr_matrix(mask.astype(bool))) == expected
+
+
+def test_upper_triangle_edges_sparse(mask):
+    rows, cols = upper_triangle_edges(mask)
+    srows, scols = upper_triangle_edges(sparse.csr_matrix(mask))
+
+    np.testing.assert_array_equal(srows, rows)
+    np.testing.assert_array_equal(scols, cols)
+    assert np.all(rows <= cols)
+
+
+def test_load_binary_mask_keeps_ones(mask, tmp_path, caplog):
+    noisy = mask.copy()
+    noisy[0, 1] = noisy[1, 0] = 0.5
+    noisy[2, 3] = noisy[3, 2] = np.nan
+    noisy[4, 5] = noisy[5, 4] = 2
+    np.save(tmp_path / 'mask.npy', noisy)
+
+    with caplog.at_level(logging.WARNING):
+        dense = load_binary_mask(str(tmp_path / 'mask.npy'))
+        csr = load_binary_mask(str(tmp_path / 'mask.npy'), as_sparse=True)
+
+    np.testing.assert_array_equal(dense, noisy == 1)
+    np.testing.assert_array_equal(csr.toarray(), noisy == 1)
+    assert 'not binary' in caplog.text
+    assert track_clustering(dense) == track_clustering(noisy)
+    assert track_clustering(csr) == track_clustering(noisy)
@@ -7,6 +7,7 @@ import sys
 import numpy as np
 import shutil
 import os
+from scipy import sparse
 
 
 def add_overwrite_arg(parser):
@@ -162,6 +163,96 @@ def compute_matrices_density(mat):
     return dens
 
 
+def load_matrix_stack(paths, dtype=None):
+    """
+    Function to load a list of connectivity matrices in a single stacked array.
+    :param paths:   List of matrices filenames (.npy).
+    :param dtype:   Dtype of the stack (ex: np.float32 to halve the memory).
+                    If None, the dtype on disk is kept.
+    :return:        Array of shape (n_subjects, N, N).
+    """
+    first = np.load(paths[0], mmap_mode='r')
+    stack = np.empty((len(paths),) + first.shape, dtype=dtype or first.dtype)
+    for i, path in enumerate(paths):
+        stack[i] = np.load(path, mmap_mode='r')
+
+    return stack
+
+
+def load_binary_mask(path, as_sparse=False):
+    """
+    Function to load a binary matrix as a boolean array or as a sparse matrix.
+    Only entries equal to 1 are selected. Other non-zero values (weights,
+    NaNs) are ignored with a warning.
+    :param path:        Binary matrix filename (.npy).
+    :param as_sparse:   If True, returns a scipy.sparse CSR matrix.
+    :return:            Boolean array or CSR matrix.
+    """
+    mat = np.load(path)
+    mask = mat == 1
+    ignored = np.count_nonzero(~mask & (mat != 0))
+    if ignored:
+        logging.warning(f'{path} is not binary: {ignored} entries different from '
+                        f'0 and 1 are ignored.')
+    if as_sparse:
+        return sparse.csr_matrix(mask)
+
+    return mask
+
+
+def upper_triangle_edges(mat):
+    """
+    Function to get the non-zero connections in the upper triangle (diagonal
+    included) of a dense or sparse matrix.
+    :param mat:     Matrix (numpy array or scipy.sparse matrix).
+    :return:        Row and column indices (0-based) in row-major order.
+    """
+    if sparse.issparse(mat):
+        coo = sparse.triu(mat, format='coo')
+        keep = coo.data != 0
+        rows, cols = coo.row[keep], coo.col[keep]
+        order = np.lexsort((cols, rows))
+        return rows[order], cols[order]
+
+    return np.nonzero(np.triu(mat))
+
+
+def iter_edge_columns(stack, rows, cols, chunk_size=50000):
+    """
+    Generator reading the values of a cohort one chunk of connections at a
+    time. Matrices given as filenames are memory-mapped, so memory is bounded
+    by n_subjects x chunk_size.
+    :param stack:       Connectivity matrices (n_subjects, N, N), or list of
+                        matrices filenames (.npy).
+    :param rows:        Row indices of the connections.
+    :param cols:        Column indices of the connections.
+    :param chunk_size:  Number of connections per chunk.
+    :return:            Yields (start, values) where values is a float64 array
+                        of shape (n_subjects, n_connections_in_chunk).
+    """
+    if isinstance(stack[0], str):
+        stack = [np.load(path, mmap_mode='r') for path in stack]
+    for start in range(0, len(rows), chunk_size):
+        r = rows[start:start + chunk_size]
+        c = cols[start:start + chunk_size]
+        yield start, np.stack([np.asarray(mat[r, c], dtype=float) for mat in stack])
+
+
+def clusters_to_indices(cluster_dict):
+    """
+    Function to convert clusters of connections (X_Y) into index arrays, so
+    that values can be read without building a mask for each cluster.
+    :param cluster_dict:    Dictionary of clusters (track_clustering output).
+    :return:                Dictionary of (rows, cols) arrays (0-based).
+    """
+    indices = {}
+    for cluster, edges in cluster_dict.items():
+        pairs = np.array([e.split('_') for e in edges], dtype=int).reshape(-1, 2) - 1
+        indices[cluster] = (pairs[:, 0], pairs[:, 1])
+
+    return indices
+
+
 def configure_logging_handler():
     """
     Configure logging handler to log file and to a stream handler.
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+import logging
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+from brainccpy.io.utils import iter_edge_columns
+
+
+def covariate_levels(df):
+    """
+    Function to get the levels of the categorical columns of a table of
+    covariates, in the order used for dummy coding.
+    :param df:  Pandas dataframe (one row per subject).
+    :return:    Dictionary {column: list of levels}.
+    """
+    return {col: pd.Categorical(df[col]).categories.tolist()
+            for col in df.select_dtypes(include=['object', 'category']).columns}
+
+
+def design_matrix(df, intercept=True, levels=None):
+    """
+    Function to build a design matrix from a table of covariates. Categorical
+    columns are dummy coded (first level dropped).
+    :param df:          Pandas dataframe (one row per subject).
+    :param intercept:   If True, an 'Intercept' column is added first.
+    :param levels:      Optional levels of the categorical columns
+                        (covariate_levels output). Subjects are then coded as
+                        in the table the levels come from, even if some levels
+                        (including the dropped one) are absent from df.
+    :return:            Pandas dataframe of floats.
+    """
+    if levels is not None:
+        df = df.copy()
+        for col, categories in levels.items():
+            if col not in df.columns:
+                raise ValueError(f'Covariate {col} is missing.')
+            unknown = sorted(set(df[col].dropna()) - set(categories), key=str)
+            if unknown:
+                raise ValueError(f'Levels {unknown} of {col} are unknown '
+                                 f'(known levels: {categories}).')
+            df[col] = pd.Categorical(df[col], categories=categories)
+    design = pd.get_dummies(df, drop_first=True).astype(float)
+    if intercept:
+        design.insert(0, 'Intercept', 1.0)
+
+    return design
+
+
+def fdr_bh(pvalues):
+    """
+    Function to compute Benjamini-Hochberg adjusted p-values (q-values).
+    :param pvalues:     Array of p-values (any shape).
+    :return:            Array of q-values (same shape).
+    """
+    p = np.asarray(pvalues, dtype=float)
+    flat = p.ravel()
+    m = flat.size
+    order = np.argsort(flat)
+    scaled = flat[order] * m / np.arange(1, m + 1)
+    q = np.empty(m)
+    q[order] = np.minimum(np.minimum.accumulate(scaled[::-1])[::-1], 1)
+
+    return q.reshape(p.shape)
+
+
+def edge_glm(stack, design, contrast, tail='both', chunk_size=50000):
+    """
+    Function to fit the same general linear model to every edge. Edges are
+    processed in chunks: each chunk is a matrix right-hand side of a single
+    least-squares solve, so memory is bounded by n_subjects x chunk_size.
+    :param stack:       Connectivity matrices (n_subjects, N, N), or list of
+                        matrices filenames (.npy, memory-mapped).
+    :param design:      Design matrix (n_subjects x n_regressors).
+    :param contrast:    Contrast vector (n_regressors,).
+    :param tail:        'greater', 'lower' or 'both'.
+    :param chunk_size:  Number of edges solved at once.
+    :return:            T-statistics, p-values and beta of the contrast as
+                        N x N matrices (upper triangle, diagonal excluded),
+                        and degrees of freedom.
+    """
+    if tail not in ['greater', 'lower', 'both']:
+        raise ValueError("tail should be 'greater', 'lower' or 'both'.")
+
+    x = np.asarray(design, dtype=float)
+    c = np.asarray(contrast, dtype=float)
+    if len(stack) != x.shape[0]:
+        raise ValueError('The design should contain one row per subject.')
+
+    rank = np.linalg.matrix_rank(x)
+    dof = x.shape[0] - rank
+    if dof <= 0:
+        raise ValueError('Not enough subjects for the number of regressors.')
+    # Variance factor of the contrast: c' (X'X)^-1 c.
+    var_c = c @ np.linalg.pinv(x.T @ x) @ c
+
+    first = np.load(stack[0], mmap_mode='r') if isinstance(stack[0], str) else stack[0]
+    n_nodes = first.shape[0]
+    rows, cols = np.triu_indices(n_nodes, k=1)
+    t = np.empty(len(rows))
+    effect = np.empty(len(rows))
+    for start, y in iter_edge_columns(stack, rows, cols, chunk_size):
+        beta = np.linalg.lstsq(x, y, rcond=None)[0]
+        resid = y - x @ beta
+        sigma2 = (resid ** 2).sum(axis=0) / dof
+        con = c @ beta
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t[start:start + y.shape[1]] = np.nan_to_num(con / np.sqrt(sigma2 * var_c),
+                                                        nan=0.0, posinf=0.0, neginf=0.0)
+        effect[start:start + y.shape[1]] = con
+        logging.info(f'Fitted edges {start + 1} to {start + y.shape[1]} of {len(rows)}.')
+
+    if tail == 'greater':
+        p = stats.t.sf(t, dof)
+    elif tail == 'lower':
+        p = stats.t.cdf(t, dof)
+    else:
+        p = 2 * stats.t.sf(np.abs(t), dof)
+
+    def to_matrix(values, fill):
+        mat = np.full((n_nodes, n_nodes), fill, dtype=float)
+        mat[rows, cols] = values
+        return mat
+
+    return to_matrix(t, 0), to_matrix(p, 1), to_matrix(effect, 0), dof
+
+
+def significance_mask(pmat, alpha=0.05, correction='fdr'):
+    """
+    Function to build the binary matrix of significant edges.
+    :param pmat:        P-values matrix (edge_glm output).
+    :param alpha:       Significance level.
+    :param correction:  'fdr' (Benjamini-Hochberg over the upper triangle
+                        edges) or 'none'.
+    :return:            Q-values matrix (p-values if correction is 'none') and
+                        binary mask (uint8, upper triangle).
+    """
+    rows, cols = np.triu_indices(pmat.shape[0], k=1)
+    q = pmat[rows, cols]
+    if correction == 'fdr':
+        q = fdr_bh(q)
+    elif correction != 'none':
+        raise ValueError("correction should be either 'fdr' or 'none'.")
+
+    qmat = np.ones_like(pmat)
+    qmat[rows, cols] = q
+    mask = np.zeros(pmat.shape, dtype=np.uint8)
+    mask[rows, cols] = q <= alpha
+
+    return qmat, mask
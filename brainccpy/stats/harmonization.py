@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+
+import numpy as np
+from brainccpy.io.utils import iter_edge_columns
+from brainccpy.version import __version__
+
+FORMAT_VERSION = 2
+
+
+def _design(sites, site_names, covariates):
+    onehot = (np.asarray(sites)[:, None] == np.asarray(site_names)[None, :]).astype(float)
+    if covariates is None:
+        return onehot
+    return np.hstack([onehot, np.asarray(covariates, dtype=float).reshape(len(onehot), -1)])
+
+
+def _priors(gamma_hat, delta_hat):
+    """
+    Empirical Bayes hyperparameters of each site, estimated across edges by
+    the method of moments (normal prior for the location, inverse gamma prior
+    for the scale).
+    """
+    gamma_bar = gamma_hat.mean(axis=1)
+    tau2 = gamma_hat.var(axis=1, ddof=1)
+    m = delta_hat.mean(axis=1)
+    s2 = delta_hat.var(axis=1, ddof=1)
+    a = (2 * s2 + m ** 2) / s2
+    b = (m * s2 + m ** 3) / s2
+
+    return gamma_bar, tau2, a, b
+
+
+def _posteriors(counts, gamma_hat, delta_hat, sum_sq, gamma_bar, tau2, a, b,
+                tol=1e-4, max_iter=1000):
+    """
+    Iterative empirical Bayes estimation of the site location and scale of
+    every edge at once. sum_sq is the sum of squared standardized values of
+    each site, which is all that is needed from the data.
+    """
+    n = counts[:, None]
+    gamma_bar, tau2, a, b = (v[:, None] for v in (gamma_bar, tau2, a, b))
+    gamma, delta = gamma_hat, delta_hat
+    for it in range(max_iter):
+        gamma_new = (n * tau2 * gamma_hat + delta * gamma_bar) / (n * tau2 + delta)
+        # Sum over subjects of (s - gamma)^2 from the site sums.
+        ss = sum_sq - 2 * gamma_new * n * gamma_hat + n * gamma_new ** 2
+        delta_new = (0.5 * ss + b) / (n / 2 + a - 1)
+        change = max(np.max(np.abs(gamma_new - gamma) / np.maximum(np.abs(gamma), 1e-12)),
+                     np.max(np.abs(delta_new - delta) / np.maximum(np.abs(delta), 1e-12)))
+        gamma, delta = gamma_new, delta_new
+        if change < tol:
+            break
+    logging.info(f'Empirical Bayes estimation converged in {it + 1} iterations.')
+
+    return gamma, delta
+
+
+def combat_fit(stack, sites, covariates=None, covariate_names=None, eb=True,
+               chunk_size=50000, covariate_levels=None):
+    """
+    Function to fit ComBat harmonization (Johnson et al., 2007; Fortin et al.,
+    2017) on the upper triangle connections of a cohort. Location/scale
+    estimates of every edge are computed with array operations, one chunk of
+    edges at a time, and the empirical Bayes step only uses per-site sums.
+    :param stack:           Connectivity matrices (n_subjects, N, N), or list
+                            of matrices filenames (.npy, memory-mapped).
+    :param sites:           Site of each subject (at least two subjects per site).
+    :param covariates:      Optional biological covariates to preserve
+                            (n_subjects x n_covariates).
+    :param covariate_names: Names of the covariates (saved with the model).
+    :param eb:              If True, site effects are shrunk with empirical
+                            Bayes. Otherwise, per-site estimates are used.
+    :param chunk_size:      Number of edges processed at once.
+    :param covariate_levels: Levels of the categorical covariates
+                            (covariate_levels output), saved with the model
+                            to code new subjects the same way.
+    :return:                Dictionary of fitted parameters (see combat_apply
+                            and save_combat).
+    """
+    sites = np.asarray(sites).astype(str)
+    site_names = np.unique(sites)
+    if len(site_names) < 2:
+        raise ValueError('At least two sites are needed for harmonization.')
+    design = _design(sites, site_names, covariates)
+    n, n_sites = design.shape[0], len(site_names)
+    counts = np.array([np.sum(sites == s) for s in site_names], dtype=float)
+    if np.any(counts < 2):
+        # The site variance (delta_hat) is undefined with a single subject.
+        raise ValueError(f'Sites should contain at least two subjects: '
+                         f'{site_names[counts < 2].tolist()}.')
+    pinv = np.linalg.pinv(design)
+
+    first = np.load(stack[0], mmap_mode='r') if isinstance(stack[0], str) else stack[0]
+    n_nodes = first.shape[0]
+    rows, cols = np.triu_indices(n_nodes, k=1)
+    n_edges = len(rows)
+
+    grand_mean = np.empty(n_edges)
+    betas = np.empty((design.shape[1] - n_sites, n_edges))
+    var_pooled = np.empty(n_edges)
+    gamma_hat = np.empty((n_sites, n_edges))
+    sum_sq = np.empty((n_sites, n_edges))
+    onehot = design[:, :n_sites]
+    for start, y in iter_edge_columns(stack, rows, cols, chunk_size):
+        stop = start + y.shape[1]
+        beta = pinv @ y
+        grand_mean[start:stop] = counts / n @ beta[:n_sites]
+        betas[:, start:stop] = beta[n_sites:]
+        var = ((y - design @ beta) ** 2).mean(axis=0)
+        var_pooled[start:stop] = var
+
+        stand = grand_mean[start:stop] + design[:, n_sites:] @ beta[n_sites:]
+        z = (y - stand) / np.sqrt(np.where(var > 0, var, 1))
+        gamma_hat[:, start:stop] = (onehot.T @ z) / counts[:, None]
+        sum_sq[:, start:stop] = onehot.T @ (z ** 2)
+        logging.info(f'Estimated edges {start + 1} to {stop} of {n_edges}.')
+
+    delta_hat = (sum_sq - counts[:, None] * gamma_hat ** 2) / (counts[:, None] - 1)
+    valid = var_pooled > 0
+    if eb:
+        gamma_bar, tau2, a, b = _priors(gamma_hat[:, valid], delta_hat[:, valid])
+        gamma_star, delta_star = _posteriors(counts, gamma_hat, delta_hat, sum_sq,
+                                             gamma_bar, tau2, a, b)
+    else:
+        gamma_star, delta_star = gamma_hat, delta_hat
+    # Constant edges are left untouched.
+    gamma_star[:, ~valid] = 0
+    delta_star[:, ~valid] = 1
+
+    return {
+        'sites': [str(s) for s in site_names],
+        'covariates': list(covariate_names) if covariate_names is not None else
+        [f'covariate_{i}' for i in range(betas.shape[0])],
+        'n_nodes': int(n_nodes),
+        'levels': dict(covariate_levels or {}),
+        'grand_mean': grand_mean,
+        'betas': betas,
+        'var_pooled': var_pooled,
+        'gamma_star': gamma_star,
+        'delta_star': delta_star,
+    }
+
+
+def combat_apply(mat, site, params, covariates=None):
+    """
+    Function to harmonize the matrix of one subject with fitted parameters,
+    so new subjects from known sites do not require refitting.
+    :param mat:         Connectivity matrix (N x N).
+    :param site:        Site of the subject (one of params['sites']).
+    :param params:      Fitted parameters (combat_fit or load_combat).
+    :param covariates:  Covariates of the subject (same order as at fit time).
+    :return:            Harmonized matrix (float64). Only upper triangle
+                        connections are harmonized; they are mirrored if the
+                        input matrix is symmetric.
+    """
+    site = str(site)
+    if site not in params['sites']:
+        raise ValueError(f'Site {site} was not seen when fitting '
+                         f'(known sites: {params["sites"]}).')
+    i = params['sites'].index(site)
+
+    mat = np.asarray(mat, dtype=float)
+    if mat.shape[0] != params['n_nodes']:
+        raise ValueError(f'Matrix should be {params["n_nodes"]} x {params["n_nodes"]}.')
+    rows, cols = np.triu_indices(params['n_nodes'], k=1)
+
+    stand = params['grand_mean'].copy()
+    if len(params['betas']):
+        stand += np.asarray(covariates, dtype=float).ravel() @ params['betas']
+    std = np.sqrt(np.where(params['var_pooled'] > 0, params['var_pooled'], 1))
+    z = (mat[rows, cols] - stand) / std
+    harmonized = (z - params['gamma_star'][i]) / np.sqrt(params['delta_star'][i]) * std + stand
+
+    symmetric = np.allclose(mat, mat.T)
+    out = mat.copy()
+    out[rows, cols] = harmonized
+    if symmetric:
+        out[cols, rows] = harmonized
+
+    return out
+
+
+def save_combat(params, filename):
+    """
+    Function to save fitted ComBat parameters in a .npz file (no pickle).
+    :param params:      Fitted parameters (combat_fit).
+    :param filename:    Output filename (.npz).
+    """
+    meta = {
+        'format_version': FORMAT_VERSION,
+        'brainccpy_version': __version__,
+        'sites': params['sites'],
+        'covariates': params['covariates'],
+        'n_nodes': params['n_nodes'],
+        'levels': params.get('levels', {}),
+    }
+    arrays = {k: v for k, v in params.items() if isinstance(v, np.ndarray)}
+    np.savez_compressed(filename, meta=np.array(json.dumps(meta)), **arrays)
+
+
+def load_combat(filename):
+    """
+    Function to load ComBat parameters saved with save_combat.
+    :param filename:    Model filename (.npz).
+    :return:            Dictionary of fitted parameters.
+    """
+    with np.load(filename, allow_pickle=False) as f:
+        meta = json.loads(str(f['meta']))
+        if meta['format_version'] > FORMAT_VERSION:
+            raise ValueError(f'Model format version {meta["format_version"]} is not '
+                             f'supported by this version of brainccpy '
+                             f'(<= {FORMAT_VERSION}).')
+        params = {k: f[k] for k in f.files if k != 'meta'}
+
+    # Models saved before format version 2 have no covariate levels (None).
+    params.update(sites=meta['sites'], covariates=meta['covariates'],
+                  n_nodes=meta['n_nodes'], levels=meta.get('levels'))
+
+    return params
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+import logging
+
+import numpy as np
+from joblib import Parallel, delayed, effective_n_jobs
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+
+def edge_ttest(edges, groups):
+    """
+    Function to compute two-sample t-statistics (pooled variance) for every
+    edge at once. Multiple labelings can be evaluated in a single call, which
+    is how permutations are computed in batches.
+    :param edges:       Array of shape (n_subjects, n_edges).
+    :param groups:      Boolean (or 0/1) array of shape (n_subjects,) or
+                        (n_labelings, n_subjects). True for subjects of the
+                        first group (see group_labels for other labels).
+    :return:            T-statistics of shape (n_edges,) or
+                        (n_labelings, n_edges).
+    """
+    groups = np.asarray(groups)
+    if not np.isin(groups, [0, 1]).all():
+        raise ValueError('groups should be boolean or 0/1, use group_labels to '
+                         'convert other labels.')
+
+    return _ttest(_centered_moments(edges), groups)
+
+
+def _centered_moments(edges):
+    # Centering the edges does not change the statistic but limits the
+    # cancellation in the sum of squares.
+    edges = edges - edges.mean(axis=0)
+    sq = edges * edges
+    return edges, sq, edges.sum(axis=0), sq.sum(axis=0)
+
+
+def _ttest(moments, groups):
+    edges, sq, tot, totq = moments
+    groups = np.asarray(groups, dtype=float)
+    n = edges.shape[0]
+    n1 = groups.sum(axis=-1, keepdims=True)
+    n2 = n - n1
+
+    s1 = groups @ edges
+    q1 = groups @ sq
+    m1 = s1 / n1
+    m2 = (tot - s1) / n2
+    ss = (q1 - n1 * m1 ** 2) + ((totq - q1) - n2 * m2 ** 2)
+    pooled = ss / (n - 2)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = (m1 - m2) / np.sqrt(pooled * (1 / n1 + 1 / n2))
+
+    return np.nan_to_num(t, nan=0.0, posinf=0.0, neginf=0.0)
+
+
+def _suprathreshold(t, threshold, tail):
+    if tail == 'greater':
+        return t > threshold
+    elif tail == 'lower':
+        return t < -threshold
+    return np.abs(t) > threshold
+
+
+def edge_components(rows, cols, n_nodes):
+    """
+    Function to label the connected components of a set of edges with a
+    sparse connected-components routine.
+    :param rows:        Starting region of each edge (0-based).
+    :param cols:        Receiving region of each edge (0-based).
+    :param n_nodes:     Number of regions.
+    :return:            Component label of each edge and number of edges
+                        in each component.
+    """
+    if len(rows) == 0:
+        return np.empty(0, dtype=int), np.empty(0, dtype=int)
+
+    graph = coo_matrix((np.ones(len(rows), dtype=np.int8), (rows, cols)),
+                       shape=(n_nodes, n_nodes)).tocsr()
+    _, node_labels = connected_components(graph, directed=False)
+    edge_labels = node_labels[rows]
+    sizes = np.bincount(edge_labels)
+
+    return edge_labels, sizes
+
+
+def _null_max_sizes(edges, groups, rows, cols, n_nodes, threshold, tail,
+                    seeds, batch_size):
+    moments = _centered_moments(edges)
+    null = np.zeros(len(seeds), dtype=int)
+    for start in range(0, len(seeds), batch_size):
+        stop = min(start + batch_size, len(seeds))
+        perms = np.array([np.random.default_rng(seed).permutation(groups)
+                          for seed in seeds[start:stop]])
+        t = _ttest(moments, perms)
+        supra = _suprathreshold(t, threshold, tail)
+        for b in range(stop - start):
+            _, sizes = edge_components(rows[supra[b]], cols[supra[b]], n_nodes)
+            null[start + b] = sizes.max() if len(sizes) else 0
+
+    return null
+
+
+def group_labels(groups):
+    """
+    Function to convert group labels with exactly two distinct values (ex: 0/1,
+    1/2 or strings) to the boolean labels used by edge_ttest and nbs.
+    :param groups:  Array of shape (n_subjects,).
+    :return:        Boolean array, True for subjects with the highest label.
+    """
+    groups = np.asarray(groups)
+    labels = np.unique(groups)
+    if len(labels) != 2:
+        raise ValueError(f'Groups should contain exactly two distinct values, '
+                         f'found {len(labels)}.')
+
+    return groups == labels[1]
+
+
+def nbs(stack, groups, threshold, n_perm=5000, tail='both', n_jobs=1,
+        random_state=1234, batch_size=16):
+    """
+    Function to perform network-based statistic (NBS) inference between two
+    groups. Connected components of the suprathreshold edges are extracted
+    and their size (number of edges) is compared to the null distribution of
+    the maximal component size obtained by permuting group labels.
+    :param stack:           Connectivity matrices of shape (n_subjects, N, N).
+    :param groups:          Array of shape (n_subjects,) with exactly two
+                            distinct values. Subjects with the highest label
+                            form the first group (positive t-statistics when
+                            their connectivity is higher).
+    :param threshold:       Threshold applied on the t-statistics.
+    :param n_perm:          Number of permutations.
+    :param tail:            'greater', 'lower' or 'both'.
+    :param n_jobs:          Number of processes used to run permutations.
+    :param random_state:    Seed from which the seed of every permutation is
+                            spawned (results do not depend on n_jobs).
+    :param batch_size:      Number of permutations evaluated at once.
+    :return:                T-statistics matrix (N x N), dictionary of clusters
+                            (same format as track_clustering), dictionary of
+                            FWE-corrected p-values per cluster and null
+                            distribution of maximal component sizes.
+    """
+    if tail not in ['greater', 'lower', 'both']:
+        raise ValueError("tail should be 'greater', 'lower' or 'both'.")
+
+    groups = group_labels(groups)
+    n_nodes = stack.shape[1]
+    rows, cols = np.triu_indices(n_nodes, k=1)
+    edges = np.ascontiguousarray(stack[:, rows, cols], dtype=float)
+
+    # Observed statistics and components.
+    t = edge_ttest(edges, groups)
+    supra = _suprathreshold(t, threshold, tail)
+    edge_labels, sizes = edge_components(rows[supra], cols[supra], n_nodes)
+
+    # Edges are in row-major order, clusters are numbered by their first edge.
+    uniq, first = np.unique(edge_labels, return_index=True)
+    order = uniq[np.argsort(first)]
+    cluster_dict = {}
+    for n, lab in enumerate(order, start=1):
+        x = rows[supra][edge_labels == lab]
+        y = cols[supra][edge_labels == lab]
+        cluster_dict[f'Cluster_{n}'] = [f'{x[c] + 1}_{y[c] + 1}' for c in range(len(x))]
+    logging.info(f'{len(cluster_dict)} components found. Running {n_perm} permutations ...')
+
+    # One random stream per permutation, workers take contiguous slices.
+    seeds = np.random.SeedSequence(random_state).spawn(n_perm)
+    n_chunks = max(1, min(effective_n_jobs(n_jobs), n_perm))
+    bounds = np.linspace(0, n_perm, n_chunks + 1).astype(int)
+    null = Parallel(n_jobs=n_jobs)(
+        delayed(_null_max_sizes)(edges, groups, rows, cols, n_nodes, threshold,
+                                 tail, seeds[start:stop], batch_size)
+        for start, stop in zip(bounds[:-1], bounds[1:]))
+    null = np.concatenate(null)
+
+    pvalues = {}
+    for n, lab in enumerate(order, start=1):
+        pvalues[f'Cluster_{n}'] = float((1 + np.sum(null >= sizes[lab])) / (n_perm + 1))
+
+    tmat = np.zeros((n_nodes, n_nodes))
+    tmat[rows, cols] = t
+
+    return tmat, cluster_dict, pvalues, null
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+import logging
+
+import numpy as np
+from joblib import Parallel, delayed, effective_n_jobs
+from sklearn.utils.extmath import randomized_svd
+
+
+def standardize(data, dtype=np.float32, chunk_size=10000):
+    """
+    Function to z-score the columns of a matrix, processing columns in chunks.
+    Constant columns are set to 0.
+    :param data:        Array (n_subjects x n_features), can be memory-mapped.
+    :param dtype:       Output dtype.
+    :param chunk_size:  Number of columns processed at once.
+    :return:            Standardized array.
+    """
+    out = np.empty(data.shape, dtype=dtype)
+    for start in range(0, data.shape[1], chunk_size):
+        chunk = np.asarray(data[:, start:start + chunk_size], dtype=np.float64)
+        chunk = chunk - chunk.mean(axis=0)
+        std = chunk.std(axis=0, ddof=1)
+        out[:, start:start + chunk_size] = chunk / np.where(std > 0, std, 1)
+
+    return out
+
+
+def _subject_space(x, chunk_size):
+    """
+    Thin SVD of x (n x p) from its n x n Gram matrix, accumulated over chunks
+    of columns: x = U diag(s) V'. Only U and s are returned, V is applied
+    later in chunks.
+    """
+    gram = np.zeros((x.shape[0], x.shape[0]))
+    for start in range(0, x.shape[1], chunk_size):
+        chunk = np.asarray(x[:, start:start + chunk_size], dtype=np.float64)
+        gram += chunk @ chunk.T
+    vals, vecs = np.linalg.eigh(gram)
+    keep = vals > vals.max() * 1e-10
+    order = np.argsort(vals[keep])[::-1]
+
+    return vecs[:, keep][:, order], np.sqrt(vals[keep][order])
+
+
+def _cross(y, lx, idx=None):
+    if idx is not None:
+        y = y[idx] - y[idx].mean(axis=0)
+        lx = lx[idx] - lx[idx].mean(axis=0)
+    return y.T @ lx / (y.shape[0] - 1)
+
+
+def _null_singular_values(y, lx, seeds):
+    return np.array([np.linalg.svd(_cross(y[np.random.default_rng(seed).permutation(len(y))],
+                                          lx), compute_uv=False)
+                     for seed in seeds])
+
+
+def _bootstrap_moments(y, lx, w, seeds):
+    """
+    Accumulate the first two moments of the bootstrap saliences (expressed in
+    the subject space and aligned on w with a Procrustes rotation). One
+    resample is drawn from each seed.
+    """
+    n, k = y.shape[0], w.shape[1]
+    total = np.zeros_like(w)
+    outer = np.zeros((k, w.shape[0], w.shape[0]))
+    for seed in seeds:
+        idx = np.random.default_rng(seed).integers(n, size=n)
+        _, _, wt = np.linalg.svd(_cross(y, lx, idx), full_matrices=False)
+        wb = wt[:k].T
+        a, _, bt = np.linalg.svd(wb.T @ w)
+        wb = wb @ (a @ bt)
+        total += wb
+        outer += np.einsum('ik,jk->kij', wb, wb)
+
+    return total, outer
+
+
+def pls_correlation(x, y, n_components=None, method='pls', reg=0.1, n_perm=1000,
+                    n_boot=1000, n_jobs=1, random_state=1234, chunk_size=10000):
+    """
+    Function to perform a brain-behaviour PLS correlation (or regularized CCA).
+    Brain data is z-scored and summarized by its thin SVD, computed from the
+    Gram matrix with chunked matrix products, so that the cross-covariance and
+    every resample are computed in the n_subjects dimensional space.
+    Permutations (singular values) and bootstrap resamples (salience
+    reliability) run in parallel workers sharing the reduced matrices.
+    :param x:               Brain data (n_subjects x n_edges), can be memory-mapped.
+    :param y:               Behaviour data (n_subjects x n_behaviours).
+    :param n_components:    Number of latent variables. If None, n_behaviours.
+    :param method:          'pls' (SVD of the brain-behaviour correlation
+                            matrix) or 'cca' (canonical correlation analysis
+                            with ridge regularization of the brain covariance).
+    :param reg:             Ridge added to the brain covariance eigenvalues
+                            (relative to their mean) if method is 'cca'.
+    :param n_perm:          Number of permutations.
+    :param n_boot:          Number of bootstrap resamples.
+    :param n_jobs:          Number of processes.
+    :param random_state:    Seed from which the seed of every permutation and
+                            resample is spawned (results do not depend on
+                            n_jobs).
+    :param chunk_size:      Number of edges processed at once.
+    :return:                Dictionary with singular values (canonical
+                            correlations for cca), explained covariance,
+                            permutation p-values, behaviour saliences
+                            (n_behaviours x k), brain saliences and bootstrap
+                            ratios (n_edges x k), brain and behaviour scores.
+    """
+    if method not in ['pls', 'cca']:
+        raise ValueError("method should be either 'pls' or 'cca'.")
+
+    y = standardize(np.asarray(y, dtype=float), dtype=np.float64)
+    x = standardize(x, chunk_size=chunk_size)
+    n = x.shape[0]
+    k = n_components or y.shape[1]
+
+    ux, sx = _subject_space(x, chunk_size)
+    if method == 'cca':
+        # Whitened data: brain in its SVD basis with a ridge, behaviour with
+        # its own SVD (both have identity covariance).
+        ev = sx ** 2 / (n - 1)
+        scale = sx / np.sqrt(ev + reg * ev.mean())
+        uy, sy, vyt = np.linalg.svd(y, full_matrices=False)
+        yw = uy * np.sqrt(n - 1)
+    else:
+        scale = sx
+        yw = y
+    lx = ux * scale
+
+    cross = _cross(yw, lx)
+    u, s, wt = randomized_svd(cross, k, random_state=random_state)
+    w = wt.T
+    explained = s ** 2 / np.sum(np.linalg.svd(cross, compute_uv=False) ** 2)
+    logging.info(f'Singular values: {np.round(s, 3)}.')
+
+    # One random stream per permutation and per resample, workers take
+    # contiguous slices.
+    seeds = np.random.SeedSequence(random_state).spawn(n_perm + n_boot)
+    perm_seeds, boot_seeds = seeds[:n_perm], seeds[n_perm:]
+
+    n_chunks = max(1, min(effective_n_jobs(n_jobs), n_perm))
+    bounds = np.linspace(0, n_perm, n_chunks + 1).astype(int)
+    null = Parallel(n_jobs=n_jobs)(
+        delayed(_null_singular_values)(yw, lx, perm_seeds[start:stop])
+        for start, stop in zip(bounds[:-1], bounds[1:]))
+    null = np.concatenate(null)[:, :k]
+    pvalues = (1 + (null >= s).sum(axis=0)) / (n_perm + 1)
+
+    n_chunks = max(1, min(effective_n_jobs(n_jobs), n_boot))
+    bounds = np.linspace(0, n_boot, n_chunks + 1).astype(int)
+    moments = Parallel(n_jobs=n_jobs)(
+        delayed(_bootstrap_moments)(yw, lx, w, boot_seeds[start:stop])
+        for start, stop in zip(bounds[:-1], bounds[1:]))
+    mean_w = sum(m[0] for m in moments) / n_boot
+    cov_w = sum(m[1] for m in moments) / n_boot - np.einsum('ik,jk->kij', mean_w, mean_w)
+
+    # Brain saliences: x' ux diag(scale / sx) w, with x = ux diag(sx) v'.
+    proj = ux * (scale / sx ** 2)
+    saliences = np.empty((x.shape[1], k))
+    std = np.empty((x.shape[1], k))
+    for start in range(0, x.shape[1], chunk_size):
+        v = x[:, start:start + chunk_size].T.astype(np.float64) @ proj
+        saliences[start:start + v.shape[0]] = v @ w
+        for c in range(k):
+            std[start:start + v.shape[0], c] = np.sqrt(np.maximum(
+                ((v @ cov_w[c]) * v).sum(axis=1), 0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        bsr = np.where(std > 0, saliences / std, 0)
+
+    if method == 'cca':
+        behaviour = vyt.T @ (u * (np.sqrt(n - 1) / sy)[:, None])
+    else:
+        behaviour = u
+
+    return {
+        'singular_values': s,
+        'explained': explained,
+        'pvalues': pvalues,
+        'behaviour_saliences': behaviour,
+        'brain_saliences': saliences,
+        'bootstrap_ratios': bsr,
+        'brain_scores': lx @ w,
+        'behaviour_scores': y @ behaviour,
+    }
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+
+import logging
+
+import numpy as np
+from joblib import Parallel, delayed, effective_n_jobs
+from sklearn.model_selection import KFold
+from brainccpy.io.utils import iter_edge_columns
+
+
+def _edge_chunks(x, chunk_size):
+    """
+    Iterate over chunks of edges (start, n_subjects x chunk float64 array) of
+    an edge table (2D array or dataframe, can be memory-mapped) or of the
+    upper triangle of a stack of matrices (3D array or list of .npy files).
+    """
+    if hasattr(x, 'iloc'):
+        x = x.to_numpy()
+    first = np.load(x[0], mmap_mode='r') if isinstance(x[0], str) else np.asarray(x[0])
+    if first.ndim == 2:
+        rows, cols = np.triu_indices(first.shape[0], k=1)
+        yield from iter_edge_columns(x, rows, cols, chunk_size)
+    else:
+        for start in range(0, x.shape[1], chunk_size):
+            yield start, np.asarray(x[:, start:start + chunk_size], dtype=np.float64)
+
+
+def _standardize_chunk(chunk):
+    chunk = chunk - chunk.mean(axis=0)
+    std = chunk.std(axis=0, ddof=1)
+    return chunk / np.where(std > 0, std, 1)
+
+
+def edge_kernel(x, standardize=True, chunk_size=10000):
+    """
+    Function to compute the linear kernel (n_subjects x n_subjects) of the
+    edges, accumulated over chunks of edges so that only n_subjects x
+    chunk_size values are held at once.
+    :param x:           Edge table (n_subjects x n_edges array or dataframe,
+                        can be memory-mapped), or stack of matrices (3D array
+                        or list of .npy files, upper triangle edges are used).
+    :param standardize: If True, every edge is z-scored across subjects.
+    :param chunk_size:  Number of edges processed at once.
+    :return:            Kernel matrix and number of edges.
+    """
+    kernel = None
+    n_edges = 0
+    for start, chunk in _edge_chunks(x, chunk_size):
+        if standardize:
+            chunk = _standardize_chunk(chunk)
+        if kernel is None:
+            kernel = np.zeros((chunk.shape[0], chunk.shape[0]))
+        kernel += chunk @ chunk.T
+        n_edges += chunk.shape[1]
+
+    # A single missing value spreads to the whole kernel (through the
+    # standardization) and the eigendecompositions would silently be wrong.
+    if not np.all(np.isfinite(kernel)):
+        raise ValueError('Edges contain missing (NaN) or infinite values, remove '
+                         'the subjects concerned.')
+
+    return kernel, n_edges
+
+
+def _fold_basis(kernel, train, test):
+    """
+    Eigendecomposition of the training kernel centered on the training
+    subjects (unpenalized intercept) and projection of the test subjects.
+    """
+    ktr = kernel[np.ix_(train, train)]
+    means = ktr.mean(axis=0)
+    ktr = ktr - means[None] - means[:, None] + means.mean()
+    vals, vecs = np.linalg.eigh(ktr)
+    keep = vals > vals.max() * 1e-10
+    vals, vecs = vals[keep], vecs[:, keep]
+
+    proj = None
+    if test is not None:
+        kte = kernel[np.ix_(test, train)]
+        kte = kte - kte.mean(axis=1)[:, None] - means[None] + means.mean()
+        proj = kte @ vecs
+
+    # Alphas are relative to the mean eigenvalue of the training kernel.
+    return {'train': train, 'test': test, 'vals': vals, 'vecs': vecs, 'proj': proj,
+            'scale': vals.sum() / len(train)}
+
+
+def _loo_errors(basis, y, alphas):
+    """
+    Closed-form leave-one-out residuals of kernel ridge for every alpha and
+    target (n_alphas x n_train x n_targets), from the hat matrix diagonal.
+    """
+    vals, vecs = basis['vals'], basis['vecs']
+    shrink = vals / (vals + alphas[:, None] * basis['scale'])
+    yc = y - y.mean(axis=0)
+    z = vecs.T @ yc
+    fitted = vecs @ (shrink[:, :, None] * z)
+    hat = 1 / len(y) + shrink @ (vecs ** 2).T
+
+    return (yc - fitted) / (1 - hat)[:, :, None]
+
+
+def _fold_predictions(basis, y, alphas):
+    """
+    Test predictions of kernel ridge for every alpha and target
+    (n_alphas x n_test x n_targets).
+    """
+    ytr = y[basis['train']]
+    mean = ytr.mean(axis=0)
+    z = basis['vecs'].T @ (ytr - mean)
+    inv = 1 / (basis['vals'] + alphas[:, None] * basis['scale'])
+
+    return basis['proj'] @ (inv[:, :, None] * z) + mean
+
+
+def _cv_predictions(bases, y, alphas):
+    """
+    Cross-validated predictions (n_subjects x n_targets) and selected alpha
+    indices. With a single basis without test subjects, leave-one-out
+    predictions of the alpha minimizing the LOO error. Otherwise, in each
+    fold, the alpha of each target is selected by closed-form LOO on the
+    training subjects (nested).
+    """
+    if len(bases) == 1 and bases[0]['test'] is None:
+        errors = _loo_errors(bases[0], y, alphas)
+        best = np.argmin((errors ** 2).sum(axis=1), axis=0)
+        pred = y - errors[best, :, np.arange(y.shape[1])].T
+        return pred, best[None]
+
+    pred = np.empty(y.shape)
+    selected = []
+    for basis in bases:
+        errors = _loo_errors(basis, y[basis['train']], alphas)
+        best = np.argmin((errors ** 2).sum(axis=1), axis=0)
+        fold = _fold_predictions(basis, y, alphas)
+        pred[basis['test']] = fold[best, :, np.arange(y.shape[1])].T
+        selected.append(best)
+
+    return pred, np.array(selected)
+
+
+def _pearson(a, b):
+    a = a - a.mean(axis=0)
+    b = b - b.mean(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (a * b).sum(axis=0) / np.sqrt((a ** 2).sum(axis=0) * (b ** 2).sum(axis=0))
+
+
+def _null_scores(bases, y, alphas, seeds):
+    null = np.empty((len(seeds), y.shape[1]))
+    for i, seed in enumerate(seeds):
+        yp = y[np.random.default_rng(seed).permutation(len(y))]
+        null[i] = _pearson(_cv_predictions(bases, yp, alphas)[0], yp)
+
+    return null
+
+
+def ridge_cv(x, y, alphas=np.logspace(-3, 3, 13), cv=10, n_perm=0, standardize=True,
+             weights=False, n_jobs=1, random_state=1234, chunk_size=10000):
+    """
+    Function to predict behavioural scores from connectivity with
+    cross-validated ridge regression (connectome-based predictive modelling).
+    Since n_subjects << n_edges, ridge is solved in the subject space: the
+    edges are only read once to build the linear kernel (in chunks), then
+    each fold needs a single eigendecomposition of its training kernel to
+    solve every alpha and every target at once. Leave-one-out errors are
+    obtained in closed form from the hat matrix diagonal. Permutations reuse
+    the eigendecompositions (only the scores are permuted) and run in
+    parallel workers.
+    :param x:               Edge table (n_subjects x n_edges, array or
+                            dataframe, can be memory-mapped) or stack of
+                            matrices (3D array or list of .npy files, upper
+                            triangle edges are used).
+    :param y:               Behavioural scores (n_subjects x n_targets).
+    :param alphas:          Ridge penalties, relative to the mean eigenvalue
+                            of the training kernel.
+    :param cv:              'loo' or number of folds. With 'loo', the alpha of
+                            each target minimizes the leave-one-out error
+                            (optimistic, as it is selected on the same
+                            predictions). With k folds, alphas are selected in
+                            each fold by leave-one-out on its training
+                            subjects (nested).
+    :param n_perm:          Number of permutations of the scores.
+    :param standardize:     If True, edges are z-scored across subjects.
+    :param weights:         If True, edge weights of the model fitted on all
+                            subjects are computed (second pass over the edges).
+    :param n_jobs:          Number of processes for the permutations.
+    :param random_state:    Seed of the folds and from which the seed of
+                            every permutation is spawned (results do not
+                            depend on n_jobs).
+    :param chunk_size:      Number of edges processed at once.
+    :return:                Dictionary with cross-validated predictions,
+                            Pearson r, R2 and MAE of each target, permutation
+                            p-values of r (if n_perm), selected alphas (per
+                            fold) and edge weights (n_edges x n_targets, if
+                            weights).
+    """
+    y = np.asarray(y, dtype=float)
+    if y.ndim == 1:
+        y = y[:, None]
+    alphas = np.asarray(alphas, dtype=float)
+
+    kernel, n_edges = edge_kernel(x, standardize=standardize, chunk_size=chunk_size)
+    if kernel.shape[0] != len(y):
+        raise ValueError('x and y should contain the same number of subjects.')
+    logging.info(f'Kernel computed on {n_edges} edges.')
+
+    n = len(y)
+    if cv == 'loo':
+        bases = [_fold_basis(kernel, np.arange(n), None)]
+    else:
+        folds = KFold(int(cv), shuffle=True, random_state=random_state).split(np.arange(n))
+        bases = [_fold_basis(kernel, train, test) for train, test in folds]
+
+    pred, selected = _cv_predictions(bases, y, alphas)
+    r = _pearson(pred, y)
+    res = {
+        'predictions': pred,
+        'r': r,
+        'r2': 1 - ((y - pred) ** 2).sum(axis=0) / ((y - y.mean(axis=0)) ** 2).sum(axis=0),
+        'mae': np.abs(y - pred).mean(axis=0),
+        'alphas': alphas[selected],
+    }
+    logging.info(f'Cross-validated r: {np.round(r, 3)}.')
+
+    if n_perm:
+        # One random stream per permutation, workers take contiguous slices.
+        seeds = np.random.SeedSequence(random_state).spawn(n_perm)
+        n_chunks = max(1, min(effective_n_jobs(n_jobs), n_perm))
+        bounds = np.linspace(0, n_perm, n_chunks + 1).astype(int)
+        null = Parallel(n_jobs=n_jobs)(
+            delayed(_null_scores)(bases, y, alphas, seeds[start:stop])
+            for start, stop in zip(bounds[:-1], bounds[1:]))
+        null = np.concatenate(null)
+        res['null'] = null
+        res['pvalues'] = (1 + (null >= r).sum(axis=0)) / (n_perm + 1)
+
+    if weights:
+        # Final model on all subjects, alpha selected by leave-one-out.
+        basis = bases[0] if cv == 'loo' else _fold_basis(kernel, np.arange(n), None)
+        errors = _loo_errors(basis, y, alphas)
+        best = np.argmin((errors ** 2).sum(axis=1), axis=0)
+        inv = 1 / (basis['vals'][:, None] + alphas[best] * basis['scale'])
+        dual = basis['vecs'] @ (inv * (basis['vecs'].T @ (y - y.mean(axis=0))))
+        w = np.empty((n_edges, y.shape[1]))
+        for start, chunk in _edge_chunks(x, chunk_size):
+            if standardize:
+                chunk = _standardize_chunk(chunk)
+            w[start:start + chunk.shape[1]] = chunk.T @ dual
+        res['weights'] = w
+        res['final_alphas'] = alphas[best]
+
+    return res
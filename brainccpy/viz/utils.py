@@ -3,6 +3,7 @@ import logging
 
 import numpy as np
 import logging
+from brainccpy.io.utils import upper_triangle_edges
 
 
 def track_clustering(mat):
@@ -10,33 +11,23 @@ def track_clustering(mat):
     Function to classify connections in clusters (defined as connections linking
     common regions).
     :param mat:         Binary matrix containing connections to sort. (.npy)
+                        Boolean arrays and scipy.sparse matrices are accepted.
+                        Only entries equal to 1 are clustered.
     :return:            Dictionary of clusters.
     """
 
     xindex = mat.shape[0]
     yindex = mat.shape[1]
 
-    mat = np.triu(mat)
-
     if xindex == yindex:
         logging.info('Input matrix is symmetrical')
     else:
         logging.info('Input matrix is asymmetrical.')
 
-    # Count number of non-zero connections in the matrix.
-    unique, counts = np.unique(mat, return_counts=True)
-    dic = dict(zip(unique, counts))
-    logging.info('Matrix contains {} connections. Extracting connections ...'.format(dic[1]))
-
-    # Extracting all connections with non-zero values in a table.
-    x = []
-    y = []
-    for i in range(0, xindex):
-        for j in range(0, yindex):
-            if mat[i, j] == 1:
-                x.append(i+1)
-                y.append(j+1)
-    pairs = np.rollaxis(np.array((x, y), dtype=int), 1)
+    # Extracting all connections equal to 1 in a table.
+    x, y = upper_triangle_edges(mat == 1)
+    logging.info('Matrix contains {} connections. Extracting connections ...'.format(len(x)))
+    pairs = np.stack((x + 1, y + 1), axis=1).astype(int)
     logging.info('Lookup table created. Clustering connections...')
 
     # Clustering connections.
@@ -70,3 +61,98 @@ def track_clustering(mat):
     return cluster_dict
 
 
+
+
+def threshold_clustering(mat, thresholds, direction='greater'):
+    """
+    Function to classify connections of a weighted matrix in clusters for a
+    list of thresholds in a single incremental pass. Edges are sorted once by
+    weight and added in threshold order to a union-find structure, so that
+    clusters at a stricter threshold are always nested in a cluster at the
+    next, more lenient, threshold.
+    :param mat:         Weighted matrix containing connections to sort (.npy).
+                        Zero-valued cells are considered as absent connections.
+    :param thresholds:  List of thresholds to evaluate.
+    :param direction:   'greater' keeps connections with weight >= threshold
+                        (t-stats, effect sizes), 'lower' keeps connections with
+                        weight <= threshold (p-values).
+    :return:            Dictionary of clusters for each threshold (same format
+                        as track_clustering) and dictionary of the parent cluster
+                        of each cluster at the next, more lenient, threshold.
+    """
+
+    if direction not in ['greater', 'lower']:
+        raise ValueError("direction should be either 'greater' or 'lower'.")
+
+    ncol = mat.shape[1]
+    n_nodes = max(mat.shape)
+
+    # Extracting all connections with non-zero values and sorting them once.
+    x, y = np.nonzero(np.triu(mat))
+    weights = mat[x, y]
+    if direction == 'greater':
+        order = np.argsort(-weights, kind='stable')
+        thresholds = sorted(thresholds, reverse=True)
+    else:
+        order = np.argsort(weights, kind='stable')
+        thresholds = sorted(thresholds)
+    x, y, weights = x[order], y[order], weights[order]
+    logging.info('Matrix contains {} connections. Clustering for {} thresholds ...'
+                 .format(len(weights), len(thresholds)))
+
+    # Number of sorted edges included at each threshold.
+    if direction == 'greater':
+        cuts = [int(np.searchsorted(-weights, -t, side='right')) for t in thresholds]
+    else:
+        cuts = [int(np.searchsorted(weights, t, side='right')) for t in thresholds]
+
+    parent = list(range(n_nodes))
+    size = [1] * n_nodes
+
+    def find(u):
+        while parent[u] != u:
+            parent[u] = parent[parent[u]]
+            u = parent[u]
+        return u
+
+    clusters = {}
+    parents = {}
+    prev_t = None
+    prev_names = None
+    added = 0
+    for t, cut in zip(thresholds, cuts):
+        for e in range(added, cut):
+            ru, rv = find(int(x[e])), find(int(y[e]))
+            if ru != rv:
+                if size[ru] < size[rv]:
+                    ru, rv = rv, ru
+                parent[rv] = ru
+                size[ru] += size[rv]
+        added = cut
+
+        roots = np.array([find(u) for u in range(n_nodes)], dtype=int)
+
+        # Sorting included connections in row-major order to number clusters
+        # the same way track_clustering does.
+        rm = np.argsort(x[:cut] * ncol + y[:cut], kind='stable')
+        cx, cy = x[:cut][rm], y[:cut][rm]
+        edge_roots = roots[cx]
+        uniq, first, inv = np.unique(edge_roots, return_index=True, return_inverse=True)
+        rank = np.empty(len(uniq), dtype=int)
+        rank[np.argsort(first)] = np.arange(len(uniq))
+
+        cluster_dict = {f'Cluster_{r + 1}': [] for r in range(len(uniq))}
+        for c in range(len(cx)):
+            cluster_dict[f'Cluster_{rank[inv[c]] + 1}'].append(f'{cx[c] + 1}_{cy[c] + 1}')
+        names = {int(uniq[u]): f'Cluster_{rank[u] + 1}' for u in range(len(uniq))}
+
+        if prev_names is not None:
+            parents[prev_t] = {name: names[int(roots[r])] for r, name in prev_names.items()}
+        clusters[t] = cluster_dict
+        prev_t, prev_names = t, names
+        logging.info(f'Threshold {t}: {cut} connections in {len(uniq)} clusters.')
+
+    if prev_names is not None:
+        parents[prev_t] = {name: None for name in prev_names.values()}
+
+    return clusters, parents
@@ -33,6 +33,8 @@ opts = dict(name=NAME,
             version=VERSION,
             packages=find_packages(),
             scripts=SCRIPTS,
+            extras_require={'dask': ['dask[distributed]'],
+                            'hdbscan': ['hdbscan']},
             include_package_data=True)
 
 setup(**opts)